@@ -0,0 +1,65 @@
+#
+# This code is placed into the PUBLIC DOMAIN.
+# It was written by Douglas Burke dburke.gw@gmail.com
+#
+"""Benchmarks for the agnslim model.
+
+The "cold" benchmarks clear the cache of the instance before each
+evaluation, so that the disc is calculated, whereas the "warm"
+benchmarks re-use the cached spectrum, so only measure the rebinning
+onto the requested grid.
+"""
+
+from xspeclmodels import XSagnslim
+
+from .common import GRID_SIZES, make_grid, throughput
+
+
+# The logmdot values for the two regimes: the inner radius is only
+# changed from the ISCO, and the slim-disc temperature profile is
+# only used, for the super-Eddington case.
+#
+REGIMES = {'sub-Eddington': -1.0,
+           'super-Eddington': 1.5}
+
+
+class Agnslim:
+
+    params = (GRID_SIZES, list(REGIMES))
+    param_names = ['nbins', 'regime']
+    timeout = 300
+
+    def setup(self, nbins, regime):
+        self.mdl = XSagnslim()
+        self.mdl.logmdot = REGIMES[regime]
+        self.pars = [p.val for p in self.mdl.pars]
+        self.xlo, self.xhi = make_grid(nbins)
+
+        # ensure the warm benchmarks use the cache
+        self.mdl._calc(self.pars, self.xlo, self.xhi)
+
+    def cold(self):
+        self.mdl.cache_clear()
+        self.mdl._calc(self.pars, self.xlo, self.xhi)
+
+    def warm(self):
+        self.mdl._calc(self.pars, self.xlo, self.xhi)
+
+    def time_cold(self, nbins, regime):
+        self.cold()
+
+    def time_warm(self, nbins, regime):
+        self.warm()
+
+    def peakmem_cold(self, nbins, regime):
+        self.cold()
+
+    def track_throughput_cold(self, nbins, regime):
+        return throughput(self.cold, nbins)
+
+    track_throughput_cold.unit = 'bins/s'
+
+    def track_throughput_warm(self, nbins, regime):
+        return throughput(self.warm, nbins)
+
+    track_throughput_warm.unit = 'bins/s'
@@ -0,0 +1,108 @@
+#
+# This code is placed into the PUBLIC DOMAIN.
+# It was written by Douglas Burke dburke.gw@gmail.com
+#
+"""Benchmarks for the thcompc convolution model.
+
+The seed spectra are calculated once, in the setup stage. The "cold"
+benchmarks clear the cache of Kompaneets operators before each
+evaluation, whereas the "warm" benchmarks re-use the operator, as
+happens when only the seed spectrum changes during a fit.
+"""
+
+import numpy as np
+
+from sherpa.astro.xspec import XSdiskbb, XSbbody
+
+from xspeclmodels import _models, thcompc_cache_clear
+
+from .common import GRID_SIZES, make_grid, throughput
+
+
+def diskbb(xlo, xhi):
+    mdl = XSdiskbb()
+    mdl.Tin = 0.5
+    return mdl(xlo, xhi)
+
+
+def bbody(xlo, xhi):
+    mdl = XSbbody()
+    mdl.kT = 0.1
+    return mdl(xlo, xhi)
+
+
+SEEDS = {'diskbb': diskbb, 'bbody': bbody}
+
+
+class Thcompc:
+
+    params = (GRID_SIZES, list(SEEDS))
+    param_names = ['nbins', 'seed']
+
+    # gamma_tau, kT_e, z
+    pars = [1.7, 50, 0]
+
+    def setup(self, nbins, seed):
+        self.xlo, self.xhi = make_grid(nbins)
+        self.seed = SEEDS[seed](self.xlo, self.xhi)
+
+        # This is what XSthcompc uses, but that class requires the
+        # CIAO contributed scripts.
+        self.calc = _models.thcompf
+        self.calc(self.pars, self.seed, self.xlo, self.xhi)
+
+    def cold(self):
+        thcompc_cache_clear()
+        self.calc(self.pars, self.seed, self.xlo, self.xhi)
+
+    def warm(self):
+        self.calc(self.pars, self.seed, self.xlo, self.xhi)
+
+    def time_cold(self, nbins, seed):
+        self.cold()
+
+    def time_warm(self, nbins, seed):
+        self.warm()
+
+    def peakmem_cold(self, nbins, seed):
+        self.cold()
+
+    def track_throughput_cold(self, nbins, seed):
+        return throughput(self.cold, nbins)
+
+    track_throughput_cold.unit = 'bins/s'
+
+    def track_throughput_warm(self, nbins, seed):
+        return throughput(self.warm, nbins)
+
+    track_throughput_warm.unit = 'bins/s'
+
+
+class ThcompcSeeds:
+    """Convolve several seed spectra with the same parameters, either
+    one at a time or together (as XSthcompc.calc_seeds does)."""
+
+    params = (GRID_SIZES, [16, 128])
+    param_names = ['nbins', 'nseeds']
+
+    pars = [1.7, 50, 0]
+
+    def setup(self, nbins, nseeds):
+        self.xlo, self.xhi = make_grid(nbins)
+
+        mdl = XSdiskbb()
+        seeds = []
+        for tin in np.linspace(0.1, 2, nseeds):
+            mdl.Tin = tin
+            seeds.append(mdl(self.xlo, self.xhi))
+
+        self.seeds = np.asarray(seeds)
+        self.calc = _models.thcompf
+        self.calc(self.pars, self.seeds[0], self.xlo, self.xhi)
+
+    def time_loop(self, nbins, nseeds):
+        for seed in self.seeds:
+            self.calc(self.pars, seed, self.xlo, self.xhi)
+
+    def time_batch(self, nbins, nseeds):
+        self.calc(self.pars, self.seeds, self.xlo, self.xhi)
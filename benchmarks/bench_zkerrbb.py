@@ -0,0 +1,67 @@
+#
+# This code is placed into the PUBLIC DOMAIN.
+# It was written by Douglas Burke dburke.gw@gmail.com
+#
+"""Benchmarks for the zkerrbb model.
+
+The kerrbb table is read in the setup stage, so it is not included
+in the timings. The "cold" benchmarks alternate between two spin
+values, so that the spectrum has to be interpolated from the table
+for each evaluation, whereas the "warm" benchmarks re-use the
+interpolated spectrum.
+"""
+
+import itertools
+
+from xspeclmodels import XSzkerrbb
+
+from .common import GRID_SIZES, make_grid, throughput
+
+
+# The (rflag, lflag) combinations.
+#
+FLAGS = ['{}{}'.format(rflag, lflag)
+         for rflag, lflag in itertools.product([0, 1], repeat=2)]
+
+
+class Zkerrbb:
+
+    params = (GRID_SIZES, FLAGS)
+    param_names = ['nbins', 'rflag_lflag']
+
+    def setup(self, nbins, flags):
+        self.mdl = XSzkerrbb()
+        self.mdl.rflag = int(flags[0])
+        self.mdl.lflag = int(flags[1])
+        self.pars = [p.val for p in self.mdl.pars]
+        self.pars2 = list(self.pars)
+        self.pars2[1] = 0.7
+        self.xlo, self.xhi = make_grid(nbins)
+
+        self.mdl._calc(self.pars, self.xlo, self.xhi)
+
+    def cold(self):
+        self.mdl._calc(self.pars2, self.xlo, self.xhi)
+        self.pars, self.pars2 = self.pars2, self.pars
+
+    def warm(self):
+        self.mdl._calc(self.pars, self.xlo, self.xhi)
+
+    def time_cold(self, nbins, flags):
+        self.cold()
+
+    def time_warm(self, nbins, flags):
+        self.warm()
+
+    def peakmem_cold(self, nbins, flags):
+        self.cold()
+
+    def track_throughput_cold(self, nbins, flags):
+        return throughput(self.cold, nbins)
+
+    track_throughput_cold.unit = 'bins/s'
+
+    def track_throughput_warm(self, nbins, flags):
+        return throughput(self.warm, nbins)
+
+    track_throughput_warm.unit = 'bins/s'
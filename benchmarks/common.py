@@ -0,0 +1,41 @@
+#
+# This code is placed into the PUBLIC DOMAIN.
+# It was written by Douglas Burke dburke.gw@gmail.com
+#
+"""Support code for the benchmarks."""
+
+import time
+
+import numpy as np
+
+
+# The number of bins in the grids used for the benchmarks.
+#
+GRID_SIZES = [100, 1000, 10000, 100000]
+
+
+def make_grid(nbins, emin=0.1, emax=20.0):
+    """Return the low and high edges of a logarithmically-spaced grid.
+
+    The units are keV.
+    """
+
+    egrid = np.logspace(np.log10(emin), np.log10(emax), nbins + 1)
+    return egrid[:-1], egrid[1:]
+
+
+def throughput(func, nbins, mintime=0.2):
+    """The number of bins evaluated per second by func().
+
+    The function is called repeatedly until at least mintime seconds
+    have elapsed.
+    """
+
+    ncalls = 0
+    start = time.perf_counter()
+    while True:
+        func()
+        ncalls += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= mintime:
+            return ncalls * nbins / elapsed
@@ -49,7 +49,7 @@ import sherpa
 #
 sherpa_incpath = sherpa.get_include()
 xspec_basedir = "xspec"
-includes = [numpy.get_include(), sherpa_incpath]
+includes = [numpy.get_include(), sherpa_incpath, "src/xspeclmodels/src"]
 for dname in ["", "include", "XSFunctions"]:
     includes.append(os.path.join(xspec_basedir, dname))
 
@@ -78,7 +78,38 @@ libnames = ["XSFunctions", "XSUtil", "XS", "hdsp_6.26",
 #
 FORTRANFILES = ['src/xspec/agnslim.f',
                 'src/xspec/zrunkbb.f',
-                'src/xspec/th.f90']
+                'src/xspec/th.f90',
+                'src/xspec/locked.f']
+
+# The models can be evaluated from several threads, so the FORTRAN
+# code must not place local variables in static memory (which
+# gfortran does for large arrays unless told otherwise). The keys
+# are the numpy.distutils compiler types. If the compiler is not
+# listed then the module is built so that the models can only be
+# evaluated with nthreads=1.
+#
+FORTRANFLAGS = {'gnu95': ['-frecursive'],
+                'intel': ['-recursive'],
+                'intelem': ['-recursive'],
+                'intelv': ['/recursive'],
+                'intelvem': ['/recursive'],
+                'nag': ['-recursive'],
+                'nagfor': ['-recursive'],
+                'pg': ['-Mrecursive'],
+                'nv': ['-Mrecursive'],
+                'sun': ['-stackvar']}
+
+# The agnslim disc calculation can be parallelized with OpenMP, but
+# this is only done if the XSPECLMODELS_OPENMP environment variable
+# is set (to a non-empty value other than 0) when building, e.g.
+#
+#   XSPECLMODELS_OPENMP=1 pip install -e .
+#
+# It has only been tested with gfortran.
+#
+use_openmp = os.environ.get('XSPECLMODELS_OPENMP', '') not in ['', '0']
+if use_openmp:
+    FORTRANFLAGS['gnu95'].append('-fopenmp')
 
 
 # Seems to be needed on macOS, otherwise link time creates this
@@ -91,18 +122,34 @@ FORTRANFILES = ['src/xspec/agnslim.f',
 #
 if os.uname().sysname == 'Darwin':
     cargs = ['-Wl,-no_compact_unwind']
+    ccargs = []
 else:
-    cargs = []
+    cargs = ['-pthread']
+    ccargs = ['-pthread']
+
+if use_openmp:
+    cargs.append('-fopenmp')
 
 mod = Extension('xspeclmodels._models',
                 include_dirs=includes,
                 library_dirs=libs,
                 libraries=libnames,
                 sources=['src/xspeclmodels/src/_models.cxx',
+                         'src/xspeclmodels/src/agnslim.cxx',
+                         'src/xspeclmodels/src/kerrbbtable.cxx',
+                         'src/xspeclmodels/src/locking.cxx',
+                         'src/xspeclmodels/src/thcomp.cxx',
                          'src/xspec/zkerrbb.cxx'],
+                extra_compile_args=ccargs,
                 extra_link_args=cargs,
                 # extra_link_args=['-lgfortran'],
-                depends=FORTRANFILES
+                depends=FORTRANFILES +
+                ['src/xspeclmodels/src/agnslim.hh',
+                 'src/xspeclmodels/src/kerrbbtable.hh',
+                 'src/xspeclmodels/src/locking.hh',
+                 'src/xspeclmodels/src/lrucache.hh',
+                 'src/xspeclmodels/src/thcomp.hh',
+                 'src/xspeclmodels/src/zkerrbb.hh']
                 )
 
 # TODO:
@@ -125,10 +172,23 @@ class ExtBuild(build_ext):
         cmplr = fcompiler.new_fcompiler()
         cmplr.customize()
 
+        try:
+            fflags = FORTRANFLAGS[cmplr.compiler_type]
+        except KeyError:
+            self.warn('The FORTRAN code is not known to be re-entrant ' +
+                      'with compiler {}, '.format(cmplr.compiler_type) +
+                      'so models can only be evaluated with nthreads=1')
+            fflags = []
+        else:
+            for ext in self.extensions:
+                ext.define_macros.append(('XSPECLMODELS_FORTRAN_REENTRANT',
+                                          None))
+
         self.announce('Compiling FORTRAN code', level=log.INFO)
         fobjs = cmplr.compile(FORTRANFILES,
                               output_dir=self.build_temp,
-                              debug=self.debug)
+                              debug=self.debug,
+                              extra_postargs=fflags)
 
         # Could just append if set, but for now expect not to be
         # set, so error out if this changes
@@ -153,12 +213,15 @@ kwargs = {
     'package_dir': {'': 'src/'},
 
     'ext_modules': [mod],
+    'scripts': ['scripts/xspeclmodels-replay'],
+
+    # The module-level __getattr__ used to import XSthcompc on demand
+    # requires Python 3.7.
+    'python_requires': '>=3.7',
 
     'classifiers': [
         'License :: CC0 1.0 Universal (CC0 1.0) Public Domain Dedicationm',
         'Intended Audience :: Science/Research',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
         'Programming Language :: Python :: 3.7',
         'Programming Language :: Python :: Implementation :: CPython',
         'Topic :: Scientific/Engineering :: Astronomy',
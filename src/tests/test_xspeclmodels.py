@@ -5,6 +5,9 @@ Some of this is essentially copying what is in __init__.py, but did
 actually find something I'd forgotten to implement...
 """
 
+import subprocess
+import sys
+
 import pytest
 
 import numpy as np
@@ -34,6 +37,58 @@ def test_do_we_import_all_the_things():
     assert syms == EXPECTED_MODELS
 
 
+# The time taken to import xspeclmodels, in seconds, once Sherpa's
+# XSPEC module has been imported. The import takes about 0.02 seconds
+# when the XSPEC library is not initialized.
+#
+IMPORT_BUDGET = 0.25
+
+
+def test_import_is_lazy():
+    """The XSPEC library and sherpa_contrib are not loaded on import."""
+
+    # Use a separate process so that the import is not affected by
+    # the other tests.
+    code = ';'.join(['import sys, time',
+                     'import sherpa.astro.xspec',
+                     't0 = time.perf_counter()',
+                     'import xspeclmodels',
+                     'print(time.perf_counter() - t0)',
+                     'print(xspeclmodels._xspec_initialized)',
+                     'print("sherpa_contrib" in sys.modules)',
+                     'print("sherpa_contrib.xspec.xsmodels" in sys.modules)'])
+    out = subprocess.run([sys.executable, '-c', code], check=True,
+                         stdout=subprocess.PIPE, universal_newlines=True)
+    dt, initialized, contrib, xsmodels = out.stdout.split()
+    assert float(dt) < IMPORT_BUDGET
+    assert initialized == 'False'
+    assert contrib == 'False'
+    assert xsmodels == 'False'
+
+
+def test_broken_sherpa_contrib(tmp_path):
+    """A sherpa_contrib that can not be imported is treated as missing."""
+
+    pkg = tmp_path / 'sherpa_contrib'
+    (pkg / 'xspec').mkdir(parents=True)
+    (pkg / '__init__.py').write_text('')
+    (pkg / 'xspec' / '__init__.py').write_text('')
+    (pkg / 'xspec' / 'xsmodels.py').write_text('raise ImportError("broken")')
+
+    code = ';'.join(['import sys',
+                     'sys.path.insert(0, {!r})'.format(str(tmp_path)),
+                     'import xspeclmodels',
+                     'print(xspeclmodels.support_convolve)',
+                     'print(hasattr(xspeclmodels, "XSthcompc"))',
+                     'print(xspeclmodels.support_convolve)',
+                     'print("XSthcompc" in xspeclmodels.__all__)',
+                     'from xspeclmodels import *',
+                     'import xspeclmodels.ui'])
+    out = subprocess.run([sys.executable, '-c', code], check=True,
+                         stdout=subprocess.PIPE, universal_newlines=True)
+    assert out.stdout.split() == ['True', 'False', 'False', 'False']
+
+
 def test_create_agnslim():
     """Can we create an agnslim instance?"""
 
@@ -110,6 +165,146 @@ def test_can_evaluate_agnslim():
     assert (y1[:-1] == y2).all()
 
 
+def test_agnslim_cache():
+    """Is the spectrum re-used when the parameters do not change?"""
+
+    import xspeclmodels
+    from xspeclmodels import XSagnslim
+
+    xspeclmodels.agnslim_cache_clear()
+    info = xspeclmodels.agnslim_cache_info()
+    assert info.hits == 0
+    assert info.misses == 0
+    assert info.currsize == 0
+
+    # Turn off the Sherpa cache so that the model is always called.
+    mdl = XSagnslim()
+    mdl._use_caching = False
+
+    egrid = np.arange(0.1, 10, 0.01)
+    y1 = mdl(egrid)
+    y2 = mdl(egrid)
+    assert (y1 == y2).all()
+
+    info = xspeclmodels.agnslim_cache_info()
+    assert info.hits == 1
+    assert info.misses == 1
+    assert info.currsize == 1
+
+    # A different parameter set is added to the cache
+    mdl.logmdot = 0.5
+    y3 = mdl(egrid)
+    assert (y3 != y1).any()
+
+    info = xspeclmodels.agnslim_cache_info()
+    assert info.hits == 1
+    assert info.misses == 2
+    assert info.currsize == 2
+
+    # and the original spectrum is still available
+    mdl.logmdot = 1
+    y4 = mdl(egrid)
+    assert (y4 == y1).all()
+
+    info = xspeclmodels.agnslim_cache_info()
+    assert info.hits == 2
+    assert info.misses == 2
+
+
+def test_agnslim_cache_per_instance():
+    """Do two instances keep their own spectra?"""
+
+    from xspeclmodels import XSagnslim
+
+    m1 = XSagnslim('m1')
+    m2 = XSagnslim('m2')
+    m1._use_caching = False
+    m2._use_caching = False
+    m2.logmdot = 0.5
+
+    egrid = np.arange(0.1, 10, 0.01)
+    for _ in range(3):
+        m1(egrid)
+        m2(egrid)
+
+    for mdl in [m1, m2]:
+        info = mdl.cache_info()
+        assert info.hits == 2
+        assert info.misses == 1
+        assert info.currsize == 1
+
+    m1.cache_clear()
+    assert m1.cache_info().currsize == 0
+    assert m2.cache_info().currsize == 1
+
+
+def test_agnslim_cache_per_spectrum():
+    """Each spectrum number has its own cache."""
+
+    from xspeclmodels import XSagnslim
+
+    mdl = XSagnslim()
+    pars = [p.val for p in mdl.pars]
+    egrid = np.arange(0.1, 10, 0.01)
+
+    y1 = mdl._calc(pars, egrid, spectrumNumber=1)
+    y2 = mdl._calc(pars, egrid, spectrumNumber=2)
+    assert (y1 == y2).all()
+
+    info = mdl.cache_info()
+    assert info.hits == 0
+    assert info.misses == 2
+    assert info.currsize == 2
+
+
+def test_agnslim_pickle():
+    """The cache is not pickled but the model can be."""
+
+    import pickle
+    from xspeclmodels import XSagnslim
+
+    mdl = XSagnslim('pickled')
+    mdl.logmdot = 0.5
+    egrid = np.arange(0.1, 10, 0.01)
+    y1 = mdl(egrid)
+
+    mdl2 = pickle.loads(pickle.dumps(mdl))
+    assert mdl2.logmdot.val == pytest.approx(0.5)
+    assert mdl2.cache_info().currsize == 0
+
+    y2 = mdl2(egrid)
+    assert (y1 == y2).all()
+
+
+def test_agnslim_cache_size():
+    """Can the cache size be changed?"""
+
+    import xspeclmodels
+    from xspeclmodels import XSagnslim
+
+    orig = xspeclmodels.agnslim_cache_info().maxsize
+    try:
+        xspeclmodels.agnslim_cache_clear()
+        xspeclmodels.set_agnslim_cache_size(1)
+        assert xspeclmodels.agnslim_cache_info().maxsize == 1
+
+        mdl = XSagnslim()
+        mdl._use_caching = False
+        egrid = np.arange(0.1, 10, 0.01)
+        mdl(egrid)
+        mdl.logmdot = 0.5
+        mdl(egrid)
+        assert xspeclmodels.agnslim_cache_info().currsize == 1
+
+        xspeclmodels.set_agnslim_cache_size(0)
+        info = xspeclmodels.agnslim_cache_info()
+        assert info.maxsize == 0
+        assert info.currsize == 0
+
+    finally:
+        xspeclmodels.set_agnslim_cache_size(orig)
+
+
 def test_can_evaluate_zkerrbb():
     """Does this create some emission?
 
@@ -182,3 +377,1011 @@ def test_can_evaluate_thcompc():
     #
     assert y2.max() > y2conv.max()
     assert y2.sum() >= y2conv.sum()
+
+
+def test_agnslim_calc_batch():
+    """Does calc_batch match evaluating each parameter set?"""
+
+    from xspeclmodels import XSagnslim
+    mdl = XSagnslim('bat')
+
+    egrid = np.arange(0.1, 10, 0.01)
+    elo = egrid[:-1]
+    ehi = egrid[1:]
+
+    base = [p.val for p in mdl.pars]
+    pars = np.asarray([base] * 3)
+    pars[1, 2] = 0.5
+    pars[2, 2] = 0.5
+    pars[2, 14] = 2.0
+
+    y = mdl.calc_batch(pars, elo, ehi)
+    assert y.shape == (3, elo.size)
+
+    for p, yrow in zip(pars, y):
+        expected = mdl.calc(p, elo, ehi)
+        assert yrow == pytest.approx(expected)
+
+    assert (y[1] != y[0]).any()
+    assert y[2] == pytest.approx(2 * y[1])
+
+
+def test_zkerrbb_calc_batch():
+    """Does calc_batch match evaluating each parameter set?"""
+
+    from xspeclmodels import XSzkerrbb
+    mdl = XSzkerrbb('bat')
+
+    egrid = np.arange(0.1, 10, 0.01)
+
+    base = [p.val for p in mdl.pars]
+    pars = np.asarray([base] * 4)
+    pars[:, 1] = [0, 0.2, 0.5, 0.9]
+    pars[3, 9] = 10
+
+    y = mdl.calc_batch(pars, egrid)
+    assert y.shape == (4, egrid.size)
+
+    for p, yrow in zip(pars, y):
+        assert yrow == pytest.approx(mdl.calc(p, egrid))
+
+    # As with calc, the last bin is 0 when only one grid is given.
+    assert (y[:, -1] == 0).all()
+
+
+def test_calc_batch_nthreads_reentrant():
+    """Are several threads only used if the FORTRAN code is re-entrant?"""
+
+    from xspeclmodels import XSzkerrbb, _models
+    mdl = XSzkerrbb('bat')
+
+    egrid = np.arange(0.1, 10, 0.01)
+    pars = np.asarray([[p.val for p in mdl.pars]] * 2)
+    y = mdl.calc_batch(pars, egrid)
+
+    if _models.fortran_reentrant():
+        assert (mdl.calc_batch(pars, egrid, nthreads=2) == y).all()
+    else:
+        with pytest.raises(ValueError, match='re-entrant'):
+            mdl.calc_batch(pars, egrid, nthreads=2)
+
+
+def test_zkerrbb_state():
+    """Are the remembered distance and spectrum used correctly?"""
+
+    from sherpa.astro import xspec
+    from xspeclmodels import XSzkerrbb
+
+    egrid = np.arange(0.1, 10, 0.01)
+
+    mdl = XSzkerrbb('st')
+    mdl(egrid)
+
+    def check():
+        expected = XSzkerrbb('check')
+        for p1, p2 in zip(mdl.pars, expected.pars):
+            p2.val = p1.val
+
+        assert (mdl(egrid) == expected(egrid)).all()
+
+    mdl.Mdd = 2
+    check()
+
+    mdl.a = 0.8
+    check()
+
+    mdl.lflag = 0
+    check()
+
+    # The distance depends on the cosmology as well as the redshift.
+    y1 = mdl(egrid)
+    orig = xspec.get_xscosmo()
+    try:
+        xspec.set_xscosmo(50, orig[1], orig[2])
+        y2 = mdl(egrid)
+        assert (y2 != y1).any()
+        check()
+    finally:
+        xspec.set_xscosmo(*orig)
+
+    assert (mdl(egrid) == y1).all()
+
+
+def test_zkerrbb_double_precision():
+    """Does the double-precision mode give similar results?"""
+
+    from xspeclmodels import XSzkerrbb
+    mdl = XSzkerrbb('dp')
+
+    egrid = np.arange(0.1, 10, 0.01)
+    elo = egrid[:-1]
+    ehi = egrid[1:]
+
+    y1 = mdl(elo, ehi)
+
+    mdl.double_precision = True
+    y2 = mdl(elo, ehi)
+
+    assert (y1 != y2).any()
+    assert y2 == pytest.approx(y1, rel=1e-4)
+
+    pars = np.asarray([[p.val for p in mdl.pars]] * 2)
+    y3 = mdl.calc_batch(pars, elo, ehi)
+    assert (y3 == y2).all()
+
+    # Changing the precision clears the Sherpa cache.
+    mdl.double_precision = False
+    assert (mdl(elo, ehi) == y1).all()
+
+
+@pytest.mark.parametrize('double_precision', [False, True])
+def test_zkerrbb_nearest(double_precision):
+    """Does the bisection match a linear scan of the grid?
+
+    The scan picks the first of several equally-close elements.
+    """
+
+    from xspeclmodels import _models
+
+    dtype = np.float64 if double_precision else np.float32
+    rng = np.random.default_rng(2718)
+    grids = [np.arange(10.0),
+             np.asarray([0, 1, 1, 1, 2, 4, 4, 8], dtype=float),
+             np.logspace(-3, 2, 601),
+             np.sort(rng.uniform(-1, 1, 46)),
+             np.asarray([5.0])]
+
+    for grid in grids:
+        x = np.concatenate((grid, 0.5 * (grid[1:] + grid[:-1]),
+                            rng.uniform(grid[0] - 1, grid[-1] + 1, 500),
+                            [grid[0] - 10, grid[-1] + 10, np.nan]))
+        got = _models.zkerrbb_nearest(x, grid,
+                                      double_precision=double_precision)
+
+        x = x.astype(dtype)
+        grid = grid.astype(dtype)
+        expected = [np.argmin(np.abs(v - grid)) for v in x]
+        assert got.tolist() == expected
+
+
+@pytest.mark.parametrize('double_precision', [False, True])
+def test_zkerrbb_wide_bins(double_precision):
+    """Are bins covering many table points integrated correctly?
+
+    The flux in each wide bin should match the sum of the flux in
+    narrower bins covering the same range.
+    """
+
+    from xspeclmodels import XSzkerrbb
+    mdl = XSzkerrbb('wide')
+    mdl.double_precision = double_precision
+
+    # A stellar-mass black hole, so that the grid covers the peak of
+    # the spectrum.
+    mdl.Mbh = 10
+    mdl.Mdd = 10
+
+    fine = np.logspace(-2, 1, 3001)
+    coarse = fine[::500]
+
+    yfine = mdl(fine[:-1], fine[1:])
+    ycoarse = mdl(coarse[:-1], coarse[1:])
+
+    expected = yfine.reshape(6, 500).sum(axis=1)
+    assert ycoarse == pytest.approx(expected, rel=1e-4)
+
+
+@pytest.mark.parametrize("name,idx,vals",
+                         [('XSagnslim', 2, [0.2, 0.5, 0.8, 1.1]),
+                          ('XSzkerrbb', 1, [0, 0.2, 0.5, 0.9])])
+@pytest.mark.parametrize("nthreads", [0, 2, 8])
+def test_calc_batch_nthreads(name, idx, vals, nthreads):
+    """The results do not depend on the number of threads"""
+
+    import xspeclmodels
+    mdl = getattr(xspeclmodels, name)()
+
+    egrid = np.arange(0.1, 10, 0.01)
+    pars = np.asarray([[p.val for p in mdl.pars]] * len(vals))
+    pars[:, idx] = vals
+
+    expected = mdl.calc_batch(pars, egrid)
+    got = mdl.calc_batch(pars, egrid, nthreads=nthreads)
+    assert (got == expected).all()
+
+
+def test_zkerrbb_table_cache():
+    """Is the binary version of the kerrbb table created?"""
+
+    import os
+    from sherpa.astro.xspec import get_xspath_model
+    from xspeclmodels import XSzkerrbb
+
+    mdl = XSzkerrbb()
+    mdl.rflag = 0
+    mdl.lflag = 1
+    egrid = np.arange(0.1, 10, 0.01)
+    y = mdl(egrid)
+    assert (y > 0).any()
+
+    cachedir = os.environ.get('XDG_CACHE_HOME',
+                              os.path.expanduser('~/.cache'))
+    fname = 'kerrbb_flux2.cache'
+    paths = [os.path.join(get_xspath_model(), fname),
+             os.path.join(cachedir, 'xspeclmodels', fname)]
+    assert any(os.path.isfile(path) for path in paths)
+
+    # a second instance (which will use the cache) gives the same answer
+    mdl2 = XSzkerrbb()
+    mdl2.rflag = 0
+    mdl2.lflag = 1
+    assert (mdl2(egrid) == y).all()
+
+
+def test_zkerrbb_table_read_once():
+    """Is the FITS file read at most once when the flags change?
+
+    The instances alternate between the rflag and lflag settings, so
+    each call needs a different FLUX column.
+    """
+
+    from xspeclmodels import XSzkerrbb, _models
+
+    mdl1 = XSzkerrbb('r1')
+    mdl2 = XSzkerrbb('r2')
+    mdl1._use_caching = False
+    mdl2._use_caching = False
+
+    egrid = np.arange(0.1, 10, 0.01)
+    mdl1(egrid)
+
+    # The table may have been read by an earlier test, or not at all
+    # if the binary cache was used.
+    nreads = _models.zkerrbb_table_reads()
+    assert nreads <= 1
+
+    flags = [(0, 0), (1, 1), (0, 1), (1, 0)]
+    for i in range(8):
+        for j, mdl in enumerate([mdl1, mdl2]):
+            rflag, lflag = flags[(i + 2 * j) % 4]
+            mdl.rflag = rflag
+            mdl.lflag = lflag
+            assert (mdl(egrid) > 0).any()
+
+    assert _models.zkerrbb_table_reads() == nreads
+
+
+def test_zkerrbb_python_threads():
+    """Can the model be evaluated from several Python threads?
+
+    The threads use different rflag and lflag settings, which
+    requires the table to be re-read.
+    """
+
+    import threading
+    from xspeclmodels import XSzkerrbb
+    mdl = XSzkerrbb()
+
+    egrid = np.arange(0.1, 10, 0.01)
+    pars = np.asarray([[p.val for p in mdl.pars]] * 4)
+    pars[:, 7] = [0, 0, 1, 1]
+    pars[:, 8] = [0, 1, 0, 1]
+    expected = [mdl.calc(p, egrid) for p in pars]
+
+    got = [None] * 4
+
+    def evaluate(i):
+        for _ in range(5):
+            got[i] = mdl.calc(pars[i], egrid)
+
+    threads = [threading.Thread(target=evaluate, args=(i, ))
+               for i in range(4)]
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    for g, e in zip(got, expected):
+        assert (g == e).all()
+
+
+@pytest.mark.parametrize("shape", [(15,), (2, 14), (1, 2, 15)])
+def test_calc_batch_invalid_pars(shape):
+    """The parameter array must be 2D with the right number of columns"""
+
+    from xspeclmodels import XSagnslim
+    mdl = XSagnslim()
+    egrid = np.arange(0.1, 10, 0.01)
+    with pytest.raises(ValueError):
+        mdl.calc_batch(np.ones(shape), egrid)
+
+
+@pytest.mark.skipif(not support_convolve,
+                    reason='ciao-contrib module not installed')
+def test_thcompc_calc_batch():
+    """Does calc_batch match evaluating each parameter set?"""
+
+    from xspeclmodels import XSthcompc
+    mdl = XSthcompc('bat')
+
+    egrid = np.arange(0.1, 10, 0.01)
+    elo = egrid[:-1]
+    ehi = egrid[1:]
+
+    line = XSgaussian()
+    line.lineE = 5.0
+    line.Sigma = 1.0
+    fluxes = line(elo, ehi)
+
+    pars = np.asarray([[1.7, 50, 0], [2.0, 20, 0], [1.7, 50, 0.1]])
+
+    # the same spectrum for each parameter set
+    y = mdl.calc_batch(pars, fluxes, elo, ehi)
+    assert y.shape == (3, elo.size)
+    for p, yrow in zip(pars, y):
+        assert yrow == pytest.approx(mdl._calc(p, fluxes, elo, ehi))
+
+    # a spectrum per parameter set
+    fluxes2 = np.asarray([fluxes, 2 * fluxes, fluxes])
+    y2 = mdl.calc_batch(pars, fluxes2, elo, ehi)
+    assert y2[0] == pytest.approx(y[0])
+    assert y2[1] == pytest.approx(2 * y[1])
+    assert y2[2] == pytest.approx(y[2])
+
+
+@pytest.mark.skipif(not support_convolve,
+                    reason='ciao-contrib module not installed')
+def test_thcompc_cache():
+    """Is the operator re-used when only the seed spectrum changes?"""
+
+    import xspeclmodels
+    from xspeclmodels import XSthcompc
+    mdl = XSthcompc()
+
+    egrid = np.arange(0.1, 10, 0.01)
+    elo = egrid[:-1]
+    ehi = egrid[1:]
+
+    line = XSgaussian()
+    line.lineE = 5.0
+    line.Sigma = 1.0
+    flux1 = line(elo, ehi)
+    line.lineE = 3.0
+    flux2 = line(elo, ehi)
+
+    pars = [1.7, 50, 0]
+
+    xspeclmodels.thcompc_cache_clear()
+    y1 = mdl._calc(pars, flux1, elo, ehi)
+    y2 = mdl._calc(pars, flux2, elo, ehi)
+
+    info = xspeclmodels.thcompc_cache_info()
+    assert info.hits == 1
+    assert info.misses == 1
+    assert info.currsize == 1
+
+    # The redshift is not part of the operator
+    y3 = mdl._calc([1.7, 50, 0.1], flux2, elo, ehi)
+    assert xspeclmodels.thcompc_cache_info().hits == 2
+
+    xspeclmodels.thcompc_cache_clear()
+    assert (mdl._calc(pars, flux1, elo, ehi) == y1).all()
+    assert (mdl._calc(pars, flux2, elo, ehi) == y2).all()
+    assert (mdl._calc([1.7, 50, 0.1], flux2, elo, ehi) == y3).all()
+
+
+@pytest.mark.skipif(not support_convolve,
+                    reason='ciao-contrib module not installed')
+def test_thcompc_grid_size():
+    """Can an internal grid be used for large grids?"""
+
+    import xspeclmodels
+    from xspeclmodels import XSthcompc
+    mdl = XSthcompc()
+
+    egrid = np.arange(0.1, 10, 0.01)
+    elo = egrid[:-1]
+    ehi = egrid[1:]
+
+    line = XSgaussian()
+    line.lineE = 5.0
+    line.Sigma = 1.0
+    flux = line(elo, ehi)
+
+    pars = [1.7, 50, 0]
+
+    assert xspeclmodels.get_thcompc_grid_size() == 0
+    y1 = mdl._calc(pars, flux, elo, ehi)
+
+    try:
+        xspeclmodels.set_thcompc_grid_size(500)
+        assert xspeclmodels.get_thcompc_grid_size() == 500
+        y2 = mdl._calc(pars, flux, elo, ehi)
+        assert (y2 != y1).any()
+        assert y2.sum() == pytest.approx(flux.sum())
+        assert np.abs(y2 - y1).max() < 0.05 * y1.max()
+
+        # The internal grid is not used when it is larger than the
+        # requested grid.
+        xspeclmodels.set_thcompc_grid_size(2000)
+        assert (mdl._calc(pars, flux, elo, ehi) == y1).all()
+
+        with pytest.raises(ValueError):
+            xspeclmodels.set_thcompc_grid_size(5)
+
+    finally:
+        xspeclmodels.set_thcompc_grid_size(0)
+
+
+@pytest.mark.skipif(not support_convolve,
+                    reason='ciao-contrib module not installed')
+def test_thcompc_calc_seeds():
+    """Can several seed spectra be convolved together?"""
+
+    import xspeclmodels
+    from xspeclmodels import XSthcompc
+    mdl = XSthcompc()
+
+    egrid = np.arange(0.1, 10, 0.01)
+    elo = egrid[:-1]
+    ehi = egrid[1:]
+
+    line = XSgaussian()
+    fluxes = []
+    for lineE in [2.0, 4.0, 5.0, 7.0]:
+        line.lineE = lineE
+        fluxes.append(line(elo, ehi))
+
+    fluxes = np.asarray(fluxes)
+    pars = [1.7, 50, 0.1]
+
+    xspeclmodels.thcompc_cache_clear()
+    ys = mdl.calc_seeds(fluxes, elo, ehi, pars=pars)
+    assert ys.shape == fluxes.shape
+    assert xspeclmodels.thcompc_cache_info()[:2] == (0, 1)
+
+    for flux, y in zip(fluxes, ys):
+        assert (mdl._calc(pars, flux, elo, ehi) == y).all()
+
+    assert (mdl.calc_seeds(fluxes, elo, ehi, pars=pars,
+                           nthreads=2) == ys).all()
+
+    # The model values are used by default.
+    mdl.z = 0.1
+    assert (mdl.calc_seeds(fluxes, elo, ehi) == ys).all()
+
+    try:
+        xspeclmodels.set_thcompc_grid_size(500)
+        ys = mdl.calc_seeds(fluxes, elo, ehi, pars=pars)
+        for flux, y in zip(fluxes, ys):
+            assert (mdl._calc(pars, flux, elo, ehi) == y).all()
+
+    finally:
+        xspeclmodels.set_thcompc_grid_size(0)
+
+    with pytest.raises(ValueError):
+        mdl.calc_seeds(fluxes, elo, ehi, pars=[pars, pars])
+
+    with pytest.raises(ValueError):
+        mdl.calc_seeds(fluxes[0], elo, ehi, pars=pars)
+
+
+def test_agnslim_resolution():
+    """Can the resolution be changed?"""
+
+    from xspeclmodels import XSagnslim
+
+    mdl = XSagnslim()
+    mdl._use_caching = False
+    assert mdl.get_resolution() == mdl.resolution_modes['default']
+
+    egrid = np.arange(0.1, 10, 0.01)
+    y1 = mdl(egrid)
+
+    mdl.set_resolution('fast')
+    assert mdl.get_resolution() == mdl.resolution_modes['fast']
+    y2 = mdl(egrid)
+    assert (y2 != y1).any()
+    assert y2 == pytest.approx(y1, rel=0.1)
+
+    mdl.set_resolution(nn=2000, iout=500)
+    res = mdl.get_resolution()
+    assert res.nn == 2000
+    assert res.iout == 500
+    assert res.imax == mdl.resolution_modes['default'].imax
+
+    # The resolution is kept when the model is pickled
+    import pickle
+    mdl2 = pickle.loads(pickle.dumps(mdl))
+    assert mdl2.get_resolution() == res
+
+    # The spectrum for the default resolution is still cached
+    mdl.set_resolution()
+    y3 = mdl(egrid)
+    assert (y3 == y1).all()
+    assert mdl.cache_info().hits > 0
+
+
+@pytest.mark.parametrize("kwargs",
+                         [{'mode': 'slow'}, {'nn': 0}, {'ipow': -1}])
+def test_agnslim_resolution_invalid(kwargs):
+    """Invalid settings are rejected."""
+
+    from xspeclmodels import XSagnslim
+
+    mdl = XSagnslim()
+    with pytest.raises(ValueError):
+        mdl.set_resolution(**kwargs)
+
+    assert mdl.get_resolution() == mdl.resolution_modes['default']
+
+
+def test_agnslim_structure_cache():
+    """Is the disc structure re-used when only kTe or Gamma change?"""
+
+    from xspeclmodels import XSagnslim
+
+    mdl = XSagnslim()
+    mdl._use_caching = False
+
+    egrid = np.arange(0.1, 10, 0.01)
+    mdl(egrid)
+    mdl.kTe_warm = 0.3
+    mdl.Gamma_hot = 2.0
+    y1 = mdl(egrid)
+
+    info = mdl.structure_cache_info()
+    assert info.hits == 1
+    assert info.misses == 1
+    assert info.currsize == 1
+
+    # A structure parameter
+    mdl.logmdot = 0.5
+    mdl(egrid)
+    info = mdl.structure_cache_info()
+    assert info.hits == 1
+    assert info.misses == 2
+
+    # The result does not depend on whether the structure was cached
+    mdl.logmdot = 1
+    mdl.cache_clear()
+    assert mdl.structure_cache_info().currsize == 0
+    y2 = mdl(egrid)
+    assert (y2 == y1).all()
+
+
+def test_agnslim_seed_table():
+    """Can the nthcomp spectra be interpolated from a table?"""
+
+    from xspeclmodels import XSagnslim
+
+    mdl = XSagnslim()
+    mdl._use_caching = False
+    assert mdl.get_resolution().nseed == 0
+
+    egrid = np.arange(0.1, 10, 0.01)
+    y1 = mdl(egrid)
+    assert mdl.shape_cache_info().currsize == 0
+
+    mdl.set_resolution(nseed=40)
+    y2 = mdl(egrid)
+    assert (y2 != y1).any()
+    assert y2 == pytest.approx(y1, rel=0.01)
+
+    info = mdl.shape_cache_info()
+    assert info.misses > 0
+    assert info.currsize == info.misses
+
+    # The tables are re-used when only the disc parameters change
+    mdl.logmdot = 0.9
+    mdl(egrid)
+    assert mdl.shape_cache_info().hits > 0
+
+    mdl.cache_clear()
+    assert mdl.shape_cache_info().currsize == 0
+
+    with pytest.raises(ValueError):
+        mdl.set_resolution(nseed=-1)
+
+
+def test_agnslim_adaptive():
+    """Can the number of zones be chosen adaptively?"""
+
+    from xspeclmodels import XSagnslim
+
+    mdl = XSagnslim()
+    mdl._use_caching = False
+    assert mdl.get_zones() == (0, 0, 0)
+
+    egrid = np.arange(0.1, 10, 0.01)
+    mdl(egrid)
+    assert mdl.get_zones() == (100, 10, 1000)
+
+    mdl.set_resolution('fast', rtol=1e-3)
+    assert mdl.get_resolution().rtol == 1e-3
+    y1 = mdl(egrid)
+
+    # Each region is refined at least once
+    fast = mdl.resolution_modes['fast']
+    zones = mdl.get_zones()
+    assert zones.hot >= 2 * fast.ipow
+    assert zones.warm >= 2 * fast.icor
+    assert zones.outer >= 2 * fast.iout
+
+    # The result matches a calculation with those zones
+    mdl.set_resolution('fast', ipow=zones.hot, icor=zones.warm,
+                       iout=zones.outer)
+    y2 = mdl(egrid)
+    assert y2 == pytest.approx(y1, rel=1e-5)
+
+    # The zones are also reported for a cached spectrum
+    mdl.set_resolution('fast', rtol=1e-3)
+    assert (mdl(egrid) == y1).all()
+    assert mdl.get_zones() == zones
+
+    with pytest.raises(ValueError):
+        mdl.set_resolution(rtol=-1)
+
+
+def test_agnslim_cache_redshift_dist():
+    """Changing redshift or dist re-uses the cached spectrum."""
+
+    from xspeclmodels import XSagnslim
+
+    mdl = XSagnslim()
+    mdl._use_caching = False
+
+    egrid = np.arange(0.1, 10, 0.01)
+    y1 = mdl(egrid)
+
+    mdl.redshift = 0.5
+    y2 = mdl(egrid)
+    assert (y2 != y1).any()
+
+    mdl.dist = 200
+    y3 = mdl(egrid)
+    assert y3 == pytest.approx(y2 / 4, rel=1e-5)
+
+    info = mdl.cache_info()
+    assert info.hits == 2
+    assert info.misses == 1
+    assert info.currsize == 1
+
+    # Check against a full calculation
+    mdl2 = XSagnslim()
+    mdl2.redshift = 0.5
+    assert (mdl2(egrid) == y2).all()
+
+    mdl2.dist = 200
+    assert mdl2(egrid) == pytest.approx(y3, rel=1e-5)
+
+
+def test_agnslim_rebin_cache():
+    """Is the mapping onto the requested grid re-used?"""
+
+    from xspeclmodels import XSagnslim, agnslim_cache_clear, \
+        agnslim_rebin_cache_info
+
+    agnslim_cache_clear()
+    assert agnslim_rebin_cache_info().currsize == 0
+
+    mdl = XSagnslim()
+    mdl._use_caching = False
+
+    egrid = np.arange(0.1, 10, 0.01)
+    y1 = mdl(egrid)
+    info = agnslim_rebin_cache_info()
+    assert info.hits == 0
+    assert info.misses == 1
+
+    # The map is shared by the instances
+    mdl2 = XSagnslim()
+    mdl2._use_caching = False
+    assert (mdl2(egrid) == y1).all()
+    assert (mdl(egrid) == y1).all()
+    info = agnslim_rebin_cache_info()
+    assert info.hits == 2
+    assert info.misses == 1
+
+    # A different grid or redshift needs a new map
+    mdl(egrid[::2])
+    mdl.redshift = 0.5
+    mdl(egrid)
+    info = agnslim_rebin_cache_info()
+    assert info.misses == 3
+    assert info.currsize == 3
+
+    agnslim_cache_clear()
+    assert agnslim_rebin_cache_info().currsize == 0
+
+
+def test_agnslim_nan_parameter():
+    """Are the caches skipped when a parameter is NaN?"""
+
+    from xspeclmodels import XSagnslim
+
+    mdl = XSagnslim()
+    egrid = np.arange(0.1, 10, 0.01)
+    pars = [p.val for p in mdl.pars]
+    pars[2] = np.nan
+
+    for _ in range(2):
+        mdl._calc(pars, egrid[:-1], egrid[1:])
+
+    assert mdl.cache_info().currsize == 0
+    assert mdl.structure_cache_info().currsize == 0
+
+    pars[2] = mdl.logmdot.val
+    mdl._calc(pars, egrid[:-1], egrid[1:])
+    assert mdl.cache_info().currsize == 1
+
+
+def test_agnslim_threads():
+    """Does the OpenMP version match the serial version?"""
+
+    import xspeclmodels
+    from xspeclmodels import XSagnslim, _models
+
+    assert xspeclmodels.get_agnslim_threads() == 1
+
+    openmp, _ = _models.agnslim_threads()
+    if not openmp:
+        with pytest.raises(ValueError):
+            xspeclmodels.set_agnslim_threads(2)
+
+        return
+
+    egrid = np.arange(0.1, 10, 0.01)
+    y1 = XSagnslim()(egrid)
+
+    try:
+        xspeclmodels.set_agnslim_threads(2)
+        assert xspeclmodels.get_agnslim_threads() == 2
+        y2 = XSagnslim()(egrid)
+    finally:
+        xspeclmodels.set_agnslim_threads(1)
+
+    assert y2 == pytest.approx(y1, rel=1e-5)
+
+
+def test_profiling(tmp_path):
+    """Are the evaluations recorded when profiling is enabled?"""
+
+    import json
+    import xspeclmodels
+    from xspeclmodels import XSagnslim, XSzkerrbb
+
+    agn = XSagnslim('pagn')
+    kbb = XSzkerrbb('pkbb')
+    agn._use_caching = False
+    kbb._use_caching = False
+    egrid = np.arange(0.1, 10, 0.01)
+
+    xspeclmodels.clear_profile()
+    agn(egrid)
+    assert xspeclmodels.get_profile() == {}
+
+    try:
+        xspeclmodels.enable_profiling()
+        agn(egrid)
+        kbb(egrid)
+        kbb(egrid)
+        agn._calc([p.val for p in agn.pars], egrid, spectrumNumber=2)
+    finally:
+        xspeclmodels.disable_profiling()
+
+    kbb(egrid)
+
+    prof = xspeclmodels.get_profile()
+    assert set(prof) == {0, 1}
+    assert set(prof[0]) == {1, 2}
+
+    rec = prof[0][1]
+    assert rec['model'] == 'agnslim'
+    assert rec['name'] == 'pagn'
+    assert rec['calls'] == 1
+    assert rec['evaluations'] == 1
+    assert rec['cache_hits'] == 1
+    assert rec['cache_misses'] == 0
+    assert rec['nbins'] == {egrid.size: 1}
+    assert sum(rec['histogram']) == 1
+    assert rec['time'] > 0
+
+    assert prof[0][2]['cache_misses'] == 1
+
+    rec = prof[1][1]
+    assert rec['model'] == 'zkerrbb'
+    assert rec['name'] == 'pkbb'
+    assert rec['calls'] == 2
+    assert rec['cache_hits'] >= 1
+
+    outfile = tmp_path / 'profile.json'
+    xspeclmodels.save_profile(str(outfile))
+    saved = json.loads(outfile.read_text())
+    assert saved['1']['1']['calls'] == 2
+
+    # Instances with the same name are recorded separately.
+    xspeclmodels.clear_profile()
+    other = XSzkerrbb('pkbb')
+    try:
+        xspeclmodels.enable_profiling()
+        other(egrid)
+        kbb(egrid)
+        kbb(egrid)
+    finally:
+        xspeclmodels.disable_profiling()
+
+    prof = xspeclmodels.get_profile()
+    assert set(prof) == {0, 1}
+    assert prof[0][1]['name'] == 'pkbb'
+    assert prof[0][1]['calls'] == 1
+    assert prof[1][1]['name'] == 'pkbb'
+    assert prof[1][1]['calls'] == 2
+
+    xspeclmodels.clear_profile()
+    assert xspeclmodels.get_profile() == {}
+
+
+@pytest.mark.skipif(not support_convolve,
+                    reason='ciao-contrib module not installed')
+def test_profiling_thcompc_threads():
+    """Are the thcompc cache counts restricted to the call?"""
+
+    import threading
+    import xspeclmodels
+    from xspeclmodels import XSthcompc
+
+    mdl1 = XSthcompc('t1')
+    mdl2 = XSthcompc('t2')
+    egrid = np.arange(0.1, 10, 0.01)
+    flux = np.ones(egrid.size)
+
+    # Evaluations from another thread, which is left running while
+    # mdl1 is evaluated, do not count against mdl1.
+    start = threading.Event()
+    stop = threading.Event()
+
+    def other():
+        mdl2._calc([1.7, 20, 0], flux, egrid)
+        start.set()
+        while not stop.is_set():
+            mdl2._calc([1.7, 20, 0], flux, egrid)
+
+    xspeclmodels.thcompc_cache_clear()
+    xspeclmodels.clear_profile()
+    thread = threading.Thread(target=other)
+    try:
+        xspeclmodels.enable_profiling()
+        thread.start()
+        start.wait()
+        mdl1._calc([1.7, 50, 0], flux, egrid)
+        mdl1._calc([1.7, 50, 0], flux, egrid)
+    finally:
+        stop.set()
+        thread.join()
+        xspeclmodels.disable_profiling()
+
+    # The order of the instances depends on the threads.
+    recs = {recs[1]['name']: recs[1]
+            for recs in xspeclmodels.get_profile().values()}
+    assert set(recs) == {'t1', 't2'}
+
+    rec = recs['t1']
+    assert rec['calls'] == 2
+    assert rec['cache_hits'] == 1
+    assert rec['cache_misses'] == 1
+
+    rec = recs['t2']
+    assert rec['cache_misses'] == 1
+    assert rec['cache_hits'] == rec['calls'] - 1
+
+    xspeclmodels.clear_profile()
+
+
+def test_trace(tmp_path):
+    """Can the evaluations be recorded and replayed?"""
+
+    import xspeclmodels
+    from xspeclmodels import XSagnslim, XSzkerrbb
+    from xspeclmodels.trace import read_trace, replay
+
+    agn = XSagnslim('tagn')
+    kbb = XSzkerrbb('tkbb')
+    agn.set_resolution('fast')
+    egrid = np.arange(0.1, 10, 0.01)
+
+    outfile = str(tmp_path / 'test.trace')
+    assert xspeclmodels.stop_trace() == 0
+    xspeclmodels.start_trace(outfile)
+    try:
+        agn(egrid)
+        kbb(egrid[:-1], egrid[1:])
+        agn.logmdot = 0.5
+        agn(egrid)
+    finally:
+        assert xspeclmodels.stop_trace() == 3
+
+    # this is not recorded
+    kbb(egrid)
+
+    evals = list(read_trace(outfile))
+    assert [e.model for e in evals] == ['agnslim', 'zkerrbb', 'agnslim']
+    assert [e.name for e in evals] == ['tagn', 'tkbb', 'tagn']
+    assert evals[0].instance == evals[2].instance
+    assert evals[0].settings == tuple(agn.get_resolution())
+    assert evals[0].fingerprint == evals[2].fingerprint
+    assert evals[0].fingerprint != evals[1].fingerprint
+    assert evals[0].xhi is None
+    assert evals[1].xhi == pytest.approx(egrid[1:])
+    assert evals[0].pars[2] == pytest.approx(1)
+    assert evals[2].pars[2] == pytest.approx(0.5)
+    assert evals[1].cosmology is not None
+
+    results = replay(outfile)
+    assert len(results) == 3
+    assert [r.nbins for r in results] == [egrid.size, egrid.size - 1,
+                                          egrid.size]
+    assert all(r.replayed > 0 for r in results)
+
+
+def test_trace_instance_numbers(tmp_path):
+    """Does each instance get its own number when ids are re-used?"""
+
+    import gc
+
+    import xspeclmodels
+    from xspeclmodels import XSzkerrbb
+    from xspeclmodels.trace import read_trace
+
+    egrid = np.arange(0.1, 10, 0.01)
+
+    # Every other instance is deleted after being evaluated, so that
+    # its id is likely to be used by the next one.
+    outfile = str(tmp_path / 'test.trace')
+    xspeclmodels.start_trace(outfile)
+    kept = []
+    try:
+        for i in range(8):
+            mdl = XSzkerrbb('t{}'.format(i))
+            mdl(egrid)
+            if i % 2:
+                kept.append(mdl)
+
+            del mdl
+            gc.collect()
+
+    finally:
+        assert xspeclmodels.stop_trace() == 8
+
+    evals = list(read_trace(outfile))
+    assert [e.name for e in evals] == ['t{}'.format(i) for i in range(8)]
+    assert len(set(e.instance for e in evals)) == 8
+
+
+def test_preload():
+    """Can the models be preloaded?"""
+
+    import xspeclmodels
+    from xspeclmodels import XSagnslim
+
+    mdl = XSagnslim('pre')
+    misses = xspeclmodels.thcompc_cache_info().misses
+
+    xspeclmodels.preload()
+    assert xspeclmodels._xspec_initialized
+
+    # The models are not evaluated.
+    assert mdl.cache_info().misses == 0
+    assert xspeclmodels.thcompc_cache_info().misses == misses
+
+    xspeclmodels.preload(['zkerrbb'])
+
+
+def test_preload_invalid():
+    """An unknown model is an error"""
+
+    import xspeclmodels
+
+    with pytest.raises(ValueError):
+        xspeclmodels.preload(['agnslim', 'agnsed'])
@@ -1,123 +1,48 @@
-      Subroutine agnslim(ear,ne,param,ifl,photar,photer)
-
-      implicit none
-
-      integer NPAR
-      parameter(NPAR=14)
-
-      integer ne, ifl
-      real ear(0:ne), photar(ne), param(NPAR), photer(ne)
-
-!------------------------------------------------------------------------------------ 
-! This subroutine checks whether any of the parameters have changed, if they have, 
-! then it creates a new energy binning scheme with 5000 bins increasing exponentially
-! in size.  The input parameters and new binning scheme are used in a call to the 
-! subroutine 'asdiskf'.  The returned fluxes are then corrected for redshift and
-! shifted back into the original energy binning scheme.
-!------------------------------------------------------------------------------------ 
-
-!     ear = Energy array
-!     ne = size of energy array (1 more than flux array as gives boundaries)
-!     param = array containing model parameters
-!     ifl = spectrum number
-!     photar = output flux array (ne-1 parameters)
-
-      integer NN
-      parameter(NN=5000)
-
-      integer n,i
-      real e(0:NN),ph(NN)
-      real dloge,zfac,oldpar(NPAR),newemin,newemax
-      logical parchange, echange
-
-      REAL fstart(ne), fend(ne)
-      integer istart(ne), iend(ne)
-
-      save oldpar,ph,e
-
-c     param(1) mass in solar
-c     param(2) distance
-c     param(3) log mass accretion rate in L/LEdd
-c     param(4) spin parameter
-c     param(5) cosi 0.5 is isotripic
-c     param(6) Te of hot compton
-c     param(7) Te of warm compton
-c     param(8) gamma for hot compton
-c     param(9) gamma for warm compton   if -ve plot only warm comp
-c     param(10) R_hot
-c     param(11) R_warm
-c     param(12) log10 rout/rg
-c     param(13) rin
-c     param(14) redshift
-
-      DO i = 1, ne
-         photer(i) = 0.0
-      ENDDO
-
-      zfac = 1.0 + param(14)
-
-!     test whether any parameters have changed
-      parchange=.false.
-      do i=1,NPAR,1
-         if (param(i).ne.oldpar(i)) parchange=.true.
-      end do
-
-!     test whether own energy grid needs to be changed
-      if (ear(0).eq.0.0) then 
-         newemin=ear(1)-(ear(2)-ear(1))/10.0
-      else
-         newemin=min(1.0e-5,ear(0)*zfac)
-      end if
-      newemax=max(1.0e3,ear(ne)*zfac)
-
-      if ((e(0).ne.newemin).or.(e(NN).ne.newemax)) then
-         echange=.true.
-      end if
-
-!     if necessary recalculate the energy grid
-
-      if (echange) then
-
-         dloge=log10(newemax/newemin)/float(NN)
-         e(0) = newemin
-         do n=1,NN,1
-!           populate the new energy array and zero flux
-            e(n)=10**(log10(e(0))+dloge*float(n))
-         end do
-
-      endif
-         
-!     call the irradiated disc if parameters or energy grid have changed
-      if (parchange .or. echange) then 
-
-         call amydiskslim(e,NN,param,ifl,ph)
-
-!        now redshift the energy bins back
-         do n=0,NN,1
-            e(n)=e(n)/zfac
-         end do
-
-!        and now correct the flux for redshift
-         do n=1,NN,1
-            ph(n)=ph(n)/zfac
-         end do
-
-!        save the new parameters into the oldpar array
-         do i=1,NPAR,1
-            oldpar(i)=param(i)
-         end do
-
-      end if
-
-!     rebin the calculated fluxes back onto original energy grid
-      CALL inibin(NN, e, ne, ear, istart, iend, fstart, fend, 0)
-      CALL erebin(NN, ph, ne, istart, iend, fstart, fend, photar)
-     
-      return
-      end
-
-      subroutine amydiskslim(ear,ne,param,ifl,photar)
-
+!------------------------------------------------------------------------------------
+! The agnslim driver routine - which created the internal energy grid, called
+! amydiskslim, corrected for redshift, and rebinned the result onto the
+! requested grid - has been replaced by C_agnslim in
+! src/xspeclmodels/src/agnslim.cxx, which caches the calculated spectra.
+!
+! The calls to donthcomp and xwrite go through the wrappers in locked.f,
+! so that amydiskslim can be called from several threads.
+!
+! The original amydiskslim routine has been split into two stages:
+! amydiskstruct calculates the radial zones, and their temperatures,
+! which depend only on the mass, logmdot, astar, R_hot, R_warm, logrout,
+! and rin parameters; amydiskspec then sums up the blackbody and
+! Comptonised emission from these zones. This lets the caller re-use the
+! disc structure when only the other parameters change. The results are
+! the same as the original code.
+!
+! The number of radial zones, which used to be hard-coded, are given
+! by the nzone argument (imax, ipow, icor, iout), so that the caller
+! can choose the accuracy of the calculation.
+!
+! When compiled with OpenMP support the radial zones in amydiskspec are
+! shared between nthr threads, and the spectra from each zone summed.
+! The order of the summation then depends on the number of threads, so
+! the results differ from the serial version at the level of rounding
+! errors. The nthcomp calls are still serialized.
+!
+! The Comptonised spectrum of each hot and warm zone only depends on
+! the zone temperature (the photon index and electron temperature are
+! the same for all the zones of a region), so amydiskspec can be sent
+! the nthcomp spectra tabulated at seed temperatures 10**(k/nseed) keV,
+! and interpolates them (linearly in log temperature) rather than
+! calling nthcomp for each zone. The tables are optional (a size of 0
+! means call nthcomp for each zone, as the original code does); they
+! are calculated by the caller (agnslim.cxx).
+!------------------------------------------------------------------------------------
+
+      subroutine amydiskstruct(param,nzone,rz,drz,tz,nz,rlim)
+
+c     Calculate the radius (rz), width (drz), and temperature (tz, in
+c     keV) of each radial zone. The arrays must have space for
+c     nzone(2)+nzone(3)+nzone(4) elements, and nz is set to the number
+c     of zones actually used in the hot, warm, and outer regions (the
+c     hot and warm regions can be empty). rlim is set to the inner
+c     radius and the outer radius of the warm region.
 
 c     program to integrate the disk equations from shakura-sunyaev disk
 c     as given by Novikov and Thorne
@@ -132,53 +57,41 @@ c     as given by Novikov and Thorne
       double precision trepd
       double precision tslim,tnt ! add add add
       double precision rgcm,pi,t,r,dr,dlogr,dflux,tprev
-      double precision en,kkev,h,kevhz,d0,d,logrout
-      double precision dllth,dlhth,dldiskint !add add add
-      integer i,ipow,icor,iout,imax,n,ne,ifl
+      double precision kkev,logrout
+      integer i,ipow,icor,iout,imax,nzone(4),nz(3)
       logical first,firstdisk,firstdisk2,firstdisk3,firstpl
-      double precision flux(ne),displ
+      double precision displ
       double precision mdotedd,alpha,eff,grad
-      double precision cosi
-      double precision gammah,gammas,teh,tes
       double precision ledd
       double precision tedd,tsg !critical temperature[K] for soft compton
       double precision trepdedd !critical temperature[K] for soft compton
       double precision redd, fcrit,t4r2,t4r2prev!radius at which T>Tedd and radius at Tmax
       double precision tedd0
       double precision factor
+      double precision rz(*),drz(*),tz(*),rlim(2)
       character(255) comment
-      real ear(0:ne),photar(ne),param(*)
-      real lpar(5),lphot(ne),lphote(ne),hpar(5),hphot(ne),hphote(ne)
-      real lphotall(ne),hphotall(ne)  !add add add
+      real param(*)
+
 
-      imax=2000 !integrate Rin(or Rms) to Rsg
-      iout=1000 !integrage Rout to Rsg
-      icor=10
-      ipow=100
+c     the original values are 2000, 100, 10, and 1000
+      imax=nzone(1) !integrate Rin(or Rms) to Rsg
+      ipow=nzone(2)
+      icor=nzone(3)
+      iout=nzone(4) !integrage Rout to Rsg
 
 c     constants
-      h=6.62617d-27 ! [erg s]
       kkev=1.16048d7  ![K/keV]
-      kevhz=2.417965d17 ![Hz/keV]
       pi=4.0*atan(1.0)      
 
 c     system parameters
       m=dble(param(1))         !in solar units
-      d0=dble(param(2))     !in Mpc
-      cosi=dble(param(5))
       mdotedd=dble(10**(param(3)))      !in L/Ledd if -ve plot disc
       astar=dble(param(4))
       mdotstart=6.0d0
       alpha=0.1
       factor=2.39d0
-c     corona parameters
-      gammah=dble(abs(param(8)))
-      gammas=dble(abs(param(9)))
-      tes=dble(abs(param(7)))/511.0
-      teh=dble(abs(param(6)))/511.0
       rcor=dble(abs(param(11)))
 
-      d=d0*1d6*3.085677d18 !mod
       rgcm=1.477d5*m  ![cm]
       tedd=2.27651d5*(1.0d7/m)**0.25
       trepdedd=0.0d0
@@ -256,18 +169,6 @@ c------------aaaaa
       endif
 c---------
 
-c     initialise 
-      do n=1,ne,1
-         photar(n)=0.0
-         flux(n)=0.0
-c         photarint(n)=0.0
-c         photarseed(n)=0.0
-c         fluxint(n)=0.0
-c        fluxseed(n)=0.0
-         lphotall(n)=0.0 !add add add 
-         hphotall(n)=0.0 !add add add 
-      end do
-      
       first=.true.
       firstdisk=.true.
       firstdisk2=.true.
@@ -421,15 +322,148 @@ c------------------------
          t=t/kkev ! [keV] 
          trepd=trepd/kkev  ![keV]
 
+         rz(i)=r
+         drz(i)=dr
+         tz(i)=trepd
+      end do                    !end of r
+
+      nz(1)=ipow
+      nz(2)=icor
+      nz(3)=iout
+      rlim(1)=rin
+      rlim(2)=rcor
+
+c      write(comment,*) '------hot compton-----'
+c      CALL xwrite(comment, 20)
+c      WRITE(comment,*) 'Lhot/Ledd=',lumipl*4.0*pi*d*d/ledd
+c      CALL xwrite(comment, 20)
+      write(comment,'(3(a,1pg13.4))') 'rin=',rin, '( rin_calc=',rin0,')'
+      CALL lkxwrite(comment, 20)
+      WRITE(comment,'(3(a,1pg13.4))') 'r_hot=', rpow,
+     &  'r_warm=',rcor, 'r_edd=', redd
+      CALL lkxwrite(comment, 20)
+      WRITE(comment,'(3(a,1pg13.4))') 'Tcri(slim)=',
+     & tedd0*(rcor/redd)**(-0.5)
+      CALL lkxwrite(comment, 20)
+      write(comment, '(3(a,1pg13.4))') 'log_rout= ',logrout
+      CALL lkxwrite(comment, 20)
+      write(comment,'(3(a,1pg13.4))') 'tout=', tsg
+      CALL lkxwrite(comment, 20)
+      write(comment,*) '------system-----'
+      CALL lkxwrite(comment, 20)
+      write(comment,'(3(a,1pg9.3))') 'fcrit=',
+     & fcrit*4*3.14*5.67e-5*rgcm**2/ledd,
+     & '(critical flux is the Eddington flux)'
+      CALL lkxwrite(comment, 20)
+      write(comment,'(3(a,1pg13.4))') 'efficiency=', eff
+      CALL lkxwrite(comment, 20)
+      write(comment,'(3(a,1pg13.4))') 'r_H=', rh
+      CALL lkxwrite(comment, 20)
+
+      return
+      end
+
+
+      subroutine amydiskspec(ear,ne,param,ifl,photar,rz,drz,tz,nz,rlim,
+     &     nthr,nseed,htab,nhtab,hk0,ltab,nltab,lk0)
+
+c     Calculate the spectrum for the zones calculated by amydiskstruct,
+c     using nthr threads (if compiled with OpenMP support, otherwise it
+c     is ignored); a value of 0 means use the OpenMP default.
+c
+c     If nhtab is not 0 then htab contains the nthcomp spectra of the
+c     hot region for the seed temperatures 10**(k/nseed) keV, where
+c     k=hk0,...,hk0+nhtab-1, which are interpolated rather than calling
+c     nthcomp for each zone. The ltab, nltab, and lk0 arguments are the
+c     same for the warm region.
+
+      implicit none
+      double precision rin
+      double precision m
+      double precision rcor
+      double precision trepd
+      double precision rgcm,pi,r,dr,dflux
+      double precision en,kkev,h,kevhz,d0,d
+      double precision dllth,dlhth,dldiskint !add add add
+      integer i,ipow,icor,iout,n,ne,ifl,nz(3),nthr,nt
+      integer nseed,nhtab,hk0,nltab,lk0
+      real htab(ne,*),ltab(ne,*)
+      double precision flux(ne),ebin(ne),bbnorm(ne)
+      double precision cosi
+      double precision gammah,gammas
+      double precision rz(*),drz(*),tz(*),rlim(2)
+      real ear(0:ne),photar(ne),param(*)
+      real lpar(5),lphot(ne),lphote(ne),hpar(5),hphot(ne),hphote(ne)
+      real lphotall(ne),hphotall(ne)  !add add add
+!$    integer omp_get_max_threads
+!$    external omp_get_max_threads
+
+      ipow=nz(1)
+      icor=nz(2)
+      iout=nz(3)
+      rin=rlim(1)
+      rcor=rlim(2)
+
+c     constants
+      h=6.62617d-27 ! [erg s]
+      kkev=1.16048d7  ![K/keV]
+      kevhz=2.417965d17 ![Hz/keV]
+      pi=4.0*atan(1.0)      
+
+c     system parameters
+      m=dble(param(1))         !in solar units
+      d0=dble(param(2))     !in Mpc
+      cosi=dble(param(5))
+c     corona parameters
+      gammah=dble(abs(param(8)))
+      gammas=dble(abs(param(9)))
+
+      d=d0*1d6*3.085677d18 !mod
+      rgcm=1.477d5*m  ![cm]
+
+
+c     initialise 
+      do n=1,ne,1
+         photar(n)=0.0
+         flux(n)=0.0
+c         photarint(n)=0.0
+c         photarseed(n)=0.0
+c         fluxint(n)=0.0
+c        fluxseed(n)=0.0
+         lphotall(n)=0.0 !add add add 
+         hphotall(n)=0.0 !add add add 
+      end do
+      
+c     the midpoint of each bin, and the zone-independent part of the
+c     blackbody spectrum, do not need to be re-calculated for each zone
+      do n=1,ne,1
+         en=dble(log10(ear(n))+log10(ear(n-1)))
+         en=en/2.0
+         en=10**en
+         ebin(n)=en
+         bbnorm(n)=pi*2.0*h*((en*kevhz)**3)/8.98755d20
+      end do
+
+      nt=1
+!$    nt=nthr
+!$    if (nt.lt.1) nt=omp_get_max_threads()
+
+!$omp parallel do num_threads(nt) schedule(dynamic,4)
+!$omp& private(i,n,r,dr,trepd,en,dflux,dllth,dlhth,dldiskint,ifl)
+!$omp& private(lpar,lphot,lphote,hpar,hphot,hphote)
+!$omp& reduction(+:flux,lphotall,hphotall)
+      do i=1,ipow+icor+iout,1
+         r=rz(i)
+         dr=drz(i)
+         trepd=tz(i)
+
 c        go over each photon energy - midpoint of bin
          do n=1,ne,1
-            en=dble(log10(ear(n))+log10(ear(n-1)))
-            en=en/2.0
-            en=10**en
+            en=ebin(n)
 
 c           do blackbody spectrum  @r>rcor
             if ((en.lt.30.0*trepd).and.(r.gt.rcor).and.(r.gt.rin)) then
-               dflux=pi*2.0*h*((en*kevhz)**3)/8.98755d20
+               dflux=bbnorm(n)
                dflux=dflux*4.0*pi*r*dr*rgcm*rgcm
                dflux=dflux/(exp(en/(trepd))-1.0)
             else
@@ -460,7 +494,11 @@ c   ----- slithe ncomp for hard comp geometry =1
             hpar(5)=0.0
 
 c thcomp is called but scale may be wrong yet
-            call donthcomp(ear,ne,hpar,ifl,hphot,hphote)
+            if (nhtab.gt.0) then
+               call amyseedinterp(ne,htab,nhtab,hk0,nseed,trepd,hphot)
+            else
+               call lkdonthcomp(ear,ne,hpar,ifl,hphot,hphote)
+            end if
             do n=1,ne,1
             dlhth=dlhth+hphot(n)*ear(n)*kevhz*h !photons/s/cm2/Hz *Hz *keV
             end do
@@ -474,7 +512,12 @@ c thcomp is called but scale may be wrong yet
             lpar(5)=0.0
 c thcomp is called but scale may be wrong yet               
                ifl=1
-               call donthcomp(ear,ne,lpar,ifl,lphot,lphote)
+               if (nltab.gt.0) then
+                  call amyseedinterp(ne,ltab,nltab,lk0,nseed,trepd,
+     &                 lphot)
+               else
+                  call lkdonthcomp(ear,ne,lpar,ifl,lphot,lphote)
+               end if
                do n=1,ne,1
                   dllth=dllth+lphot(n)*ear(n)*kevhz*h !photons/s/cm2/Hz *Hz *keV
                end do
@@ -499,7 +542,7 @@ c  end ----- mod mod mod mod slice nthcomp
 c----------- end of slice pow
 
       end do                    !end of r
-
+!$omp end parallel do
 c==== powerlaw
 
 
@@ -513,38 +556,6 @@ c        now multiply by energy band in Hz
          photar(n) = sngl(flux(n)*kevhz) * (ear(n)-ear(n-1)) !kept 
       end do
 
-      displ=displ/(4.0*pi*d*d)!add add add
-      lumipl=lumipl/(4.0*pi*d*d)!add add add
-c     now add high temp compton emission
-
-c      write(comment,*) '------hot compton-----'
-c      CALL xwrite(comment, 20)
-c      WRITE(comment,*) 'Lhot/Ledd=',lumipl*4.0*pi*d*d/ledd
-c      CALL xwrite(comment, 20)
-      write(comment,'(3(a,1pg13.4))') 'rin=',rin, '( rin_calc=',rin0,')'
-      CALL xwrite(comment, 20)
-      WRITE(comment,'(3(a,1pg13.4))') 'r_hot=', rpow,
-     &  'r_warm=',rcor, 'r_edd=', redd
-      CALL xwrite(comment, 20)
-      WRITE(comment,'(3(a,1pg13.4))') 'Tcri(slim)=',
-     & tedd0*(rcor/redd)**(-0.5)
-      CALL xwrite(comment, 20)
-      write(comment, '(3(a,1pg13.4))') 'log_rout= ',logrout
-      CALL xwrite(comment, 20)
-      write(comment,'(3(a,1pg13.4))') 'tout=', tsg
-      CALL xwrite(comment, 20)
-      write(comment,*) '------system-----'
-      CALL xwrite(comment, 20)
-      write(comment,'(3(a,1pg9.3))') 'fcrit=',
-     & fcrit*4*3.14*5.67e-5*rgcm**2/ledd,
-     & '(critical flux is the Eddington flux)'
-      CALL xwrite(comment, 20)
-      write(comment,'(3(a,1pg13.4))') 'efficiency=', eff
-      CALL xwrite(comment, 20)
-      write(comment,'(3(a,1pg13.4))') 'r_H=', rh
-      CALL xwrite(comment, 20)
-
-
       do n=1,ne,1
          if ((param(6).lt.0.0).or.(param(7).lt.0.0).or.
      &          (param(9).lt.0.0)) then
@@ -564,3 +575,47 @@ c      CALL xwrite(comment, 20)
       return
       end
 
+
+      subroutine amyseedinterp(ne,tab,ntab,k0,nseed,t,phot)
+
+c     Interpolate, linearly in log temperature, the spectra tabulated
+c     at the seed temperatures 10**(k/nseed) keV, for k=k0,...,k0+ntab-1,
+c     to the temperature t (in keV). Temperatures outside the table use
+c     the nearest pair of nodes (the caller ensures the table covers
+c     the zones).
+
+      implicit none
+      integer ne,ntab,k0,nseed,n,j
+      real tab(ne,ntab),phot(ne)
+      double precision t,x,w
+
+      if (ntab.eq.1) then
+         do n=1,ne,1
+            phot(n)=tab(n,1)
+         end do
+         return
+      end if
+
+      x=dble(nseed)*log10(t)-dble(k0)
+      j=int(x)
+      j=max(0,min(ntab-2,j))
+      w=x-dble(j)
+      do n=1,ne,1
+         phot(n)=sngl((1.0d0-w)*tab(n,j+1)+w*tab(n,j+2))
+      end do
+
+      return
+      end
+
+
+      integer function amydiskomp()
+
+c     Returns 1 if the code was compiled with OpenMP support, 0 otherwise.
+
+      implicit none
+
+      amydiskomp=0
+!$    amydiskomp=1
+
+      return
+      end
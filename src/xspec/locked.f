@@ -0,0 +1,32 @@
+!------------------------------------------------------------------------------------
+! Wrappers for the XSPEC library routines that are called by the model
+! code but are not known to be reentrant (they may use SAVE variables,
+! or write to shared output streams). Each call is made while holding
+! the lock provided by src/xspeclmodels/src/locking.cxx, so that the
+! models can be evaluated from several threads.
+!------------------------------------------------------------------------------------
+
+      subroutine lkdonthcomp(ear,ne,param,ifl,photar,photer)
+
+      implicit none
+      integer ne,ifl
+      real ear(0:ne),param(*),photar(ne),photer(ne)
+
+      call xslmlock()
+      call donthcomp(ear,ne,param,ifl,photar,photer)
+      call xslmunlock()
+
+      end
+
+
+      subroutine lkxwrite(string,chat)
+
+      implicit none
+      character*(*) string
+      integer chat
+
+      call xslmlock()
+      call xwrite(string,chat)
+      call xslmunlock()
+
+      end
@@ -3,38 +3,59 @@
 !by James F. Steiner (see http://jfsteiner.com/simplcut/)
 
 subroutine thcompf(ear,ne,param,IFL,photar,photer) 
+  ! The model is evaluated in two steps: thcompfop calculates the
+  ! operator (the photon energy grid, escape probabilities, and the
+  ! factorized tridiagonal matrix of the Kompaneets equation), which
+  ! depends only on gamma_tau, kT_e, and the energy grid, and
+  ! thcompfsolve applies it to the seed spectrum. This lets the caller
+  ! re-use the operator when only the seed spectrum changes.
   IMPLICIT NONE
-  integer ifl,ne,i,j
+  integer ifl,ne
 
-  real ear(0:ne),param(3),photar(ne),photer(ne),kte,tau,gam_tau,z_red
-  double precision theta0,theta,alp,tauthin,tauthick,a,b,c,q,delta
-  real thpar(3),tmparrt(ne)
-  real psum,tsum
+  real ear(0:ne),param(3),photar(ne),photer(ne)
+  real x(0:ne),bet(ne),a(ne),c(ne),alp(ne),gam(ne),aa,escape
+  integer interp
+
+  call thcompfop(ear,ne,param,x,bet,a,c,alp,gam,aa,escape,interp)
+  call thcompfsolve(ear,ne,param,IFL,photar,photer,x,bet,a,c,alp,gam,aa,escape,interp)
+
+  RETURN
+END subroutine thcompf
 
-  ifl=0
-  photer(1)=0.0
+
+subroutine thcompfop(ear,ne,param,x,bet,a,c,alp,gam,aa,escape,interp)
+  ! Calculate the operator for the parameters (only the first two,
+  ! gamma_tau and kT_e, are used) and energy grid. The arrays
+  ! must have the same size as in thcompf, and interp is set to 1 if
+  ! the seed spectrum has to be interpolated onto the x grid.
+  IMPLICIT NONE
+  integer ne,interp
+
+  real ear(0:ne),param(3),kte,tau,gam_tau
+  real x(0:ne),bet(ne),a(ne),c(ne),alp(ne),gam(ne),aa,escape
+  real xear(0:ne)
+  double precision theta0,theta,dalp,tauthin,tauthick,da,db,dc,q,delta
 
   gam_tau=param(1)
   kte=param(2)
-  z_red=param(3)
 
   if(gam_tau.gt.0.0)then
      IF (gam_tau.eq.1.0) THEN
         gam_tau=1.001
      ENDIF
 
-     alp=gam_tau-1.
+     dalp=gam_tau-1.
      theta0=kte/511.
      theta=theta0*(1.+1.*theta0+3.*theta0**2.)
      tauthin=1.2/(1.+1.*theta0+5.*theta0**2.)
      tauthick=0.25/(1.+1.*theta0+3.*theta0**2.)
      
-     a=tauthick*theta!>0
-     b=tauthin*theta !>0
-     c=-1./((1.5+alp)**2.-2.25)!<0
-     delta=b**2.-4.*a*c
-     q=-0.5*(b+sqrt(delta)) !<0 from numerical recipes: q=-0.5*(b+sgn(b)*sqrt(delta))
-     tau=real(c/q) !>0 (square root, the second one, tau=q/a is <0)
+     da=tauthick*theta!>0
+     db=tauthin*theta !>0
+     dc=-1./((1.5+dalp)**2.-2.25)!<0
+     delta=db**2.-4.*da*dc
+     q=-0.5*(db+sqrt(delta)) !<0 from numerical recipes: q=-0.5*(b+sgn(b)*sqrt(delta))
+     tau=real(dc/q) !>0 (square root, the second one, tau=q/a is <0)
 
 !     write(*,*)"Gamma parametrization used. Tau=", tau
   else
@@ -42,9 +63,29 @@ subroutine thcompf(ear,ne,param,IFL,photar,photer)
 !     write(*,*)"Tau parametrization used"
   endif
 
-  thpar(1) = tau
-  thpar(2) = kte
-  thpar(3) = z_red
+  xear = ear/511.
+
+  call thcomptonop(kte/511.,tau,xear,x,ne,bet,a,c,alp,gam,aa,escape,interp)
+
+  RETURN
+END subroutine thcompfop
+
+
+subroutine thcompfsolve(ear,ne,param,IFL,photar,photer,x,bet,a,c,alp,gam,aa,escape,interp)
+  ! Apply the operator from thcompfop to the seed spectrum in photar
+  ! (only the third parameter, the redshift, is used).
+  IMPLICIT NONE
+  integer ifl,ne,i,j,interp
+
+  real ear(0:ne),param(3),photar(ne),photer(ne),z_red
+  real x(0:ne),bet(ne),a(ne),c(ne),alp(ne),gam(ne),aa,escape
+  real tmparrt(ne)
+  real psum,tsum
+
+  ifl=0
+  photer(1)=0.0
+
+  z_red=param(3)
 
   !     Initialize arrays
   !     NTHCOMP CALL
@@ -53,7 +94,7 @@ subroutine thcompf(ear,ne,param,IFL,photar,photer)
      tmparrt(i) = photar(i)/(ear(i)-ear(i-1)) ! initialize  TO PHOTON DENSITY!
   end do
 
-  call msrunthcomp(ear,ne,thpar,IFL,tmparrt)
+  call msrunthcomp(ear,ne,z_red,IFL,tmparrt,x,bet,a,c,alp,gam,aa,escape,interp)
 
   psum = 0.
   tsum = 0.
@@ -68,40 +109,212 @@ subroutine thcompf(ear,ne,param,IFL,photar,photer)
   photar = tmparrt/tsum*psum ! normalize the output
 
   RETURN
-END subroutine thcompf
+END subroutine thcompfsolve
+
+
+subroutine thcompfsolvem(ear,ne,nspec,param,photar,x,bet,a,c,alp,gam,aa,escape,interp)
+  ! As thcompfsolve, but for the nspec seed spectra in the columns of
+  ! photar, which share the operator from thcompfop. The steps of
+  ! thcompfsolve, msrunthcomp, thcomptonsolve, and mythermlcsolve are
+  ! made for all the spectra at once - in particular the tridiagonal
+  ! systems are solved together, with the inner loops running over the
+  ! spectra - and each spectrum gives the same result as a call to
+  ! thcompfsolve. The work arrays are allocated on the heap.
+  IMPLICIT NONE
+  integer ne,nspec,interp
+
+  real ear(0:ne),param(3),photar(ne,nspec)
+  real x(0:ne),bet(ne),a(ne),c(ne),alp(ne),gam(ne),aa,escape
+
+  integer i,j,jl,jj,k
+  real z_red,tau,normfac
+  real, allocatable :: xear(:),seed(:,:),dphdot(:,:),d(:,:),g(:,:),u(:,:)
+  real, allocatable :: dphesc(:,:),sptot(:,:),xprim(:,:),spec(:,:)
+  real, allocatable :: fnorm(:),psum(:),tsum(:)
+
+  allocate(xear(0:ne),seed(nspec,ne),dphdot(nspec,ne),d(nspec,ne))
+  allocate(g(nspec,ne),u(nspec,ne),dphesc(nspec,ne),sptot(nspec,0:ne))
+  allocate(xprim(nspec,0:ne),spec(nspec,ne),fnorm(nspec),psum(nspec))
+  allocate(tsum(nspec))
+
+  z_red=param(3)
+  tau=1.
+  normfac=1.0
+
+  xear = ear/511.
+
+  !     the seed photon density (thcompfsolve)
+  do i=1,ne
+     do k=1,nspec
+        seed(k,i) = photar(i,k)/(ear(i)-ear(i-1))
+     end do
+  end do
+
+  !     interpolate onto the x grid (thcomptonsolve)
+  if (interp .eq. 0) then
+     dphdot = seed
+  else
+     j=1
+     do i=1,ne
+        do while (j .le. (ne-1) .and. xear(j) .lt. x(i))
+           j=j+1
+        end do
+        if (j .lt. ne) then
+           if (j .gt. 1) then
+              jl = j-1
+              do k=1,nspec
+                 dphdot(k,i) = seed(k,jl)+(x(i)-xear(jl))*(seed(k,jl+1)-seed(k,jl))/(xear(jl+1)-xear(jl))
+              end do
+           else
+              dphdot(:,i)=seed(:,1)
+           endif
+        else
+           dphdot(:,i)=seed(:,j)
+        endif
+     end do
+  endif
+
+  dphdot(:,ne)=seed(:,ne)
+
+  !     solve the tridiagonal systems (mythermlcsolve)
+  do j=2,ne-1
+     do k=1,nspec
+        d(k,j)=x(j)*dphdot(k,j)
+     end do
+  end do
+
+  u(:,ne)=0
+  do k=1,nspec
+     g(k,2)=d(k,2)/alp(2)
+  end do
+  do j=3,ne-2
+     do k=1,nspec
+        g(k,j)=(d(k,j)-c(j)*g(k,j-1))/alp(j)
+     end do
+  end do
+  do k=1,nspec
+     g(k,ne-1)=(d(k,ne-1)-a(ne-1)*u(k,ne)-c(ne-1)*g(k,ne-2))/alp(ne-1)
+     u(k,ne-1)=g(k,ne-1)
+  end do
+  do j=3,ne-1
+     jj=ne+1-j
+     do k=1,nspec
+        u(k,jj)=g(k,jj)-gam(jj)*u(k,jj+1)
+     end do
+  end do
+  do k=1,nspec
+     u(k,1)=aa*u(k,2)
+  end do
+
+  do j=1,ne-1
+     do k=1,nspec
+        dphesc(k,j)=x(j)*x(j)*u(k,j)*bet(j)*tau
+     end do
+  end do
+
+  !     add the unscattered fraction and normalize (thcomptonsolve)
+  sptot(:,0)=0.
+  sptot(:,ne)=0.
+  do j=1,ne-1
+     do k=1,nspec
+        dphesc(k,j)=dphesc(k,j)+escape*dphdot(k,j)
+        sptot(k,j)=dphesc(k,j)*x(j)**2
+     end do
+  end do
+
+  fnorm = 0
+  do j=1,ne-1
+     do k=1,nspec
+        fnorm(k) = fnorm(k) + sptot(k,j)/x(j)
+     end do
+  end do
+  do k=1,nspec
+     fnorm(k)=fnorm(k)*log(x(2)/x(1))
+  end do
+  do j=1,ne-1
+     do k=1,nspec
+        sptot(k,j) = sptot(k,j)/fnorm(k)
+     end do
+  end do
 
+  !     back onto the energy grid, with the redshift (msrunthcomp)
+  xprim = 0
+  if ((interp.eq.1).or.(z_red.gt.0.0)) then
+     j = 1
+     do i=0,ne
+        do while ((j .lt. ne).and.511.*x(j) .lt. ear(i)*(1+z_red))
+           j = j + 1
+        end do
+        if (j .lt. ne) then
+           if (j .gt. 1) then
+              jl = j - 1
+              do k=1,nspec
+                 xprim(k,i) = sptot(k,jl)+(ear(i)/511.*(1+z_red)-x(jl))*(sptot(k,jl+1)-sptot(k,jl))/(x(jl+1)-x(jl))
+              end do
+           else
+              xprim(:,i)=sptot(:,1)
+           endif
+        else
+           xprim(:,i)=sptot(:,j)
+        endif
+     end do
+  else
+     xprim=sptot
+  endif
 
-SUBROUTINE msrunthcomp(Ear,Ne,Param,Ifl,Spec)
+  xprim(:,ne) = sptot(:,ne)
+
+  do i=1,ne
+     do k=1,nspec
+        spec(k,i) = 0.5*(xprim(k,i)/ear(i)**2+xprim(k,i-1)/ear(i-1)**2)*(ear(i)-ear(i-1))*normfac
+     end do
+  end do
+
+  !     normalize the output (thcompfsolve)
+  psum = 0.
+  tsum = 0.
+  do j=1,ne
+     do k=1,nspec
+        psum(k) = psum(k)+photar(j,k)
+        tsum(k) = tsum(k)+spec(k,j)
+     end do
+  end do
+
+  do k=1,nspec
+     do j=1,ne
+        photar(j,k) = spec(k,j)/tsum(k)*psum(k)
+     end do
+  end do
+
+  deallocate(xear,seed,dphdot,d,g,u,dphesc,sptot,xprim,spec,fnorm,psum,tsum)
+
+  RETURN
+END subroutine thcompfsolvem
+
+
+SUBROUTINE msrunthcomp(Ear,Ne,z_red,Ifl,Spec,xth,bet,a,c,alp,gam,aa,escape,interp)
   !     driver for the Comptonization code solving Kompaneets equation
   !     seed photons - arbitrary XSPEC model
 
-  !     number of model parameters: 3
-  !     1: Thomson optical depth
-  !     2: plasma temperature in keV
-  !     3: redshift
+  !     the operator (calculated by thcompfop for the Thomson optical
+  !     depth and plasma temperature) is sent in, along with the
+  !     redshift
   
   implicit none
-  INTEGER Ne,Ifl
-  REAL Param(*),Ear(0:Ne),Spec(Ne),seedspec(Ne),xear(Ne)
+  INTEGER Ne,Ifl,interp
+  REAL Ear(0:Ne),Spec(Ne),seedspec(Ne),xear(0:Ne)
+  REAL bet(Ne),a(Ne),c(Ne),alp(Ne),gam(Ne),aa,escape
 
-  INTEGER np,i,j,jl
-  REAL xn , normfac , z_red
+  INTEGER i,j,jl
+  REAL normfac , z_red
   REAL xth(0:Ne) , spt(0:Ne), xprim(0:Ne)
 
-  LOGICAL IFLAG
-
   Ifl=0
   seedspec = spec
 
-  z_red = param(3)
-!  z_red = 0. ! previously param(4) in non-convolving thcomp
-
-  np = 3
   xear = ear/511.
 
-  call thcompton_fun(seedspec,param(2)/511.,param(1),xear,xth,Ne,spt,IFLAG)
-
-  xn = (1+z_red)/511.            
+  call thcomptonsolve(seedspec,xear,xth,Ne,bet,a,c,alp,gam,aa,escape,interp,spt)
 
   normfac=1.0
 
@@ -116,7 +329,7 @@ SUBROUTINE msrunthcomp(Ear,Ne,Param,Ifl,Spec)
 
   !     put primary into final array only if scale >= 0.
 
-  if (IFLAG.or.(z_red.gt.0.0)) then
+  if ((interp.eq.1).or.(z_red.gt.0.0)) then
      j = 1
      do i=0,ne
         do while ((j .lt. ne).and.511.*xth(j) .lt. ear(i)*(1+z_red))
@@ -147,37 +360,36 @@ SUBROUTINE msrunthcomp(Ear,Ne,Param,Ifl,Spec)
 END SUBROUTINE msrunthcomp
 
 
-subroutine thcompton_fun(specin,theta0,tau,xin,x,nen,sptot,IFLAG) 
+subroutine thcomptonop(theta0,tau,xin,x,nen,bet,a,c,alp,gam,aa,escape,interp) 
   !     version: January 96
   !     
   !     Thermal Comptonization; solves Kompaneets eq. with some
   !     relativistic corrections. See Lightman & Zdziarski (1987), ApJ
   !     The seed spectrum is blackbody.
+  !
+  !     This calculates the parts of the solution that do not depend on
+  !     the seed spectrum (see thcomptonsolve).
   IMPLICIT NONE
-  integer nen
+  integer nen,interp
   real delta,xmin,xmax,deltal,xnr,xr,taukn,arg,flz,pi
-  real sptot(0:nen),x(0:nen),xin(0:nen),dphesc(nen),dphdot(nen)
-  real rel(nen),bet(nen),c0(nen),c1(nen),c2(nen),specin(nen)
-  integer i,j,jl,jnr,jrel
+  real x(0:nen),xin(0:nen)
+  real rel(nen),bet(nen),c0(nen),c1(nen),c2(nen)
+  real a(nen),c(nen),alp(nen),gam(nen),aa,escape
+  integer i,j,jnr,jrel
   real(kind=8)::w,w1,z1,z2,z3,z4,z5,z6
-  real tau,alpha,theta0,tauthin,tauthick,escape
+  real tau,theta0,tauthin,tauthick
   !     input parameters:
   real theta
-  real fnorm,dif1
-  logical IFLAG
+  real dif1
 
   pi=3.1415927 
   !     clear arrays (important for repeated calls)
-  sptot(0)=0.
   do j=1,nen
-     dphesc(j)=0.
-     dphdot(j)=0.
      rel(j)=0.
      bet(j)=0.
      c0(j)=0.
      c1(j)=0.
      c2(j)=0.
-     sptot(j)=0.
   enddo
 
   !     a phenomenological relativistic correction to the temperature
@@ -232,33 +444,11 @@ subroutine thcompton_fun(specin,theta0,tau,xin,x,nen,sptot,IFLAG)
      dif1 = dif1+abs(xin(i)-x(i))
   enddo
 
-  IFLAG = .TRUE.            ! INTERP NEEDED IF TRUE                                 
+  interp = 1                ! INTERP NEEDED IF 1
   if (dif1 .lt. 1e-3) then
-     dphdot = specin
-     IFLAG = .FALSE.        ! SAME GRID so NO INTERP                                     
-  else                      ! interpolate to get a new array                        
-     j=1
-     do i=1,nen
-        do while (j .le. (nen-1) .and. xin(j) .lt. x(i))
-           j=j+1
-        end do
-        if (j .lt. nen) then
-           if (j .gt. 1) then
-              jl = j-1
-              dphdot(i) = specin(jl)+(x(i)-xin(jl))*(specin(jl+1)-specin(jl))/(xin(jl+1)-xin(jl))
-           else
-              dphdot(i)=specin(1)
-           endif
-        else
-           dphdot(i)=specin(j)
-        endif
-     end do
+     interp = 0             ! SAME GRID so NO INTERP
   endif
 
-  dphdot(nen)=specin(nen)
-  !CCCCCCCCCCCCCCCCCCCCCCCCCCCC
-  !CCCCCCCCCCCCCCCCCCCCCCCCCccc
-
   !     
   !     compute beta array, the probalility of escape per Thomson time.
   !     bet evaluated for spherical geometry and nearly uniform sources.
@@ -298,7 +488,7 @@ subroutine thcompton_fun(specin,theta0,tau,xin,x,nen,sptot,IFLAG)
   !     Note that tau in thermlc affects only the overall norm, and it is 
   !     actually not needed at all.
 
-  call mythermlc(1.,theta,deltal,x,nen,dphesc,dphdot,bet,c0,c1,c2)
+  call mythermlcop(1.,theta,deltal,x,nen,bet,c0,c1,c2,a,c,alp,gam,aa)
   !     the unscattered fraction in a uniform sphere with uniform 
   !     production of photons 
   escape=(2*tau**2 - 1 + exp(-2*tau)*(2*tau+1))*3/(8*tau**3) 
@@ -306,9 +496,53 @@ subroutine thcompton_fun(specin,theta0,tau,xin,x,nen,sptot,IFLAG)
   escape=Sqrt(escape*Exp(-tau))
  ! write(*,*) 'escaped fraction=',escape
 
-  !  alpha=sqrt(2.25+bet(1)/theta)-1.5
-  alpha=sqrt(2.25+1/(theta*(tau*tauthin+(tau**2.)*tauthick)))-1.5 !to get agreement between alpha computed from rel(1)=1
-!  write(*,*) 'alpha = ',alpha
+  return  
+end subroutine thcomptonop
+
+
+subroutine thcomptonsolve(specin,xin,x,nen,bet,a,c,alp,gam,aa,escape,interp,sptot) 
+  !     Apply the operator calculated by thcomptonop to the seed
+  !     spectrum (specin, on the xin grid).
+  IMPLICIT NONE
+  integer nen,interp
+  real sptot(0:nen),x(0:nen),xin(0:nen),dphesc(nen),dphdot(nen)
+  real bet(nen),specin(nen)
+  real a(nen),c(nen),alp(nen),gam(nen),aa,escape
+  integer i,j,jl
+  real fnorm
+
+  !     clear arrays (important for repeated calls)
+  sptot(0)=0.
+  do j=1,nen
+     dphesc(j)=0.
+     dphdot(j)=0.
+     sptot(j)=0.
+  enddo
+
+  if (interp .eq. 0) then
+     dphdot = specin
+  else                      ! interpolate to get a new array                        
+     j=1
+     do i=1,nen
+        do while (j .le. (nen-1) .and. xin(j) .lt. x(i))
+           j=j+1
+        end do
+        if (j .lt. nen) then
+           if (j .gt. 1) then
+              jl = j-1
+              dphdot(i) = specin(jl)+(x(i)-xin(jl))*(specin(jl+1)-specin(jl))/(xin(jl+1)-xin(jl))
+           else
+              dphdot(i)=specin(1)
+           endif
+        else
+           dphdot(i)=specin(j)
+        endif
+     end do
+  endif
+
+  dphdot(nen)=specin(nen)
+
+  call mythermlcsolve(1.,x,nen,dphesc,dphdot,bet,a,c,alp,gam,aa)
 
   !     the spectrum in E F_E
   do j=1,nen-1
@@ -328,31 +562,33 @@ subroutine thcompton_fun(specin,theta0,tau,xin,x,nen,sptot,IFLAG)
   enddo
 
   return  
-end subroutine thcompton_fun
+end subroutine thcomptonsolve
 
 
-subroutine mythermlc(tau,theta,deltal,x,nen,dphesc,dphdot,bet,c0,c1,c2)
+subroutine mythermlcop(tau,theta,deltal,x,nen,bet,c0,c1,c2,a,c,alp,gam,aa)
   !     This program computes the effects of Comptonization by
   !     nonrelativistic thermal electrons in a sphere including escape, and
   !     relativistic corrections up to photon energies of 1 MeV.
   !     the dimensionless photon energy is x=hv/(m*c*c)
   !     
   !     The input parameters and functions are:
-  !     dphdot(x), the photon production rate 
   !     tau, the Thomson scattering depth
   !     theta, the temperature in units of m*c*c
   !     c2(x), and bet(x), the coefficients in the K-equation and the
   !     probability of photon escape per Thomson time, respectively,
   !     including Klein-Nishina corrections
-  !     The output parameters and functions are:
-  !     dphesc(x), the escaping photon density
+  !     The output parameters and functions are the coefficients of
+  !     the tridiagonal matrix, factorized for mythermlcsolve:
+  !     a(x) and c(x), the off-diagonal elements;
+  !     alp(x) and gam(x), from the decomposition;
+  !     aa, the lower boundary condition.
   implicit none 
   integer nen
   real tau,theta,deltal
-  real x(0:nen),dphesc(nen),dphdot(nen),bet(nen),c0(nen),c1(nen)
-  integer j,jj
+  real x(0:nen),bet(nen),c0(nen),c1(nen)
+  integer j
   real a(nen),b(nen),c(nen),c20,w1,w2,t1,t2,t3,x32,aa,c2(nen) 
-  real d(nen),alp(nen),g(nen),gam(nen),u(nen)
+  real alp(nen),gam(nen)
 
   !     u(x) is the dimensionless photon occupation number
   c20=tau/deltal
@@ -371,7 +607,6 @@ subroutine mythermlc(tau,theta,deltal,x,nen,dphesc,dphdot,bet,c0,c1,c2)
      t3=x(j)**3*(tau*bet(j))
      b(j)=t1+t2+t3
      c(j)=c20*c0(j-1)*(0.5*c2(j-1)-c1(j-1)/deltal/w2)
-     d(j)=x(j)*dphdot(j)
   enddo
 
   !     define constants going into boundary terms
@@ -380,9 +615,6 @@ subroutine mythermlc(tau,theta,deltal,x,nen,dphesc,dphdot,bet,c0,c1,c2)
   x32=sqrt(x(1)*x(2))
   aa=(theta/deltal/x32+0.5)/(theta/deltal/x32-0.5)
   !     
-  !     zero flux at the highest energy
-  u(nen)=0
-  !     
   !     invert tridiagonal matrix
   alp(2)=b(2)+c(2)*aa
   gam(2)=a(2)/alp(2)
@@ -390,6 +622,30 @@ subroutine mythermlc(tau,theta,deltal,x,nen,dphesc,dphdot,bet,c0,c1,c2)
      alp(j)=b(j)-c(j)*gam(j-1)
      gam(j)=a(j)/alp(j)
   enddo
+
+  return
+end subroutine mythermlcop
+
+
+subroutine mythermlcsolve(tau,x,nen,dphesc,dphdot,bet,a,c,alp,gam,aa)
+  !     Solve for the escaping photon density, dphesc(x), given the
+  !     photon production rate, dphdot(x), using the matrix from
+  !     mythermlcop.
+  implicit none 
+  integer nen
+  real tau
+  real x(0:nen),dphesc(nen),dphdot(nen),bet(nen)
+  integer j,jj
+  real a(nen),c(nen),aa
+  real d(nen),alp(nen),g(nen),gam(nen),u(nen)
+
+  do j=2,nen-1
+     d(j)=x(j)*dphdot(j)
+  enddo
+
+  !     zero flux at the highest energy
+  u(nen)=0
+  !     
   g(2)=d(2)/alp(2)
   do j=3,nen-2
      g(j)=(d(j)-c(j)*g(j-1))/alp(j)
@@ -409,5 +665,4 @@ subroutine mythermlc(tau,theta,deltal,x,nen,dphesc,dphdot,bet,c0,c1,c2)
   enddo
 
   return
-end subroutine mythermlc
-
+end subroutine mythermlcsolve
@@ -1,65 +1,644 @@
 #include <xsTypes.h>
-#include <stlToCArrays.h>
-#include <functionMap.h>
 #include <XSFunctions/Utilities/FunctionUtility.h>
 #include <XSUtil/Numerics/Numerics.h>
+#include <algorithm>
+#include <cmath>
 #include <memory>
+#include <mutex>
+#include <vector>
 
-extern "C" void zrunkbb_(float* ear, int& nE, float& eta, float& astar, 
-		float& theta, float& mbh, float& mdd, float& dbh, 
-		float& fcol, int& rflag, int& lflag, float& zbh, 
-                float* photar, float* fluxE, int* nex1, int* nex2);
+#include "kerrbbtable.hh"
+#include "locking.hh"
+#include "zkerrbb.hh"
 
+// The calculation used to be done by ZRUNKBB in zrunkbb.f, which
+// was described as:
+//
+//   Written by: Li-Xin Li
+//            Harvard-Smithsonian Center for Astrophysics
+//            60 Garden St., Cambridge, MA 02138
+//
+//   Version:         October, 2004
+//
+//   Reference:  Li, Zimmerman, Narayan, & McClintock 2004, astro-ph/0411583
+//
+//   The program computes the black-body emission spectrum from a thin
+//   Keplerian accretion disk around a Kerr black hole. All relativistic
+//   effects are taken into account, including frame-dragging, Doppler boost,
+//   gravitational redshift, and bending of light by the gravity of the black
+//   hole. In particular, self-irradiation of the disk as a result of light
+//   deflection is included. The inner boundary of the disk is fixed at the
+//   marginally stable orbit. Torque at the inner boundary of the disk
+//   is allowed to be nonzero. However, when this program is applied to data
+//   reduction, a zero torque (eta = 0) is recommended since we have found
+//   that the effect of a nonzero torque on the spectrum can, to a good
+//   approximation, be absorbed into a zero torque model by adjusting the
+//   mass accretion rate and the normalization.
+//
+//   The program uses the precalculated data file kerrbb.fits - read
+//   by KBBREAD and sent in as the GI, AI, THETAI, E, and FLUX0
+//   arrays - to fit spectral data by linear interpolation. The first
+//   extension (GRIDVALS) contains 4 rows specifying:
+//   - a grid of black hole spin (a/M);
+//   - a grid of disk inclination angles (in degrees);
+//   - a grid of the torque at the inner boundary of the disk (eta, dimensionless);
+//   - a grid of spectrum energy (in keV)
+//   The second extension (FLUX) contains the flux density at each grid
+//   point specified by the above four parameters, in photons/keV/cm^2/sec.
+//   [There are four columns in this file: FLUX1, when both self-irradiation
+//   and limb-darkening are turned off; FLUX2, when self-irradiation is off
+//   but limb-darkening is on; FLUX3, when self-irradiation is on but
+//   limb-darkening is off; FLUX4, when both self-irradiation and
+//   limb-darkening are on.]
+//
+//   The program requires the following input arguments
+//   - "EAR(0:NE)": array of observed energy (frequency) bins (in units of
+//      keV);
+//   - "NE": number of observed energy bins (size of the energy array);
+//   - "eta" : ratio of the disk power produced by a
+//       torque at the disk inner boundary to the disk power arising
+//       from accretion. It must be >= 0 and <=1. When eta = 0, the
+//       solution corresponds to that of a standard Keplerian disk with
+//       zero torque at the inner boundary;
+//   - "astar" : specific angular momentum of the black hole in
+//      units of the black hole mass M (geometrized units G=c=1). a
+//       should be >= -1 and < 1;
+//   - "theta" : disk's inclination angle (the angle between the
+//      axis of the disk and the line of sight). It is expressed in
+//       degrees. i=0 is for a "face-on" accretion disk. i should be <=
+//       85 degree;
+//   - "Mbh" : the mass of the black hole in units of the solar mass;
+//   - "Mdd" : the "effective" mass accretion rate of the disk
+//      in units of 10^18 g/sec. When eta = 0 (zero torque at the inner
+//      boundary), this is just the mass accretion rate of the disk. When
+//       eta is nonzero, the effective mass accretion rate = (1+eta) times
+//       the true mass accretion rate of the disk. The total disk
+//       luminosity is then "epsilon" times "the effective mass accretion
+//       rate" times "c^2", where epsilon is the radiation efficiency of a
+//       standard accretion disk around the Kerr black hole;
+//   - "Dbh" : the distance from the observer to the black
+//       hole in units of kpc;
+//   - "fcol" : spectral hardening factor, T_col/T_eff. It should
+//       be greater than 1.0, and considered to be 1.5-1.9 for accretion
+//       disks around a stellar-mass black hole. See, e.g., Shimura and
+//       Takahara 1995, ApJ, 445, 780;
+//   - "ZBH": the redshift of the source. This is only used to modify the
+//       variable ca (change by Jack Steiner). The redshift will presumably
+//       be appropriate for the distance DBH input
+//
+//
+//   The program outputs an array of the observed photon flux in each bin
+//   of energy: "PHOTAR(NE)", in units of photons/cm^2/second. For
+//   example, PHOTAR(i) gives the observed photon number flux with
+//   observed photon energy between EAR(i) and EAR(i+1).
+//
+// The code has been converted to C++, so that it can be evaluated in
+// single precision - where the results match ZRUNKBB to within
+// rounding - or double precision, and so that it does not need
+// temporary arrays: the Fortran stored the flux at both edges of each
+// bin, but the value at the upper edge of one bin is the same as at
+// the lower edge of the next, so it is only calculated once.
+//
+// ZRUNKBB was converted, rather than wrapped, because:
+//
+//   - a double-precision option needs the calculation to be done in
+//     either precision, and ZRUNKBB declared everything as REAL, so
+//     the alternative was a second, hand-edited, copy of the routine;
+//   - ZRUNKBB kept the table, and the flags used to select the
+//     column, in SAVE variables, so it could not be called from
+//     several threads;
+//   - writing into the caller's buffer, without per-bin work arrays,
+//     changed the loop over the bins, which was most of the routine.
+//
+// The conversion follows the zrunkbb.f this package was distributed
+// with (which includes the redshift change by Jack Steiner, and is in
+// the git history of the package). Any change made upstream to the
+// calculation has to be applied here by hand. Before
+// the changes to the bin integration described below, the
+// single-precision results matched ZRUNKBB bit for bit.
+//
+// The log-log slopes of the interpolated spectrum, and its integral
+// over the table, are calculated once for each interpolated spectrum
+// (see KerrbbSpectrum), so each bin needs a single log10 call for
+// each edge, and its integral is found from the difference of two
+// cumulative sums rather than by summing over the table points it
+// covers. This changes the single-precision results by a relative
+// amount of about 1e-5 for narrow bins, which is less than the
+// difference from the double-precision calculation.
+//
+
+// Return the index of the element of arr (which must be in ascending
+// order) that is closest to x, picking the first when several are
+// equally close (as KBBNEAR did). The array can be anything that
+// supports operator[] (see KerrbbEnergy).
+//
+template <typename Real, typename Array>
+static int kerrbb_nearest(Real x, const Array& arr, int n) {
+
+  if ( x != x )
+    return 0;
+
+  // The first element that is not less than x (as std::lower_bound).
+  int lo = 0;
+  int count = n;
+  while ( count > 0 ) {
+    int step = count / 2;
+    if ( arr[lo + step] < x ) {
+      lo += step + 1;
+      count -= step + 1;
+    } else {
+      count = step;
+    }
+  }
+
+  int idx;
+  Real dif;
+  if ( lo == n ) {
+    idx = n - 1;
+    dif = std::abs(x - arr[idx]);
+  } else {
+    idx = lo;
+    dif = std::abs(x - arr[lo]);
+    if ( lo > 0 ) {
+      Real diflo = std::abs(x - arr[lo - 1]);
+      if ( diflo <= dif ) {
+	idx = lo - 1;
+	dif = diflo;
+      }
+    }
+  }
+
+  // Rounding means that earlier elements can be just as close.
+  while ( (idx > 0) && (std::abs(x - arr[idx - 1]) == dif) )
+    idx--;
+
+  return idx;
+}
+
+// The interpolation weights along one axis of the table: x lies
+// between elements i1 and i2 = i1 + 1, with weight t for i2.
+//
+template <typename Real>
+static void kerrbb_weights(Real x, const float* grid, int n,
+			   int& i1, int& i2, Real& t) {
+
+  Real arr[KERRBB_NS];
+  for (int i = 0; i < n; i++) {
+    arr[i] = grid[i];
+  }
+
+  int i0 = kerrbb_nearest(x, arr, n);
+  Real dx = x - arr[i0];
+  int ib = i0 + int( std::copysign(Real(1), dx) );
+
+  i1 = std::min(i0, ib);
+  i2 = std::max(i0, ib);
+
+  // Trap special case of values being at top of ranges
+  if ( i2 > n - 1 ) {
+    i2 = n - 1;
+    i1 = i2 - 1;
+  }
+
+  t = (x - arr[i1]) / (arr[i2] - arr[i1]);
+}
+
+// The interpolated table spectrum - that is, the flux density at
+// each energy of the table before it is scaled by the mass, accretion
+// rate, distance, and fcol - which depends only on eta, astar, theta,
+// and the table (so rflag and lflag).
+//
+// The scaling does not change the slope of the spectrum in log-log
+// space, or the shape of its integral, so these are also calculated
+// here, rather than for each bin: lslope is the slope between each
+// pair of table points, loge is the log of the table energies, and
+// the integral of the spectrum (using the trapezoid rule) from the
+// first table point to point k is cumlo[k], and from point k to the
+// last point is cumhi[k]. The sums are done in double precision.
+//
+template <typename Real>
+struct KerrbbSpectrum {
+  double eta;
+  double astar;
+  double theta;
+  std::shared_ptr<const KerrbbTable> table;
+  Real flux[KERRBB_NENER];
+  Real lslope[KERRBB_NENER - 1];
+  Real loge[KERRBB_NENER];
+  double cumlo[KERRBB_NENER];
+  double cumhi[KERRBB_NENER];
+
+  // The integral of the unscaled spectrum from table point n1 to n2
+  // (n1 <= n2). The difference is taken using whichever sum is
+  // smaller, to limit the loss of precision in the tails of the
+  // spectrum.
+  double integral(int n1, int n2) const {
+    if ( cumlo[n2] <= cumhi[n1] )
+      return cumlo[n2] - cumlo[n1];
+
+    return cumhi[n1] - cumhi[n2];
+  }
+};
+
+// The table energies scaled by ca (the values are calculated when
+// needed rather than stored).
+//
+template <typename Real>
+struct KerrbbEnergy {
+  KerrbbEnergy(const float* e_, Real ca_) : e(e_), ca(ca_) { }
+
+  Real operator[](int i) const { return e[i] * ca; }
+
+  const float* e;
+  Real ca;
+};
+
+// The flux density at an energy, and the bracketing table points.
+// The spectrum is scaled by cc in flux and ca in energy, and logca
+// is log10(ca).
+//
+template <typename Real>
+struct KerrbbEdge {
+  Real flux;
+  int n1;
+  int n2;
+};
+
+template <typename Real>
+static KerrbbEdge<Real> kerrbb_edge(Real earm,
+				    const KerrbbSpectrum<Real>& spec,
+				    const KerrbbEnergy<Real>& ear0,
+				    Real cc, Real logca) {
+
+  const int nener = KERRBB_NENER;
+  KerrbbEdge<Real> out;
+
+  // When earm < ear0[0], calculate the specific flux at earm
+  // according to law: specific flux proportional to energy^(-2/3)
+  if ( earm < ear0[0] ) {
+    Real flux0 = cc * spec.flux[0];
+    out.flux = flux0 * std::pow(ear0[0] / earm, Real(2) / Real(3));
+    out.n1 = 0;
+    out.n2 = 0;
+
+  // When earm > ear0[nener - 1], cutoff the flux density
+  } else if ( earm > ear0[nener - 1] ) {
+    out.flux = Real(1.e-20);
+    out.n1 = nener - 1;
+    out.n2 = nener - 1;
+
+  // Use linear interpolation (in log space)
+  } else {
+    int nex = kerrbb_nearest(earm, ear0, nener);
+    Real de = earm - ear0[nex];
+    int nexb = nex + int( std::copysign(Real(1), de) );
+    out.n1 = std::min(nex, nexb);
+    out.n2 = std::max(nex, nexb);
+
+    // ZRUNKBB read past the end of the table when earm matched the
+    // last energy.
+    if ( out.n2 > nener - 1 ) {
+      out.n2 = nener - 1;
+      out.n1 = out.n2 - 1;
+    }
+
+    Real flux1 = cc * spec.flux[out.n1];
+    out.flux = flux1 *
+      std::pow(Real(10), spec.lslope[out.n1] *
+	       (std::log10(earm) - (logca + spec.loge[out.n1])));
+  }
+
+  return out;
+}
+
+template <typename Real>
+static std::shared_ptr<const KerrbbSpectrum<Real> >
+kerrbb_interpolate(const std::shared_ptr<const KerrbbTable>& table,
+		   const double* pars) {
+
+  std::shared_ptr<KerrbbSpectrum<Real> > spec =
+    std::make_shared<KerrbbSpectrum<Real> >();
+  spec->eta = pars[0];
+  spec->astar = pars[1];
+  spec->theta = pars[2];
+  spec->table = table;
+
+  Real eta = pars[0];
+  Real astar = pars[1];
+  Real theta = pars[2];
+
+  int nx1, nx2, ny1, ny2, nz1, nz2;
+  Real t, s, w;
+  kerrbb_weights(astar, table->ai, KERRBB_NS, nx1, nx2, t);
+  kerrbb_weights(theta, table->thetai, KERRBB_NTH, ny1, ny2, s);
+  kerrbb_weights(eta, table->gi, KERRBB_NG, nz1, nz2, w);
+  Real tc = Real(1.) - t;
+  Real sc = Real(1.) - s;
+  Real wc = Real(1.) - w;
+
+  // FLUX0(NS, NTH, NG, NENER) in Fortran order
+  auto index = [](int ix, int iy, int iz) {
+    return ix + KERRBB_NS * (iy + KERRBB_NTH * iz);
+  };
+  const int stride = KERRBB_NS * KERRBB_NTH * KERRBB_NG;
+  const int i1 = index(nx1, ny1, nz1);
+  const int i2 = index(nx2, ny1, nz1);
+  const int i3 = index(nx2, ny2, nz1);
+  const int i4 = index(nx1, ny2, nz1);
+  const int i5 = index(nx1, ny1, nz2);
+  const int i6 = index(nx2, ny1, nz2);
+  const int i7 = index(nx2, ny2, nz2);
+  const int i8 = index(nx1, ny2, nz2);
+
+  for (int i = 0; i < KERRBB_NENER; i++) {
+    const float* f0 = table->flux0 + i * stride;
+    Real cflux1 = tc * sc * wc * f0[i1];
+    Real cflux2 = t * sc * wc * f0[i2];
+    Real cflux3 = t * s * wc * f0[i3];
+    Real cflux4 = tc * s * wc * f0[i4];
+    Real cflux5 = tc * sc * w * f0[i5];
+    Real cflux6 = t * sc * w * f0[i6];
+    Real cflux7 = t * s * w * f0[i7];
+    Real cflux8 = tc * s * w * f0[i8];
+
+    spec->flux[i] = cflux1 + cflux2 + cflux3 + cflux4
+      + cflux5 + cflux6 + cflux7 + cflux8;
+  }
+
+  const float* e = table->e;
+  for (int i = 0; i < KERRBB_NENER; i++) {
+    spec->loge[i] = std::log10(Real(e[i]));
+  }
+
+  for (int i = 0; i < KERRBB_NENER - 1; i++) {
+    spec->lslope[i] = (std::log10(spec->flux[i + 1]) -
+		       std::log10(spec->flux[i])) /
+      (spec->loge[i + 1] - spec->loge[i]);
+  }
+
+  spec->cumlo[0] = 0.0;
+  for (int i = 0; i < KERRBB_NENER - 1; i++) {
+    spec->cumlo[i + 1] = spec->cumlo[i] + 0.5 *
+      (double(spec->flux[i]) + double(spec->flux[i + 1])) *
+      (double(e[i + 1]) - double(e[i]));
+  }
+
+  spec->cumhi[KERRBB_NENER - 1] = 0.0;
+  for (int i = KERRBB_NENER - 2; i >= 0; i--) {
+    spec->cumhi[i] = spec->cumhi[i + 1] + 0.5 *
+      (double(spec->flux[i]) + double(spec->flux[i + 1])) *
+      (double(e[i + 1]) - double(e[i]));
+  }
+
+  return spec;
+}
+
+// Scale the interpolated spectrum and integrate it over each bin.
+// The parameters are mbh, mdd (in 1e18 g/s), dbh (in kpc), fcol, and
+// zbh, as described in zkerrbb.
+//
+template <typename Real>
+static void kerrbb_calc(const KerrbbSpectrum<Real>& spec,
+			const double* energy, int nE, Real mbh, Real mdd,
+			Real dbh, Real fcol, Real zbh, double* photar) {
+
+  Real ca = std::pow(mdd, Real(0.25)) * std::pow(mbh, Real(-0.5)) * fcol;
+  Real cb = mbh * mbh / (dbh * dbh) * std::pow(fcol, Real(-4.));
+  Real cc = cb * (ca * ca);
+
+  // Modification from Jack Steiner for extragalactic sources
+  ca = ca / (Real(1.0) + zbh);
+
+  KerrbbEnergy<Real> ear0(spec.table->e, ca);
+  Real logca = std::log10(ca);
+  double scale = double(cc) * double(ca);
+
+  Real elo = energy[0];
+  KerrbbEdge<Real> lo = kerrbb_edge(elo, spec, ear0, cc, logca);
+  for (int i = 0; i < nE; i++) {
+    Real ehi = energy[i + 1];
+    KerrbbEdge<Real> hi = kerrbb_edge(ehi, spec, ear0, cc, logca);
+
+    int n2 = lo.n2;
+    int n3 = hi.n1;
+
+    Real flux2 = cc * spec.flux[n2];
+    Real flux3 = cc * spec.flux[n3];
+    Real iflux1 = Real(0.5) * (lo.flux + flux2) * (ear0[n2] - elo);
+    Real iflux2 = Real(0.5) * (hi.flux + flux3) * (ehi - ear0[n3]);
+    Real iflux12 = Real(0.5) * (lo.flux + hi.flux) * (ehi - elo);
+
+    if ( n3 > n2 ) {
+      Real iflux0 = scale * spec.integral(n2, n3);
+      photar[i] = iflux0 + iflux1 + iflux2;
+
+    } else if ( n3 == n2 ) {
+      photar[i] = iflux1 + iflux2;
+
+    } else {
+      photar[i] = iflux12;
+    }
+
+    elo = ehi;
+    lo = hi;
+  }
+}
+
+// The last distance and interpolated spectrum calculated for each
+// precision. The parameters are often frozen (e.g. only the accretion
+// rate and normalization vary during a fit), in which case the values
+// can be re-used.
+//
+template <typename Real>
+struct KerrbbMemo {
+  KerrbbMemo() : have_distance(false) { }
+
+  // The distance (in kpc) for the redshift and cosmology.
+  bool have_distance;
+  double z;
+  float H0;
+  float q0;
+  float lambda0;
+  Real dbh;
+
+  std::shared_ptr<const KerrbbSpectrum<Real> > spectrum;
+};
+
+// The hits and misses count how often the interpolated spectrum
+// could be re-used.
+//
+class ZkerrbbState {
+public:
+  ZkerrbbState() : hits(0), misses(0) { }
+
+  std::mutex mutex;
+  KerrbbMemo<float> single_memo;
+  KerrbbMemo<double> double_memo;
+  size_t hits;
+  size_t misses;
+};
+
+static ZkerrbbState default_state;
+
+template <typename Real>
+static KerrbbMemo<Real>& get_memo(ZkerrbbState& state);
+
+template <>
+KerrbbMemo<float>& get_memo<float>(ZkerrbbState& state) {
+  return state.single_memo;
+}
+
+template <>
+KerrbbMemo<double>& get_memo<double>(ZkerrbbState& state) {
+  return state.double_memo;
+}
+
+template <typename Real>
+static void zkerrbb_calc(ZkerrbbState& state,
+			 const std::shared_ptr<const KerrbbTable>& table,
+			 const double* energy, int nE, const double* pars,
+			 double* photar) {
+
+  // Set the physical quantities required by the main routine
+
+  Real mbh = pars[3];
+  // convert mdd from Msun/yr to 1e18 g/s units required by runkbb
+  // (1.99e33/3.1457e7/1e18); the value is converted to Real first,
+  // as in the Fortran version
+  Real mdd = Real(pars[4]) * 6.309e7;
+  Real zbh = pars[5];
+  Real fcol = pars[6];
+
+  // The cosmology can be changed - with the GIL held - while the
+  // model is being evaluated.
+  float q0f, H0f, Lambda0f;
+  {
+    std::lock_guard<XspecLock> guard(xspec_lock());
+    q0f = FunctionUtility::getq0();
+    H0f = FunctionUtility::getH0();
+    Lambda0f = FunctionUtility::getlambda0();
+  }
+
+  KerrbbMemo<Real>& memo = get_memo<Real>(state);
+
+  bool have_dbh = false;
+  Real dbh = 0;
+  std::shared_ptr<const KerrbbSpectrum<Real> > spec;
+  {
+    std::lock_guard<std::mutex> guard(state.mutex);
+    if ( memo.have_distance && (memo.z == pars[5]) && (memo.H0 == H0f) &&
+	 (memo.q0 == q0f) && (memo.lambda0 == Lambda0f) ) {
+      dbh = memo.dbh;
+      have_dbh = true;
+    }
+
+    if ( memo.spectrum && (memo.spectrum->eta == pars[0]) &&
+	 (memo.spectrum->astar == pars[1]) &&
+	 (memo.spectrum->theta == pars[2]) &&
+	 (memo.spectrum->table == table) )
+      spec = memo.spectrum;
+
+    if ( spec )
+      state.hits++;
+    else
+      state.misses++;
+  }
+
+  if ( !have_dbh ) {
+    // calculate distance in kpc
+    Real q0 = q0f;
+    Real H0 = H0f;
+    Real Lambda0 = Lambda0f;
+    Real clight = 2.99792458e5;
+    Numerics::FZSQ fzsq;
+
+    dbh = (clight/H0)*sqrt(fzsq(zbh, q0, Lambda0)) * 1000.0;
+
+    std::lock_guard<std::mutex> guard(state.mutex);
+    memo.have_distance = true;
+    memo.z = pars[5];
+    memo.H0 = H0f;
+    memo.q0 = q0f;
+    memo.lambda0 = Lambda0f;
+    memo.dbh = dbh;
+  }
+
+  if ( !spec ) {
+    spec = kerrbb_interpolate<Real>(table, pars);
+
+    std::lock_guard<std::mutex> guard(state.mutex);
+    memo.spectrum = spec;
+  }
+
+  kerrbb_calc(*spec, energy, nE, mbh, mdd, dbh, fcol, zbh, photar);
+}
+
+ZkerrbbState* zkerrbb_state_new() {
+  return new ZkerrbbState();
+}
+
+void zkerrbb_state_free(ZkerrbbState* state) {
+  delete state;
+}
+
+void zkerrbb_memo_info(ZkerrbbState* state, size_t* hits, size_t* misses) {
+  if ( state == NULL )
+    state = &default_state;
+
+  std::lock_guard<std::mutex> guard(state->mutex);
+  *hits = state->hits;
+  *misses = state->misses;
+}
+
+template <typename Real>
+static void nearest_many(const double* x, int nx, const double* arr, int n,
+			 int* idx) {
+  std::vector<Real> grid(arr, arr + n);
+  for (int i = 0; i < nx; i++) {
+    idx[i] = kerrbb_nearest(Real(x[i]), grid, n);
+  }
+}
+
+void zkerrbb_nearest(const double* x, int nx, const double* arr, int n,
+		     int* idx, bool double_precision) {
+  if ( double_precision )
+    nearest_many<double>(x, nx, arr, n, idx);
+  else
+    nearest_many<float>(x, nx, arr, n, idx);
+}
+
+void zkerrbb_eval(ZkerrbbState* state, const double* energy, int nFlux,
+		  const double* params, double* flux, bool double_precision) {
+
+  if ( state == NULL )
+    state = &default_state;
+
+  int rflag = (int)round(params[7]);
+  int lflag = (int)round(params[8]);
+
+  std::shared_ptr<const KerrbbTable> table = get_kerrbb_table(rflag, lflag);
+  if (!table) {
+    std::fill(flux, flux + nFlux, 0.0);
+    return;
+  }
+
+  if (double_precision)
+    zkerrbb_calc<double>(*state, table, energy, nFlux, params, flux);
+  else
+    zkerrbb_calc<float>(*state, table, energy, nFlux, params, flux);
+}
+
+// The XSPEC C++ interface to the model (the calculation is done in
+// single precision, using the default state).
+//
 extern "C" void zkerrbb(const RealArray& energyArray, const RealArray& params,
-        int spectrumNumber, RealArray& flux, RealArray& fluxErr, 
+        int spectrumNumber, RealArray& flux, RealArray& fluxErr,
         const string& initString)
 {
-   // Memory allocation wrapper function for Li-Xin Li's runkbb routine.
-
    int nE = static_cast<int>(energyArray.size()) - 1;
 
-   // The memory for temporary arrays
-
-   std::unique_ptr<float[]> apFluxE(new float[nE*2]);
-   std::unique_ptr<int[]> apNex1(new int[nE*2]);
-   std::unique_ptr<int[]> apNex2(new int[nE*2]);
-
-   float *ear=0, *pars=0, *photar=0, *photer=0;
-   XSFunctions::stlToFloatArrays<float>(energyArray, params, flux, fluxErr,
-           ear, pars, photar, photer);
-   std::unique_ptr<float[]> apEar(ear);
-   std::unique_ptr<float[]> apPars(pars);
-   std::unique_ptr<float[]> apPhotar(photar);
-   std::unique_ptr<float[]> apPhoter(photer);
-
-   // Set the physical quantities required by the main routine
-
-   float eta = pars[0];
-   float astar = pars[1];
-   float theta = pars[2];
-   float mbh = pars[3];
-   // convert mdd from Msun/yr to 1e18 g/s units required by runkbb
-   // (1.99e33/3.1457e7/1e18)
-   float mdd = pars[4] * 6.309e7;
-   float zbh = pars[5];
-   float fcol = pars[6];
-   int rflag = (int)round(pars[7]);
-   int lflag = (int)round(pars[8]);
-
-   // calculate distance in kpc 
-   float q0 = FunctionUtility::getq0();
-   float H0 = FunctionUtility::getH0();
-   float Lambda0 = FunctionUtility::getlambda0();
-   float clight = 2.99792458e5;
-   Numerics::FZSQ fzsq;
-
-   float dbh = (clight/H0)*sqrt(fzsq(zbh, q0, Lambda0)) * 1000.0;
-
-   // call main routine
-
-   zrunkbb_(ear, nE, eta, astar, theta, mbh, mdd, dbh, fcol, rflag, lflag,
-	    zbh, photar, apFluxE.get(), apNex1.get(), apNex2.get());
-   XSFunctions::floatFluxToStl<float>(photar, photer, nE, false, flux, fluxErr);
+   flux.resize(nE);
+   zkerrbb_eval(NULL, &energyArray[0], nE, &params[0], &flux[0], false);
 
    // no flux errors associated with this model
    fluxErr = 0.0;
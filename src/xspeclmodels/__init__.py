@@ -42,6 +42,204 @@ gamma_tau   " "  1.7   1.001      1.001      5         10        0.01
 kT_e        keV  50.   0.5        0.5      150.0      150.0      0.1
 z           " "  0.0   0.0        0.0       5.0         5.0     -0.01
 
+Caching
+-------
+
+The agnslim model stores the spectra it calculates on its internal
+grid in a least-recently-used cache, so that repeated evaluations -
+for instance when fitting several datasets, or using several agnslim
+components - do not require the disc to be re-calculated. Each
+XSagnslim instance has its own cache (with a separate cache for each
+spectrum number), so that components do not evict each other's
+spectra. The caches can be inspected and controlled with the
+agnslim_cache_info, agnslim_cache_clear, and set_agnslim_cache_size
+routines, and the cache_info and cache_clear methods of XSagnslim.
+The disc structure (the temperature of each radial zone), which only
+depends on the mass, logmdot, astar, R_hot, R_warm, logrout, and rin
+parameters, is cached separately by each instance (see the
+structure_cache_info method), so that changing one of the other
+parameters - such as the temperature or photon index of the
+Comptonisation components - does not require it to be re-calculated.
+The spectra are stored in the rest frame, and the redshift and
+distance are applied when the spectrum is rebinned onto the requested
+grid, so changing the redshift or dist parameters does not require a
+new spectrum (unless the redshifted grid extends beyond the 1e-5 to
+1e3 keV range of the internal grid). The mapping from the internal
+grid onto the requested grid is also cached (see
+agnslim_rebin_cache_info), so returning a cached spectrum only requires
+a sparse matrix-vector product. When the distance differs from
+the value used to calculate the cached spectrum the result can
+differ from a full calculation by a relative amount of about 1e-6,
+due to the single-precision calculation.
+
+The zkerrbb model uses the kerrbb.fits file from the XSPEC model data
+directory. All four FLUX columns (one for each combination of the
+rflag and lflag settings) are read at once, and kept, so that
+changing these settings does not require the file to be re-read.
+Each column is also written out as a binary file
+(kerrbb_flux<n>.cache, where n is 1 to 4), in the model data directory
+if possible, otherwise in $XDG_CACHE_HOME/xspeclmodels/ (or
+~/.cache/xspeclmodels/). These files are memory-mapped, so that
+processes running on the same machine share one copy of the table
+rather than each reading the FITS file. The cache
+files are automatically replaced if kerrbb.fits changes, and can be
+deleted at any time.
+
+The thcompc model stores the operator it applies to the seed spectrum
+(which depends on the gamma_tau and kT_e parameters and the energy
+grid) in a least-recently-used cache, so that when only the seed
+spectrum changes the operator does not need to be re-calculated. The
+cache can be inspected and controlled with the thcompc_cache_info,
+thcompc_cache_clear, and set_thcompc_cache_size routines.
+
+The thcompc model solves the Kompaneets equation on a grid with as
+many bins as the requested grid, so the time and memory it needs
+grow with the grid (which can cause a stack overflow for grids with
+tens of thousands of bins). The set_thcompc_grid_size routine sets
+the number of bins in an internal, logarithmically-spaced, grid that
+is used instead when the requested grid is larger. The seed spectrum
+is rebinned onto this grid and the result interpolated back onto the
+requested grid. This is not used by default.
+
+Resolution
+----------
+
+The agnslim model calculates the spectrum on an internal grid of
+5000 logarithmically-spaced bins, integrating the disc over a fixed
+number of radial zones. The set_resolution method of XSagnslim
+allows a coarser (faster) or finer (slower) calculation to be used
+by a model instance, either by selecting one of the modes listed in
+XSagnslim.resolution_modes or by giving the settings explicitly. The
+approximate trade-offs, measured as the typical difference from a
+calculation with four times the resolution of the default, for bins
+above 0.1% of the peak, are:
+
+  =========  ============  ==============
+  mode       time          difference
+  =========  ============  ==============
+  fast       1/15 - 1/20   2 to 3%
+  default    1             0.3%
+  reference  4             0.1%
+  =========  ============  ==============
+
+The default mode matches the original XSPEC model. The differences
+depend on the parameter values, so the fast mode is intended for
+exploratory fits, with the final fit using the default or reference
+modes.
+
+Most of the time is spent calculating the Comptonised spectrum of
+each radial zone in the hot and warm regions, even though only the
+seed temperature changes from zone to zone. Setting the nseed
+resolution value (e.g. mdl.set_resolution(nseed=20)) calculates these
+spectra at nseed seed temperatures per decade, and interpolates
+between them, so the cost depends on the range of temperatures
+rather than the number of zones. The tabulated spectra are cached by
+each instance (see the shape_cache_info method), so they are re-used
+when only the disc parameters change. This is an approximation, so
+the results should be compared to those with nseed=0 (the default
+for all modes) for the parameter values of interest.
+
+The radial zones are spread evenly (in log radius) over each region,
+so the number of zones needed depends on the parameter values. When
+the rtol resolution value is set, the ipow, icor, and iout values give
+the starting number of zones for the hot, warm, and outer regions,
+and the zones in each region are doubled (up to five times) until the
+change in the spectrum from that region is less than rtol of the
+total (for bins above 0.1% of the peak). The get_zones method reports
+the number of zones that were used. For example
+
+  >>> mdl.set_resolution('fast', rtol=1e-3)
+  >>> y = mdl(egrid)
+  >>> mdl.get_zones()
+
+The tolerance is applied to each region separately, and is an
+estimate, so the error in the spectrum can be a few times rtol.
+
+Batch evaluation
+----------------
+
+The models provide a calc_batch method, which evaluates the model
+for a 2D array of parameter values (one row per parameter set) on a
+single grid, and returns a 2D array with one row per set. The loop
+over the parameter sets is done in C++, so this avoids the overhead
+of going through Python and Sherpa for each set (e.g. when
+post-processing the results of an MCMC run). The sets can be
+evaluated in parallel by setting the nthreads argument.
+
+The XSthcompc model also provides a calc_seeds method, which
+convolves several seed spectra (a 2D array with one row per
+spectrum) with a single set of parameter values. The operator is
+only calculated, or taken from the cache, once, and the Kompaneets
+equation is solved for the spectra together, so this is faster than
+calling the model for each spectrum (for instance when convolving the
+components of a model separately), and gives the same results.
+
+Threads
+-------
+
+The models release the GIL while they are being evaluated, so they
+can also be evaluated from several Python threads. The XSPEC model
+library is not thread safe, so the calls the models make to it (e.g.
+the nthcomp code used by agnslim, and the rebinning routines) are made
+with the GIL held. This means that these calls are serialized, both
+with each other and with the models provided by Sherpa (which hold
+the GIL while they run), but also that they have to wait for any
+Python code running in other threads to release the GIL.
+
+The XSPEC models provided by Sherpa, such as XSnthcomp, are only
+protected by the GIL. They must not be evaluated from another thread
+while one of these models is being evaluated, unless that thread
+holds the GIL (which is the case when they are called from Python),
+since the two could then use the XSPEC library at the same time.
+
+If the XSPECLMODELS_OPENMP environment variable was set when the
+module was built then the radial zones of a single agnslim evaluation
+can be calculated in parallel, using the number of threads set by
+set_agnslim_threads (the default is 1). The nthcomp calls are still
+serialized, so the gain is limited to the disc blackbody component.
+Since the order in which the zones are summed depends on the number of
+threads, the results differ from the serial calculation by a relative
+amount of about 1e-6 (single-precision rounding).
+
+The FORTRAN code must be compiled so that it is re-entrant (e.g. with
+-frecursive for gfortran). The flag is only known for some compilers
+(see FORTRANFLAGS in setup.py), and when the module has been built
+with another compiler the nthreads argument must be 1, and the models
+should not be evaluated from several Python threads at the same time.
+
+Worker processes
+----------------
+
+The XSPEC model library is initialized, and the kerrbb table read,
+the first time a model is used. The preload routine does this (and
+imports the thcompc code), so that processes forked after it has been
+called share this data and can evaluate the models immediately. The
+caches are also shared, so instances evaluated on the grids they will
+be used with before forking start with a filled cache.
+
+Profiling
+---------
+
+The evaluation of the models can be recorded by calling
+enable_profiling. For each model instance (identified by a number,
+as instances can share a name) and spectrum number, the number of
+calls and parameter sets evaluated, the total time and a histogram of
+the time per call (with the bin edges given by PROFILE_TIME_BINS), the
+number of cache hits and misses, and the number of times each grid
+size was used, are recorded. The results are returned by get_profile,
+or written to a JSON file by save_profile. Profiling is turned off by
+disable_profiling, and has negligible overhead when off.
+
+Tracing
+-------
+
+The start_trace routine writes every evaluation of the models - the
+parameter values, the grid, and the time taken - to a file until
+stop_trace is called. The xspeclmodels-replay script (or the replay
+routine from xspeclmodels.trace) re-runs these evaluations, and
+reports the time taken, without needing Sherpa, so that a fit can be
+profiled, and optimizations tested, using the calls it actually makes.
+
 References
 ----------
 
@@ -49,17 +247,53 @@ References
 
 """
 
+from collections import namedtuple
+import functools
+import importlib.machinery
+import importlib.util
+import json
+import threading
+import time
+import weakref
+
+import numpy as np
+
 from sherpa.models.parameter import Parameter, hugeval
 from sherpa.astro.xspec import XSAdditiveModel, get_xsversion
 
-try:
-    from sherpa_contrib.xspec.xsmodels import XSConvolutionKernel
-    support_convolve = True
-except ImportError:
-    support_convolve = False
-
 from . import _models
 
+
+# The thcompc model needs the sherpa_contrib package, which is only
+# imported when XSthcompc is first used (see __getattr__).
+#
+def _has_module(name):
+    """Can the module be found (without importing it or its parents)?
+
+    This does not mean that it can be imported.
+    """
+
+    # importlib.util.find_spec imports the parent packages, so it is
+    # only used for the top-level package, and the search path it
+    # reports is used to find the rest.
+    parts = name.split('.')
+    try:
+        spec = importlib.util.find_spec(parts[0])
+        for i in range(1, len(parts)):
+            if spec is None or spec.submodule_search_locations is None:
+                return False
+
+            spec = importlib.machinery.PathFinder.find_spec(
+                '.'.join(parts[:i + 1]), spec.submodule_search_locations)
+
+    except (ImportError, ValueError):
+        return False
+
+    return spec is not None
+
+
+support_convolve = _has_module('sherpa_contrib.xspec.xsmodels')
+
 __all__ = ['XSagnslim', 'XSzkerrbb']
 if support_convolve:
     __all__.append('XSthcompc')
@@ -67,19 +301,694 @@ if support_convolve:
 __all__ = tuple(__all__)
 
 
+def __getattr__(name):
+    global __all__, support_convolve
+
+    if name == 'XSthcompc' and support_convolve:
+        try:
+            from ._thcompc import XSthcompc
+        except ImportError as exc:
+            # sherpa_contrib can be found but not imported, so treat
+            # it as missing from now on.
+            support_convolve = False
+            __all__ = tuple(n for n in __all__ if n != 'XSthcompc')
+            emsg = "module '{}' has no attribute '{}' ({})"
+            raise AttributeError(emsg.format(__name__, name,
+                                             exc)) from None
+
+        # Store the class so that __getattr__ is not needed again.
+        globals()['XSthcompc'] = XSthcompc
+        return XSthcompc
+
+    raise AttributeError("module '{}' has no attribute '{}'".format(__name__,
+                                                                  name))
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
+
+
 # We need to ensure that the XSPEC model library has been initialized
 # before the model is evaluated. This could be handled in the
 # Python<->C++ bridge, as it is with the XSPEC module that is
-# distributed with CIAO, but here we just ensure that the library
-# has been initialized when this module is imported.
+# distributed with CIAO, but here we just ensure that Sherpa has
+# initialized the library before the first evaluation (rather than
+# when the module is imported, since it can take a noticeable time).
+#
+_xspec_initialized = False
+
+
+def _initialize_xspec():
+    """Ensure the XSPEC model library has been initialized."""
+
+    global _xspec_initialized
+    if not _xspec_initialized:
+        get_xsversion()
+        _xspec_initialized = True
+
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+AgnslimResolution = namedtuple('AgnslimResolution',
+                               ['nn', 'imax', 'ipow', 'icor', 'iout',
+                                'nseed', 'rtol'])
+
+AgnslimZones = namedtuple('AgnslimZones', ['hot', 'warm', 'outer'])
+
+
+def agnslim_cache_info():
+    """Report the statistics of the agnslim caches.
+
+    Returns
+    -------
+    info : CacheInfo
+        The number of hits and misses, the maximum number of spectra
+        that can be stored by each cache, and the number currently
+        stored. The values are summed over all agnslim instances.
+
+    See Also
+    --------
+    agnslim_cache_clear, set_agnslim_cache_size
+
+    """
+
+    return CacheInfo(*_models.agnslim_cache_info())
+
+
+def agnslim_rebin_cache_info():
+    """Report the statistics of the agnslim rebinning cache.
+
+    The mapping from the internal grid of agnslim to the requested
+    grid is shared by all the agnslim instances, and only depends on
+    the grids and the redshift.
+
+    Returns
+    -------
+    info : CacheInfo
+        The number of hits and misses, the maximum number of maps
+        that can be stored, and the number currently stored.
+
+    See Also
+    --------
+    agnslim_cache_clear, agnslim_cache_info
+
+    """
+
+    return CacheInfo(*_models.agnslim_rebin_cache_info())
+
+
+def agnslim_cache_clear():
+    """Remove all spectra and rebinning maps from the agnslim caches.
+
+    The hit and miss counts are also reset.
+
+    See Also
+    --------
+    agnslim_cache_info, agnslim_rebin_cache_info, set_agnslim_cache_size
+
+    """
+
+    _models.agnslim_cache_clear()
+
+
+def set_agnslim_cache_size(maxsize):
+    """Change the number of spectra stored by the agnslim caches.
+
+    Parameters
+    ----------
+    maxsize : int
+        The maximum number of spectra to store in each cache (there
+        is a cache for each spectrum number of each agnslim
+        instance). A value of 0 turns off the cache. If a cache
+        currently contains more than maxsize entries then the
+        least-recently used entries are removed.
+
+    See Also
+    --------
+    agnslim_cache_clear, agnslim_cache_info
+
+    """
+
+    _models.agnslim_cache_resize(maxsize)
+
+
+def thcompc_cache_info():
+    """Report the statistics of the thcompc cache.
+
+    Returns
+    -------
+    info : CacheInfo
+        The number of hits and misses, the maximum number of
+        operators that can be stored, and the number currently
+        stored.
+
+    See Also
+    --------
+    thcompc_cache_clear, set_thcompc_cache_size
+
+    """
+
+    return CacheInfo(*_models.thcompf_cache_info())
+
+
+def thcompc_cache_clear():
+    """Remove all operators from the thcompc cache.
+
+    The hit and miss counts are also reset.
+
+    See Also
+    --------
+    set_thcompc_cache_size, thcompc_cache_info
+
+    """
+
+    _models.thcompf_cache_clear()
+
+
+def set_thcompc_cache_size(maxsize):
+    """Change the number of operators stored by the thcompc cache.
+
+    Parameters
+    ----------
+    maxsize : int
+        The maximum number of operators to store (one is needed for
+        each combination of the gamma_tau and kT_e parameters and
+        the energy grid). A value of 0 turns off the cache. If the
+        cache currently contains more than maxsize entries then the
+        least-recently used entries are removed.
+
+    See Also
+    --------
+    thcompc_cache_clear, thcompc_cache_info
+
+    """
+
+    _models.thcompf_cache_resize(maxsize)
+
+
+def get_thcompc_grid_size():
+    """The number of bins in the internal grid used by thcompc.
+
+    Returns
+    -------
+    nbins : int
+        The number of bins, where 0 means the requested grid is
+        used.
+
+    See Also
+    --------
+    set_thcompc_grid_size
+
+    """
+
+    return _models.thcompf_grid_size()
+
+
+def set_thcompc_grid_size(nbins):
+    """Change the number of bins in the internal grid used by thcompc.
+
+    This applies to all thcompc instances.
+
+    Parameters
+    ----------
+    nbins : int
+        When the requested grid has more than nbins bins, the seed
+        spectrum is rebinned onto nbins logarithmically-spaced bins
+        covering the same range, the Kompaneets equation solved on
+        this grid, and the result interpolated back onto the
+        requested grid. A value of 0 means the requested grid is
+        always used (as the original model does).
+
+    Raises
+    ------
+    ValueError
+        If nbins is not 0 and is less than 10.
+
+    See Also
+    --------
+    get_thcompc_grid_size
+
+    Notes
+    -----
+    The internal grid should resolve the features of the seed
+    spectrum, since the result is interpolated between the internal
+    bins. The output is normalized to the number of photons in the
+    seed spectrum, as with the original model.
+
+    """
+
+    _models.thcompf_set_grid_size(nbins)
+
+
+def get_agnslim_threads():
+    """The number of threads used by an agnslim evaluation.
+
+    Returns
+    -------
+    nthreads : int
+        The number of threads, where 0 means one per core. This is
+        always 1 if the module was not built with OpenMP support.
+
+    See Also
+    --------
+    set_agnslim_threads
+
+    """
+
+    openmp, nthreads = _models.agnslim_threads()
+    return nthreads if openmp else 1
+
+
+def set_agnslim_threads(nthreads):
+    """Change the number of threads used by an agnslim evaluation.
+
+    This applies to all agnslim instances, and is only supported if
+    the module was built with OpenMP support (by setting the
+    XSPECLMODELS_OPENMP environment variable when building).
+
+    Parameters
+    ----------
+    nthreads : int
+        The number of threads used to calculate the emission from the
+        radial zones of the disc. A value of 0 means use one thread per
+        core (or the value of the OMP_NUM_THREADS environment variable).
+
+    Raises
+    ------
+    ValueError
+        If nthreads is negative, or is not 1 when the module was built
+        without OpenMP support.
+
+    See Also
+    --------
+    get_agnslim_threads
+
+    """
+
+    openmp, _ = _models.agnslim_threads()
+    if not openmp and nthreads != 1:
+        raise ValueError("xspeclmodels was built without OpenMP support")
+
+    _models.agnslim_set_threads(nthreads)
+
+
+PRELOAD_MODELS = ('agnslim', 'zkerrbb', 'thcompc')
+
+
+def preload(models=None):
+    """Prepare the models so that they can be used immediately.
+
+    The XSPEC model library is initialized, the thcompc code is
+    imported, and the model data is read in (the kerrbb table used by
+    zkerrbb, for all rflag and lflag settings), so that the first
+    evaluation of a model does not have to pay these costs. This is
+    intended to be called before forking worker processes, since the
+    children then share the data, and the table is memory-mapped read
+    only (when the cache file can be used) so it stays shared.
+
+    Parameters
+    ----------
+    models : sequence of str or None, optional
+        The models to prepare (from PRELOAD_MODELS). The default is
+        all of them (thcompc is skipped if sherpa_contrib is not
+        available).
+
+    Raises
+    ------
+    IOError
+        The kerrbb table could not be read.
+
+    Notes
+    -----
+    The models are not evaluated, as the spectra and thcompc operators
+    that are cached depend on the grid and parameter values. These
+    caches are shared by forked processes, so instances created, and
+    evaluated on the grids they will be used with, before forking
+    start with a filled cache.
+
+    Examples
+    --------
+
+    >>> import multiprocessing
+    >>> import xspeclmodels
+    >>> xspeclmodels.preload()
+    >>> with multiprocessing.get_context('fork').Pool(8) as pool:
+    ...     pool.map(fit_source, sources)
+
+    """
+
+    if models is None:
+        models = PRELOAD_MODELS
+        if not support_convolve:
+            models = [m for m in models if m != 'thcompc']
+
+    for model in models:
+        if model not in PRELOAD_MODELS:
+            emsg = "model must be one of {}, not '{}'"
+            raise ValueError(emsg.format(PRELOAD_MODELS, model))
+
+    # agnslim has no data to read, so only needs the initialization.
+    _initialize_xspec()
+
+    if 'zkerrbb' in models:
+        if _models.zkerrbb_preload() != 4:
+            raise IOError("unable to read the kerrbb table")
+
+    if 'thcompc' in models:
+        from . import _thcompc
+
+
+# The upper edges of the histogram of the evaluation time, in seconds.
+# The last bin of the histogram counts calls that took longer than
+# the last edge.
 #
-get_xsversion()
+PROFILE_TIME_BINS = (1e-4, 1e-3, 1e-2, 0.1, 1.0, 10.0)
+
+_profiling = False
+_profile_data = {}
+_profile_instances = {}
+_profile_ninstances = 0
+_profile_lock = threading.Lock()
+
+
+def _profile_instance(instance):
+    """Return the instance number used for the profile records.
+
+    The numbers are handed out in the order the instances are first
+    evaluated. A weak reference is used to check that the id has not
+    been reused by a new instance. The profile lock must be held.
+    """
+
+    global _profile_ninstances
+
+    key = id(instance)
+    try:
+        ref, num = _profile_instances[key]
+    except KeyError:
+        ref = None
+
+    if ref is None or ref() is not instance:
+        num = _profile_ninstances
+        _profile_ninstances += 1
+        _profile_instances[key] = (weakref.ref(instance), num)
+
+    return num
+
+
+def enable_profiling():
+    """Start recording the evaluation of the models.
+
+    Any existing records are kept.
+
+    See Also
+    --------
+    clear_profile, disable_profiling, get_profile, save_profile
+
+    """
+
+    global _profiling
+    _profiling = True
+
+
+def disable_profiling():
+    """Stop recording the evaluation of the models.
+
+    The existing records are kept.
+
+    See Also
+    --------
+    clear_profile, enable_profiling, get_profile
+
+    """
+
+    global _profiling
+    _profiling = False
+
+
+def clear_profile():
+    """Remove the records of the model evaluations.
+
+    The instance numbers start again at 0.
+
+    See Also
+    --------
+    enable_profiling, get_profile
+
+    """
+
+    global _profile_ninstances
+
+    with _profile_lock:
+        _profile_data.clear()
+        _profile_instances.clear()
+        _profile_ninstances = 0
+
+
+def get_profile():
+    """Return the records of the model evaluations.
+
+    Returns
+    -------
+    profile : dict
+        The keys are the instance numbers (starting at 0, in the
+        order the instances were first evaluated), and the values are
+        dictionaries with a key for each spectrum number. Each record
+        contains the keys: model (the model type), name (the name of
+        the instance), calls (the number of calls), evaluations (the
+        number of parameter sets), time (the total time, in seconds),
+        histogram (the number of calls in each time bin, see
+        PROFILE_TIME_BINS), cache_hits, cache_misses, and nbins (a
+        dictionary of the number of times each grid size was used).
+        The return value is a copy of the records.
+
+    See Also
+    --------
+    clear_profile, enable_profiling, save_profile
+
+    Examples
+    --------
+
+    >>> enable_profiling()
+    >>> mdl = XSagnslim('mdl')
+    >>> y = mdl(np.arange(0.1, 10, 0.01))
+    >>> rec = get_profile()[0][1]
+    >>> rec['name'], rec['calls']
+    ('mdl', 1)
+
+    """
+
+    with _profile_lock:
+        return {num: {specnum: dict(rec, histogram=list(rec['histogram']),
+                                    nbins=dict(rec['nbins']))
+                      for specnum, rec in recs.items()}
+                for num, recs in _profile_data.items()}
+
+
+def save_profile(filename):
+    """Write the records of the model evaluations to a JSON file.
+
+    Parameters
+    ----------
+    filename : str
+        The name of the file, which will be overwritten if it exists.
+
+    See Also
+    --------
+    get_profile
+
+    """
+
+    with open(filename, 'w') as fh:
+        json.dump(get_profile(), fh, indent=2)
+
+
+_recorder = None
+
+
+def start_trace(filename):
+    """Record the evaluation of the models to a file.
+
+    Every evaluation - the model, parameter values, grid, and the time
+    taken - is written to the file, until stop_trace is called, so
+    that the evaluations can be re-run with the xspeclmodels-replay
+    script (or xspeclmodels.trace.replay). See xspeclmodels.trace for
+    the format of the file.
+
+    Parameters
+    ----------
+    filename : str
+        The name of the file, which will be overwritten if it exists.
+
+    See Also
+    --------
+    stop_trace
+
+    Notes
+    -----
+    Any existing trace is stopped. The input spectrum is stored for
+    each thcompc evaluation, so the file can get large when this
+    model is used.
+
+    Examples
+    --------
+
+    >>> start_trace('fit.trace')
+    >>> fit()
+    >>> stop_trace()
+
+    """
+
+    from .trace import TraceRecorder
+
+    global _recorder
+    stop_trace()
+    _recorder = TraceRecorder(filename)
+
+
+def stop_trace():
+    """Stop recording the evaluation of the models.
+
+    Returns
+    -------
+    nevals : int
+        The number of evaluations written to the file (0 if there was
+        no trace).
+
+    See Also
+    --------
+    start_trace
+
+    """
+
+    global _recorder
+    recorder = _recorder
+    if recorder is None:
+        return 0
+
+    _recorder = None
+    recorder.close()
+    return recorder.nevals
+
+
+def _instrumented(model, cache_counts, settings=None, grid_arg=0):
+    """Wrap the _calc method of a model.
+
+    The wrapper ensures that the XSPEC model library has been
+    initialized, records the evaluation when profiling is enabled,
+    and writes it to the trace file if start_trace has been called.
+    The cache_counts argument is a function which is sent the
+    instance and returns the (hits, misses) counts for the cache it
+    uses (the change over the call is recorded, so the counts must not
+    include calls from other threads), settings is a function that
+    returns the instance settings for the trace (None means there are
+    none), and grid_arg is the position of the xlo argument after
+    pars.
+    """
+
+    def wrap(calc):
+
+        @functools.wraps(calc)
+        def wrapper(self, pars, *args, **kwargs):
+            if not _xspec_initialized:
+                _initialize_xspec()
+
+            profiling = _profiling
+            recorder = _recorder
+            if not profiling and recorder is None:
+                return calc(self, pars, *args, **kwargs)
+
+            if profiling:
+                hits, misses = cache_counts(self)
+
+            start = time.perf_counter()
+            out = calc(self, pars, *args, **kwargs)
+            elapsed = time.perf_counter() - start
+
+            specnum = kwargs.get('spectrumNumber', 1)
+            if recorder is not None:
+                xlo = args[grid_arg]
+                xhi = args[grid_arg + 1] if len(args) > grid_arg + 1 \
+                    else kwargs.get('xhi')
+                fluxes = args[0] if grid_arg > 0 else None
+                recorder.record(model, self,
+                                () if settings is None else settings(self),
+                                pars, fluxes, xlo, xhi, specnum,
+                                kwargs.get('nthreads', 1), elapsed)
+
+            if not profiling:
+                return out
+
+            hits1, misses1 = cache_counts(self)
+
+            # A convolution model can be sent several seed spectra
+            # for one parameter set.
+            if np.ndim(pars) == 2:
+                nsets = len(pars)
+            elif grid_arg > 0 and np.ndim(args[0]) == 2:
+                nsets = len(args[0])
+            else:
+                nsets = 1
+            nbins = len(args[grid_arg])
+            idx = int(np.searchsorted(PROFILE_TIME_BINS, elapsed))
+
+            with _profile_lock:
+                num = _profile_instance(self)
+                recs = _profile_data.setdefault(num, {})
+                try:
+                    rec = recs[specnum]
+                except KeyError:
+                    rec = {'model': model, 'name': self.name,
+                           'calls': 0, 'evaluations': 0, 'time': 0.0,
+                           'histogram': [0] * (len(PROFILE_TIME_BINS) + 1),
+                           'cache_hits': 0, 'cache_misses': 0,
+                           'nbins': {}}
+                    recs[specnum] = rec
+
+                rec['calls'] += 1
+                rec['evaluations'] += nsets
+                rec['time'] += elapsed
+                rec['histogram'][idx] += 1
+                rec['cache_hits'] += hits1 - hits
+                rec['cache_misses'] += misses1 - misses
+                rec['nbins'][nbins] = rec['nbins'].get(nbins, 0) + 1
+
+            return out
+
+        return wrapper
+
+    return wrap
+
+
+def _sherpa_cache_clear(model):
+    """Clear the Sherpa cache of the model, if this version of Sherpa has one.
+
+    The Sherpa method is called directly, since the models may
+    override cache_clear.
+    """
+
+    clear = getattr(XSAdditiveModel, 'cache_clear', None)
+    if clear is not None:
+        clear(model)
+
+
+def _batch_pars(model, pars):
+    """Check the parameter sets sent to calc_batch."""
+
+    pars = np.asarray(pars, dtype=np.float64)
+    npars = len(model.pars)
+    if pars.ndim != 2 or pars.shape[1] != npars:
+        emsg = "pars must have shape (nsets, {}), not {}"
+        raise ValueError(emsg.format(npars, pars.shape))
+
+    return pars
 
 
 class XSagnslim(XSAdditiveModel):
     """The XSPEC agnslim model: AGN super-Eddington accretion model
 
-    See [1]_
+    See [1]_. The spectra calculated by the model are cached by each
+    instance (see the cache_info method), and the resolution of the
+    calculation can be changed (see the set_resolution method).
 
     Attributes
     ----------
@@ -128,7 +1037,11 @@ class XSagnslim(XSAdditiveModel):
 
     """
 
-    _calc = _models.agnslim
+    resolution_modes = {
+        'fast': AgnslimResolution(1000, 500, 20, 5, 250, 0, 0.0),
+        'default': AgnslimResolution(5000, 2000, 100, 10, 1000, 0, 0.0),
+        'reference': AgnslimResolution(10000, 4000, 200, 20, 2000, 0, 0.0)
+    }
 
     def __init__(self, name='agnslim'):
         self.mass = Parameter(name, 'mass', 1e7, 1, 1e10, 1, 1e10,
@@ -164,6 +1077,249 @@ class XSagnslim(XSAdditiveModel):
                 self.R_hot, self.R_warm, self.logrout, self.rin,
                 self.redshift, self.norm)
         XSAdditiveModel.__init__(self, name, pars)
+        self.__dict__['_state'] = _models.agnslim_state()
+
+    # The cache is not copied when the model is pickled, but the
+    # resolution is.
+    #
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_state']
+        state['_resolution'] = tuple(self.get_resolution())
+        return state
+
+    def __setstate__(self, state):
+        resolution = state.pop('_resolution', None)
+        super().__setstate__(state)
+        self.__dict__['_state'] = _models.agnslim_state()
+        if resolution is not None:
+            _models.agnslim_set_resolution(self._state, *resolution)
+
+    @_instrumented('agnslim',
+                   lambda mdl: _models.agnslim_cache_info(mdl._state)[:2],
+                   settings=lambda m: _models.agnslim_resolution(m._state))
+    def _calc(self, pars, xlo, *args, **kwargs):
+        return _models.agnslim(pars, xlo, *args, state=self._state, **kwargs)
+
+    def cache_info(self):
+        """Report the statistics of the cache for this instance.
+
+        Returns
+        -------
+        info : CacheInfo
+            The number of hits and misses, the maximum number of
+            spectra that can be stored by each cache, and the number
+            currently stored (summed over all spectrum numbers).
+
+        See Also
+        --------
+        cache_clear, agnslim_cache_info
+
+        """
+
+        return CacheInfo(*_models.agnslim_cache_info(self._state))
+
+    def structure_cache_info(self):
+        """Report the statistics of the disc-structure cache.
+
+        The disc structure is only calculated when a spectrum is not
+        found in the cache.
+
+        Returns
+        -------
+        info : CacheInfo
+            The number of hits and misses, the maximum number of
+            structures that can be stored, and the number currently
+            stored.
+
+        See Also
+        --------
+        cache_clear, cache_info
+
+        """
+
+        return CacheInfo(*_models.agnslim_structure_cache_info(self._state))
+
+    def shape_cache_info(self):
+        """Report the statistics of the tabulated nthcomp cache.
+
+        The cache is only used when the nseed resolution setting is
+        not 0. Each entry is the Comptonised spectrum for a single
+        seed temperature.
+
+        Returns
+        -------
+        info : CacheInfo
+            The number of hits and misses, the maximum number of
+            spectra that can be stored, and the number currently
+            stored.
+
+        See Also
+        --------
+        cache_clear, set_resolution
+
+        """
+
+        return CacheInfo(*_models.agnslim_shape_cache_info(self._state))
+
+    def cache_clear(self):
+        """Remove all spectra, disc structures, and nthcomp tables from the cache.
+
+        The model-evaluation cache provided by Sherpa (for those
+        versions that have a cache_clear method) is also cleared.
+
+        See Also
+        --------
+        cache_info, agnslim_cache_clear
+
+        """
+
+        _sherpa_cache_clear(self)
+
+        # Sherpa calls cache_clear from the base-class constructor,
+        # before the state has been created.
+        state = self.__dict__.get('_state')
+        if state is not None:
+            _models.agnslim_cache_clear(state)
+
+    def get_resolution(self):
+        """Return the resolution used by this instance.
+
+        Returns
+        -------
+        resolution : AgnslimResolution
+            The number of bins in the internal energy grid (nn) and
+            the number of radial zones used for the disc (imax), hot
+            (ipow), warm (icor), and outer (iout) regions, and the
+            number of seed temperatures per decade used to tabulate
+            the Comptonised spectra (nseed, where 0 means they are
+            calculated for each zone), and the relative tolerance used
+            to select the number of zones (rtol, where 0 means the
+            number of zones is fixed).
+
+        See Also
+        --------
+        set_resolution, get_zones
+
+        """
+
+        return AgnslimResolution(*_models.agnslim_resolution(self._state))
+
+    def get_zones(self):
+        """Return the number of radial zones used by the last evaluation.
+
+        Returns
+        -------
+        zones : AgnslimZones
+            The number of zones in the hot, warm, and outer regions.
+            A region can be empty, for instance when R_warm is smaller
+            than R_hot. The values are 0 if the model has not been
+            evaluated.
+
+        See Also
+        --------
+        get_resolution, set_resolution
+
+        """
+
+        return AgnslimZones(*_models.agnslim_zones(self._state))
+
+    def set_resolution(self, mode='default', nn=None, imax=None,
+                       ipow=None, icor=None, iout=None, nseed=None,
+                       rtol=None):
+        """Change the resolution used by this instance.
+
+        Parameters
+        ----------
+        mode : {'default', 'fast', 'reference'}, optional
+            The starting settings, taken from resolution_modes.
+        nn : int or None, optional
+            The number of bins in the internal energy grid.
+        imax : int or None, optional
+            The number of radial zones used to find the temperature
+            profile of the disc.
+        ipow : int or None, optional
+            The number of radial zones for the hot Comptonisation
+            region.
+        icor : int or None, optional
+            The number of radial zones for the warm Comptonisation
+            region.
+        iout : int or None, optional
+            The number of radial zones for the outer disc.
+        nseed : int or None, optional
+            The number of seed temperatures per decade at which the
+            Comptonised spectra of the hot and warm regions are
+            calculated and then interpolated. A value of 0 means
+            that they are calculated for each radial zone.
+        rtol : number or None, optional
+            If greater than 0 then the ipow, icor, and iout values
+            are the starting number of zones in each region, which
+            are doubled until the spectrum from that region changes
+            by less than rtol.
+
+        See Also
+        --------
+        get_resolution, get_zones
+
+        Notes
+        -----
+        The spectra already in the cache are not removed, since the
+        resolution is part of the cache key.
+
+        Examples
+        --------
+
+        >>> mdl = XSagnslim()
+        >>> mdl.set_resolution('fast')
+        >>> mdl.set_resolution(nn=2000)
+        >>> mdl.set_resolution(nseed=20)
+        >>> mdl.set_resolution('fast', rtol=1e-3)
+
+        """
+
+        try:
+            res = self.resolution_modes[mode]
+        except KeyError:
+            emsg = "mode must be one of {}, not '{}'"
+            raise ValueError(emsg.format(sorted(self.resolution_modes),
+                                         mode)) from None
+
+        changes = {'nn': nn, 'imax': imax, 'ipow': ipow, 'icor': icor,
+                   'iout': iout, 'nseed': nseed, 'rtol': rtol}
+        res = res._replace(**{k: v for k, v in changes.items()
+                              if v is not None})
+        _models.agnslim_set_resolution(self._state, *res)
+
+        # The Sherpa cache does not know about the resolution.
+        _sherpa_cache_clear(self)
+
+    def calc_batch(self, pars, xlo, xhi=None, nthreads=1):
+        """Evaluate the model for several sets of parameter values.
+
+        Parameters
+        ----------
+        pars : array_like
+            The parameter values, with shape (nsets, npars), where
+            each row contains the values for all the parameters
+            (including frozen ones) in the same order as the pars
+            attribute.
+        xlo : array_like
+            The grid on which to evaluate the model, as for calc.
+        xhi : array_like or None, optional
+            The upper edges of each bin, as for calc.
+        nthreads : int, optional
+            The number of threads used to evaluate the parameter
+            sets. A value of 0 means use one thread per core.
+
+        Returns
+        -------
+        y : ndarray
+            The model values, with shape (nsets, len(xlo)).
+
+        """
+
+        return self._calc(_batch_pars(self, pars), xlo, xhi,
+                          nthreads=nthreads)
 
 
 class XSzkerrbb(XSAdditiveModel):
@@ -172,6 +1328,12 @@ class XSzkerrbb(XSAdditiveModel):
     Description is taken from XSkerrbb; it is assumed this is
     correct.
 
+    The model is evaluated in single precision, as in XSPEC, unless
+    the double_precision attribute is set to True. Each instance
+    remembers the distance and interpolated table spectrum from the
+    last evaluation, so that they are not re-calculated when only the
+    Mbh, Mdd, fcol, or norm parameters change.
+
     Attributes
     ----------
     eta
@@ -210,8 +1372,6 @@ class XSzkerrbb(XSAdditiveModel):
 
     """
 
-    _calc = _models.C_zkerrbb
-
     def __init__(self, name='zkerrbb'):
         self.eta = Parameter(name, 'eta', 0, 0, 1.0, 0, 1.0,
                              frozen=True)
@@ -232,60 +1392,48 @@ class XSzkerrbb(XSAdditiveModel):
         pars = (self.eta, self.a, self.i, self.Mbh, self.Mdd, self.z,
                 self.fcol, self.rflag, self.lflag, self.norm)
         XSAdditiveModel.__init__(self, name, pars)
+        self.__dict__['_state'] = _models.zkerrbb_state()
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_state']
+        return state
 
-if support_convolve:
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self.__dict__['_state'] = _models.zkerrbb_state()
 
-    class XSthcompc(XSConvolutionKernel):
-        """The XSPEC thcompc model: Thermally comptonized continuum
+    @property
+    def double_precision(self):
+        """Is the model evaluated in double precision?"""
 
-        For a description see [1]_.
+        return self.__dict__.get('_double_precision', False)
 
-        .. warning::
-           This is a convolution kernel (that is, it modifies the spectrum
-           created by a model expression). This means that it is used
-           differently, and has seen *NO* testing. Note that Sherpa in
-           CIAO 4.12 has no "easy" way to extend the analysis grid
-           (although it can do so, this has not been tested with XSPEC
-           models).
+    @double_precision.setter
+    def double_precision(self, value):
+        value = bool(value)
+        if value == self.double_precision:
+            return
 
-        Attributes
-        ----------
-        gamma_tau
-            >0: the low-energy power-law photon index;
-            <0: the Thomson optical depth (given by the absolute value).
-        kT_e
-            electron temperature (high energy rollover)
-        z
-
-        References
-        ----------
+        self.__dict__['_double_precision'] = value
 
-        .. [1] https://github.com/HEASARC/xspec_localmodels/tree/master/thcompc
+        # The Sherpa cache does not know about the precision.
+        _sherpa_cache_clear(self)
 
-        Examples
-        --------
-
-        As this is a convolution model, it needs to be applied to a model
-        expression, so we generate one using a powerlaw *just* for the example
-        (in actual use this is likely to be more complex).
+    @_instrumented('zkerrbb',
+                   lambda mdl: _models.zkerrbb_memo_info(mdl._state),
+                   settings=lambda mdl: (int(mdl.double_precision),))
+    def _calc(self, pars, xlo, *args, **kwargs):
+        return _models.C_zkerrbb(pars, xlo, *args, state=self._state,
+                                 double_precision=self.double_precision,
+                                 **kwargs)
 
-        >>> continuum = XSpowerlaw('continuum')
-        >>> cmdl = XSthcompc('comptonization')
-        >>> mdl = cmdl(continuum)
+    def calc_batch(self, pars, xlo, xhi=None, nthreads=1):
+        """Evaluate the model for several sets of parameter values.
 
+        See XSagnslim.calc_batch.
         """
 
-        _calc = _models.thcompf
-
-        def __init__(self, name='thcompc'):
-
-            self.gamma_tau = Parameter(name, 'gamma_tau', 1.7, 1.001, 5,
-                                       1.001, 10)
-            self.kT_e = Parameter(name, 'kT_e', 50, 0.5, 150, 0.5, 150,
-                                  units='keV')
-            self.z = Parameter(name, 'z', 0.0, 0, 5, 0, 5,
-                               frozen=True)
+        return self._calc(_batch_pars(self, pars), xlo, xhi,
+                          nthreads=nthreads)
 
-            pars = (self.gamma_tau, self.kT_e, self.z)
-            XSConvolutionKernel.__init__(self, name, pars)
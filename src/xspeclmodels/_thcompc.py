@@ -0,0 +1,154 @@
+#
+# This code is placed into the PUBLIC DOMAIN.
+# It was written by Douglas Burke dburke.gw@gmail.com
+#
+"""
+The thcompc convolution model.
+
+This is kept separate from the other models since it requires the
+sherpa_contrib package, which is only imported when the model is
+first used (via xspeclmodels.XSthcompc).
+
+"""
+
+import numpy as np
+
+from sherpa.models.parameter import Parameter
+from sherpa_contrib.xspec.xsmodels import XSConvolutionKernel
+
+from . import _models
+from . import _batch_pars, _instrumented
+
+__all__ = ('XSthcompc',)
+
+
+class XSthcompc(XSConvolutionKernel):
+    """The XSPEC thcompc model: Thermally comptonized continuum
+
+    For a description see [1]_.
+
+    .. warning::
+       This is a convolution kernel (that is, it modifies the spectrum
+       created by a model expression). This means that it is used
+       differently, and has seen *NO* testing. Note that Sherpa in
+       CIAO 4.12 has no "easy" way to extend the analysis grid
+       (although it can do so, this has not been tested with XSPEC
+       models).
+
+    Attributes
+    ----------
+    gamma_tau
+        >0: the low-energy power-law photon index;
+        <0: the Thomson optical depth (given by the absolute value).
+    kT_e
+        electron temperature (high energy rollover)
+    z
+
+    References
+    ----------
+
+    .. [1] https://github.com/HEASARC/xspec_localmodels/tree/master/thcompc
+
+    Examples
+    --------
+
+    As this is a convolution model, it needs to be applied to a model
+    expression, so we generate one using a powerlaw *just* for the example
+    (in actual use this is likely to be more complex).
+
+    >>> continuum = XSpowerlaw('continuum')
+    >>> cmdl = XSthcompc('comptonization')
+    >>> mdl = cmdl(continuum)
+
+    """
+
+    @_instrumented('thcompc',
+                   lambda mdl: _models.thcompf_thread_counts(),
+                   settings=lambda mdl: (_models.thcompf_grid_size(),),
+                   grid_arg=1)
+    def _calc(self, pars, fluxes, xlo, *args, **kwargs):
+        return _models.thcompf(pars, fluxes, xlo, *args, **kwargs)
+
+    def __init__(self, name='thcompc'):
+
+        self.gamma_tau = Parameter(name, 'gamma_tau', 1.7, 1.001, 5,
+                                   1.001, 10)
+        self.kT_e = Parameter(name, 'kT_e', 50, 0.5, 150, 0.5, 150,
+                              units='keV')
+        self.z = Parameter(name, 'z', 0.0, 0, 5, 0, 5,
+                           frozen=True)
+
+        pars = (self.gamma_tau, self.kT_e, self.z)
+        XSConvolutionKernel.__init__(self, name, pars)
+
+    def calc_batch(self, pars, fluxes, xlo, xhi=None, nthreads=1):
+        """Convolve fluxes for several sets of parameter values.
+
+        Parameters
+        ----------
+        pars : array_like
+            The parameter values, with shape (nsets, 3).
+        fluxes : array_like
+            The spectrum to convolve, evaluated on the grid. It
+            can be a 1D array, which is used for every parameter
+            set, or have shape (nsets, len(xlo)).
+        xlo : array_like
+            The grid, which must be contiguous.
+        xhi : array_like or None, optional
+            The upper edges of each bin.
+        nthreads : int, optional
+            The number of threads used to evaluate the parameter
+            sets. A value of 0 means use one thread per core.
+
+        Returns
+        -------
+        y : ndarray
+            The convolved spectra, with shape (nsets, len(xlo)).
+
+        """
+
+        return self._calc(_batch_pars(self, pars), fluxes, xlo, xhi,
+                          nthreads=nthreads)
+
+    def calc_seeds(self, fluxes, xlo, xhi=None, pars=None, nthreads=1):
+        """Convolve several seed spectra with the same parameters.
+
+        Parameters
+        ----------
+        fluxes : array_like
+            The spectra to convolve, with shape (nseeds, len(xlo)).
+        xlo : array_like
+            The grid, which must be contiguous.
+        xhi : array_like or None, optional
+            The upper edges of each bin.
+        pars : array_like or None, optional
+            The parameter values (gamma_tau, kT_e, z). If not set
+            then the current values of the model are used.
+        nthreads : int, optional
+            The number of threads used to evaluate the spectra. A
+            value of 0 means use one thread per core.
+
+        Returns
+        -------
+        y : ndarray
+            The convolved spectra, with shape (nseeds, len(xlo)).
+            Each row matches the result of convolving that spectrum
+            on its own.
+
+        """
+
+        if pars is None:
+            pars = [p.val for p in self.pars]
+
+        pars = np.asarray(pars, dtype=np.float64)
+        npars = len(self.pars)
+        if pars.shape != (npars,):
+            emsg = "pars must have shape ({},), not {}"
+            raise ValueError(emsg.format(npars, pars.shape))
+
+        fluxes = np.asarray(fluxes, dtype=np.float64)
+        if fluxes.ndim != 2:
+            emsg = "fluxes must have shape (nseeds, nbins), not {}"
+            raise ValueError(emsg.format(fluxes.shape))
+
+        return self._calc(pars, fluxes, xlo, xhi, nthreads=nthreads)
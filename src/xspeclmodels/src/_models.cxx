@@ -5,79 +5,1132 @@
 // Provide the Python interface to XSPEC local models using Sherpa.
 //
 // At present limited to:
-//     zkerrbb.cxx (which calls zrunkbb.f)
-//     agnslim.f
+//     zkerrbb.cxx (which uses zrunkbb.f to read the table)
+//     agnslim.cxx (which calls agnslim.f)
+//     th.f90
 //
 
+#include <algorithm>
+#include <atomic>
 #include <iostream>
+#include <sstream>
+#include <thread>
+#include <vector>
 
 #include <xsTypes.h>
+#include <XSFunctions/Utilities/FunctionUtility.h>
+#include <XSFunctions/Utilities/xsFortran.h>
 
 #include "sherpa/astro/xspec_extension.hh"
+#include "sherpa/fcmp.hh"
 
-// We need a wrapper to convert from the C++ interface to the C-style
-// interface (which is used by Sherpa). This code is taken from
-// the XSPEC wrappers it generates for functions:
-//  <heasoft>/Xspec/src/XSFunctions/funcWrappers.cxx
-//
-void cppModelWrapper(const double* energy, int nFlux, const double* params,
-        int spectrumNumber, double* flux, double* fluxError, const char* initStr,
-        int nPar, void (*cppFunc)(const RealArray&, const RealArray&,
-        int, RealArray&, RealArray&, const string&))
-{
-   // Assumes energy points to arrays of size nFlux+1, flux and fluxError
-   // point to arrays of size nFlux (though they need not be initialized),
-   // and params points to an array of size nPar.
-   RealArray energy_C(energy, (size_t)nFlux+1);
-   RealArray params_C(params, nPar);
-   RealArray flux_C(flux, (size_t)nFlux);
-   RealArray fluxError_C(fluxError, (size_t)nFlux);
-   string cppStr;
-   if(initStr && strlen(initStr))
-      cppStr = initStr;
-   (*cppFunc)(energy_C, params_C, spectrumNumber, flux_C, fluxError_C, cppStr);
-   for (int i=0; i<nFlux; ++i)
-   {
-      flux[i] = flux_C[i];
-   }
-   if (fluxError_C.size())
-   {
-      for (int i=0; i<nFlux; ++i)
-      {
-         fluxError[i] = fluxError_C[i];
+#include "agnslim.hh"
+#include "kerrbbtable.hh"
+#include "locking.hh"
+#include "thcomp.hh"
+#include "zkerrbb.hh"
+
+
+// The models are not wrapped with the Sherpa macros, since they can
+// be evaluated for several parameter sets in one call (and agnslim
+// has state), so the grid handling from Sherpa's XSPEC interface -
+// see create_grid and finalize_grid in
+// sherpa/astro/xspec_extension.hh - is repeated here:
+//
+//   - the model can be sent a single array of bin edges (in which
+//     case the last bin of the output is set to 0), or the low and
+//     high edges of each bin;
+//   - a grid in descending order is taken to be in Angstrom and is
+//     converted to keV;
+//   - if the low and high edges are not contiguous then a bin is
+//     added for each gap, and then removed from the output.
+//
+// The routines return false, with the Python error set, on failure.
+//
+
+// hc in keV Angstrom, using the values from sherpa/constants.hh.
+static const double HC_KEV_ANG = 4.135667662e-18 * 2.99792458e18;
+
+static bool create_grid(const DoubleArray& xlo, const DoubleArray& xhi,
+			std::vector<double>& ear,
+			std::vector<int>& gaps_index) {
+
+  int nelem = int( xlo.get_size() );
+  if ( nelem < 2 ) {
+    std::ostringstream err;
+    err << "input array must have at least 2 elements, found " << nelem;
+    PyErr_SetString( PyExc_TypeError, err.str().c_str() );
+    return false;
+  }
+
+  if ( xhi && (nelem != int( xhi.get_size() )) ) {
+    std::ostringstream err;
+    err << "input arrays are not the same size: " << nelem
+	<< " and " << int( xhi.get_size() );
+    PyErr_SetString( PyExc_TypeError, err.str().c_str() );
+    return false;
+  }
+
+  bool is_wave = (xlo[0] > xlo[nelem-1]) ? true : false;
+  const DoubleArray *x1 = (is_wave && xhi) ? &xhi : &xlo;
+  const DoubleArray *x2 = (is_wave && xhi) ? &xlo : &xhi;
+
+  std::vector<double> gaps_edges;
+  gaps_index.clear();
+  if ( xhi ) {
+    const int gap_found = is_wave ? 1 : -1;
+    for (int i = 0; i < nelem-1; i++) {
+      if ( sao_fcmp((*x2)[i], (*x1)[i+1], DBL_EPSILON) == gap_found ) {
+	gaps_index.push_back(i);
+	gaps_edges.push_back((*x2)[i]);
       }
-   }
+    }
+  }
+
+  int ngaps = (int) gaps_edges.size();
+  int ngrid = nelem;
+  if ( xhi )
+    ngrid += 1 + ngaps;
+
+  ear.assign(ngrid, 0);
+
+  int start = 0;
+  for (int j = 0; j < ngaps; j++) {
+    int end = gaps_index[j] + 1;
+    for (int i = start; i < end; i++) {
+      ear[i + j] = (*x1)[i];
+    }
+    ear[end + j] = gaps_edges[j];
+    start = end;
+  }
+
+  for (int i = start; i < nelem; i++) {
+    ear[i + ngaps] = (*x1)[i];
+  }
+
+  if ( xhi )
+    ear[ngrid - 1] = (*x2)[nelem - 1];
+
+  if ( is_wave ) {
+    for (int i = 0; i < ngrid; i++) {
+      if ( ear[i] <= 0.0 ) {
+	std::ostringstream err;
+	err << "Wavelength must be > 0, sent " << ear[i];
+	PyErr_SetString( PyExc_ValueError, err.str().c_str() );
+	return false;
+      }
+      ear[i] = HC_KEV_ANG / ear[i];
+    }
+  }
+
+  return true;
+
+} // create_grid
+
+
+// Copy the model output (evaluated on the grid from create_grid)
+// into the result, removing the bins added for any gaps. The result
+// has the same size as the input grid, which means that it has an
+// extra 0 value at the end when only one grid was given.
+//
+static void finalize_grid(const std::vector<double>& out,
+			  const std::vector<int>& gaps_index,
+			  double* result, int nelem) {
+
+  int nout = int( out.size() );
+  int ngaps = (int) gaps_index.size();
+
+  int j = 0;
+  int i = 0;
+  for (int k = 0; k < nout && i < nelem; k++) {
+    if ( (j < ngaps) && (k == gaps_index[j] + 1 + j) ) {
+      j++;
+      continue;
+    }
+    result[i++] = out[k];
+  }
+
+} // finalize_grid
+
+
+// Parse the optional xhi argument (which can be None).
+//
+static bool convert_xhi(PyObject* obj, DoubleArray& xhi) {
+  if ( (obj == NULL) || (obj == Py_None) )
+    return true;
+
+  return sherpa::convert_to_contig_array< DoubleArray >(obj, &xhi) == 1;
 }
 
-extern "C" {
 
-  void zkerrbb(const RealArray& energyArray, const RealArray& params,
-	       int spectrumNumber, RealArray& flux, RealArray& fluxErr,
-	       const string& initString);
+// Release a reference when it goes out of scope.
+//
+class PyRef {
+public:
+  explicit PyRef(PyObject* obj) : obj_(obj) { }
+  ~PyRef() { Py_XDECREF(obj_); }
 
-  void C_zkerrbb(const double* energy, int nFlux, const double* params,
-		 int spectrumNumber, double* flux, double* fluxError,
-		 const char* initStr) {
-    const size_t nPar = 9;
+  PyObject* get() const { return obj_; }
+  PyArrayObject* array() const { return (PyArrayObject*) obj_; }
 
-    cppModelWrapper(energy, nFlux, params, spectrumNumber, flux, fluxError,
-		    initStr, nPar, zkerrbb);
+  PyObject* release() {
+    PyObject* obj = obj_;
+    obj_ = NULL;
+    return obj;
   }
 
-  void agnslim_(float* ear, int* ne, float* param, int* ifl, float* photar, float* photer);
+private:
+  PyRef(const PyRef&);
+  PyRef& operator=(const PyRef&);
 
-  void thcompf_(float* ear, int* ne, float* param, int* ifl, float* photar, float* photer);
+  PyObject* obj_;
+};
+
+
+// The models can be evaluated for several parameter sets in one
+// call, which avoids the overhead of going through Python (and
+// re-creating the grid) for each set. The parameters are either a
+// 1D array, for a single set, or a 2D array with a row per set, in
+// which case the output is also 2D, with a row per set.
+//
+// The array is returned as a new reference, or NULL (with the
+// Python error set) if it is invalid.
+//
+static PyObject* convert_pars(PyObject* obj, npy_intp NumPars) {
+  PyObject* pars = PyArray_FROMANY(obj, NPY_DOUBLE, 1, 2, NPY_ARRAY_IN_ARRAY);
+  if ( pars == NULL )
+    return NULL;
+
+  PyArrayObject* arr = (PyArrayObject*) pars;
+  npy_intp npars = PyArray_DIM(arr, PyArray_NDIM(arr) - 1);
+  if ( npars != NumPars ) {
+    std::ostringstream err;
+    err << "expected " << NumPars << " parameters, got " << npars;
+    PyErr_SetString( PyExc_TypeError, err.str().c_str() );
+    Py_DECREF(pars);
+    return NULL;
+  }
+
+  return pars;
+}
+
+
+// Create the output array: nelem values for each parameter set.
+//
+static PyObject* create_output(bool batch, npy_intp nsets, npy_intp nelem) {
+  npy_intp dims[2] = { nsets, nelem };
+  if ( batch )
+    return PyArray_ZEROS(2, dims, NPY_DOUBLE, 0);
+
+  return PyArray_ZEROS(1, dims + 1, NPY_DOUBLE, 0);
+}
+
+
+// Was the FORTRAN code compiled with a flag that makes it re-entrant
+// (see FORTRANFLAGS in setup.py)? If not, run_sets refuses to use
+// more than one thread.
+//
+#ifdef XSPECLMODELS_FORTRAN_REENTRANT
+static const bool fortran_reentrant = true;
+#else
+static const bool fortran_reentrant = false;
+#endif
+
+
+// Call func(n), for n = 0 to nsets - 1, with the GIL released. The
+// parameter sets are shared between nthreads threads, where 0 means
+// use one thread per core (it must be 1 if the FORTRAN code is not
+// re-entrant). The return value is false, with the Python error set,
+// if any of the calls failed.
+//
+template <typename Func>
+static bool run_sets(const char* errmsg, npy_intp nsets, int nthreads,
+		     Func func) {
+
+  if ( nthreads < 0 ) {
+    PyErr_SetString( PyExc_ValueError, "nthreads must be >= 0" );
+    return false;
+  }
+
+  if ( !fortran_reentrant && (nthreads != 1) ) {
+    PyErr_SetString( PyExc_ValueError,
+		     "nthreads must be 1 as the FORTRAN code was not "
+		     "compiled to be re-entrant" );
+    return false;
+  }
+
+  if ( nthreads == 0 )
+    nthreads = std::max(1, int( std::thread::hardware_concurrency() ));
+
+  if ( nthreads > nsets )
+    nthreads = int( std::max(nsets, npy_intp(1)) );
+
+  // Each thread takes the next parameter set, so that the work is
+  // shared out even when the evaluation time varies with the
+  // parameter values.
+  std::atomic<npy_intp> next(0);
+  std::atomic<bool> failed(false);
+  auto worker = [&]() {
+    for (;;) {
+      npy_intp n = next++;
+      if ( (n >= nsets) || failed )
+	return;
+
+      try {
+	func(n);
+      } catch (...) {
+	failed = true;
+      }
+    }
+  };
+
+  Py_BEGIN_ALLOW_THREADS
+  std::vector<std::thread> threads;
+  try {
+    for (int i = 1; i < nthreads; i++) {
+      threads.emplace_back(worker);
+    }
+  } catch (...) {
+    // run with however many threads could be started
+  }
+
+  worker();
+  for (size_t i = 0; i < threads.size(); i++) {
+    threads[i].join();
+  }
+  Py_END_ALLOW_THREADS
+
+  if ( failed ) {
+    PyErr_SetString( PyExc_ValueError, errmsg );
+    return false;
+  }
+
+  return true;
 
 }
 
 
+// Additive models are evaluated by a function with this interface,
+// where params does not include the normalization and state is
+// specific to the model (it can be NULL).
+//
+typedef void (*AdditiveFunc)(void* state, const double* energy, int nFlux,
+			     const double* params, int spectrumNumber,
+			     double* flux);
+
+// Evaluate an additive model, with NumPars parameters (the last of
+// which is the normalization), for each parameter set, using
+// nthreads threads.
+//
+static PyObject* eval_additive(const char* name, AdditiveFunc func,
+			       void* state, npy_intp NumPars,
+			       PyObject* pars_obj, const DoubleArray& xlo,
+			       const DoubleArray& xhi, int spectrumNumber,
+			       int nthreads) {
+
+  PyRef pars(convert_pars(pars_obj, NumPars));
+  if ( !pars.get() )
+    return NULL;
+
+  std::vector<double> ear;
+  std::vector<int> gaps_index;
+  if ( !create_grid(xlo, xhi, ear, gaps_index) )
+    return NULL;
+
+  bool batch = PyArray_NDIM(pars.array()) == 2;
+  npy_intp nsets = batch ? PyArray_DIM(pars.array(), 0) : 1;
+  npy_intp nelem = xlo.get_size();
+
+  PyRef result(create_output(batch, nsets, nelem));
+  if ( !result.get() )
+    return NULL;
+
+  int npts = int( ear.size() ) - 1;
+
+  const double* pptr = (const double*) PyArray_DATA(pars.array());
+  double* rptr = (double*) PyArray_DATA(result.array());
+
+  // When there are no gaps the model can write directly into the
+  // result (any extra bin at the end is left as 0).
+  bool direct = gaps_index.empty();
+
+  auto eval = [&](npy_intp n) {
+    const double* setpars = pptr + n * NumPars;
+    double* setresult = rptr + n * nelem;
+
+    if ( direct ) {
+      func(state, &ear[0], npts, setpars, spectrumNumber, setresult);
+    } else {
+      std::vector<double> out(npts);
+      func(state, &ear[0], npts, setpars, spectrumNumber, &out[0]);
+      finalize_grid(out, gaps_index, setresult, int( nelem ));
+    }
+
+    double norm = setpars[NumPars - 1];
+    for (npy_intp i = 0; i < nelem; i++) {
+      setresult[i] *= norm;
+    }
+  };
+
+  std::ostringstream errmsg;
+  errmsg << name << " model evaluation failed";
+  if ( !run_sets(errmsg.str().c_str(), nsets, nthreads, eval) )
+    return NULL;
+
+  return result.release();
+
+}
+
+
+// The state for a model instance is stored in a capsule.
+//
+static const char* AGNSLIM_STATE = "xspeclmodels.agnslim_state";
+
+static void agnslim_state_destructor(PyObject* capsule) {
+  AgnslimState* state =
+    static_cast<AgnslimState*>(PyCapsule_GetPointer(capsule, AGNSLIM_STATE));
+  agnslim_state_free(state);
+}
+
+static PyObject* agnslim_state_fct(PyObject* self, PyObject* args) {
+  return PyCapsule_New(agnslim_state_new(), AGNSLIM_STATE,
+		       agnslim_state_destructor);
+}
+
+// Convert the state argument: None means use the default state.
+//
+static bool get_agnslim_state(PyObject* obj, AgnslimState** state) {
+  *state = NULL;
+  if ( (obj == NULL) || (obj == Py_None) )
+    return true;
+
+  *state = static_cast<AgnslimState*>(PyCapsule_GetPointer(obj,
+							   AGNSLIM_STATE));
+  return *state != NULL;
+}
+
+
+static void agnslim_additive(void* state, const double* energy, int nFlux,
+			     const double* params, int spectrumNumber,
+			     double* flux) {
+  agnslim_eval(static_cast<AgnslimState*>(state), energy, nFlux, params,
+	       spectrumNumber, flux);
+}
+
+// agnslim(pars, xlo, xhi=None, state=None, spectrumNumber=1, nthreads=1)
+//
+static PyObject* agnslim_fct(PyObject* self, PyObject* args, PyObject* kwds) {
+
+  static char *kwlist[] = {(char*)"pars", (char*)"xlo", (char*)"xhi",
+			   (char*)"state", (char*)"spectrumNumber",
+			   (char*)"nthreads", NULL};
+
+  DoubleArray xlo, xhi;
+  PyObject *pars_obj = NULL, *xhi_obj = NULL, *state_obj = NULL;
+  int spectrumNumber = 1;
+  int nthreads = 1;
+  if ( !PyArg_ParseTupleAndKeywords( args, kwds, (char*)"OO&|OOii", kwlist,
+				     &pars_obj,
+				     (converter)sherpa::convert_to_contig_array< DoubleArray >,
+				     &xlo,
+				     &xhi_obj, &state_obj, &spectrumNumber,
+				     &nthreads ) )
+    return NULL;
+
+  if ( !convert_xhi(xhi_obj, xhi) )
+    return NULL;
+
+  AgnslimState* state;
+  if ( !get_agnslim_state(state_obj, &state) )
+    return NULL;
+
+  return eval_additive("agnslim", agnslim_additive, state, 15,
+		       pars_obj, xlo, xhi, spectrumNumber, nthreads);
+
+}
+
+
+static const char* ZKERRBB_STATE = "xspeclmodels.zkerrbb_state";
+
+static void zkerrbb_state_destructor(PyObject* capsule) {
+  ZkerrbbState* state =
+    static_cast<ZkerrbbState*>(PyCapsule_GetPointer(capsule, ZKERRBB_STATE));
+  zkerrbb_state_free(state);
+}
+
+static PyObject* zkerrbb_state_fct(PyObject* self, PyObject* args) {
+  return PyCapsule_New(zkerrbb_state_new(), ZKERRBB_STATE,
+		       zkerrbb_state_destructor);
+}
+
+// Convert the state argument: None means use the default state.
+//
+static bool get_zkerrbb_state(PyObject* obj, ZkerrbbState** state) {
+  *state = NULL;
+  if ( (obj == NULL) || (obj == Py_None) )
+    return true;
+
+  *state = static_cast<ZkerrbbState*>(PyCapsule_GetPointer(obj,
+							   ZKERRBB_STATE));
+  return *state != NULL;
+}
+
+struct ZkerrbbArgs {
+  ZkerrbbState* state;
+  bool double_precision;
+};
+
+static void zkerrbb_additive(void* state, const double* energy, int nFlux,
+			     const double* params, int spectrumNumber,
+			     double* flux) {
+  ZkerrbbArgs* args = static_cast<ZkerrbbArgs*>(state);
+  zkerrbb_eval(args->state, energy, nFlux, params, flux,
+	       args->double_precision);
+}
+
+// C_zkerrbb(pars, xlo, xhi=None, state=None, spectrumNumber=1,
+//           nthreads=1, double_precision=False)
+//
+static PyObject* zkerrbb_fct(PyObject* self, PyObject* args, PyObject* kwds) {
+
+  static char *kwlist[] = {(char*)"pars", (char*)"xlo", (char*)"xhi",
+			   (char*)"state", (char*)"spectrumNumber",
+			   (char*)"nthreads", (char*)"double_precision", NULL};
+
+  DoubleArray xlo, xhi;
+  PyObject *pars_obj = NULL, *xhi_obj = NULL, *state_obj = NULL;
+  int spectrumNumber = 1;
+  int nthreads = 1;
+  int double_precision = 0;
+  if ( !PyArg_ParseTupleAndKeywords( args, kwds, (char*)"OO&|OOiip", kwlist,
+				     &pars_obj,
+				     (converter)sherpa::convert_to_contig_array< DoubleArray >,
+				     &xlo,
+				     &xhi_obj, &state_obj, &spectrumNumber,
+				     &nthreads, &double_precision ) )
+    return NULL;
+
+  if ( !convert_xhi(xhi_obj, xhi) )
+    return NULL;
+
+  ZkerrbbArgs zargs;
+  if ( !get_zkerrbb_state(state_obj, &zargs.state) )
+    return NULL;
+
+  zargs.double_precision = double_precision != 0;
+  return eval_additive("zkerrbb", zkerrbb_additive, &zargs, 10,
+		       pars_obj, xlo, xhi, spectrumNumber, nthreads);
+
+}
+
+
+// The operator cache hits and misses of the thcompf calls made by
+// each thread, so that a call can be profiled without counting the
+// calls made by other threads (which the cache totals include).
+//
+static thread_local size_t thcompf_thread_hits = 0;
+static thread_local size_t thcompf_thread_misses = 0;
+
+
+// thcompf(pars, fluxes, xlo, xhi=None, spectrumNumber=1, nthreads=1)
+//
+// The fluxes to be convolved can be a 1D array, in which case it is
+// used for every parameter set, or a 2D array with a row per set.
+// When there is a single parameter set and a 2D fluxes array, each
+// row is convolved with the same parameters (using thcomp_eval_many,
+// with the rows shared out between the threads in blocks).
+// As with Sherpa, the grid must be contiguous and the fluxes array
+// must match the size of xlo (even if xhi is not given).
+//
+static PyObject* thcompf_fct(PyObject* self, PyObject* args, PyObject* kwds) {
+
+  static const npy_intp NumPars = 3;
+  static const npy_intp SeedBlockSize = 64;
+
+  static char *kwlist[] = {(char*)"pars", (char*)"fluxes", (char*)"xlo",
+			   (char*)"xhi", (char*)"spectrumNumber",
+			   (char*)"nthreads", NULL};
+
+  DoubleArray xlo, xhi;
+  PyObject *pars_obj = NULL, *fluxes_obj = NULL, *xhi_obj = NULL;
+  int spectrumNumber = 1;
+  int nthreads = 1;
+  if ( !PyArg_ParseTupleAndKeywords( args, kwds, (char*)"OOO&|Oii", kwlist,
+				     &pars_obj, &fluxes_obj,
+				     (converter)sherpa::convert_to_contig_array< DoubleArray >,
+				     &xlo,
+				     &xhi_obj, &spectrumNumber, &nthreads ) )
+    return NULL;
+
+  if ( !convert_xhi(xhi_obj, xhi) )
+    return NULL;
+
+  PyRef pars(convert_pars(pars_obj, NumPars));
+  if ( !pars.get() )
+    return NULL;
+
+  PyRef fluxes(PyArray_FROMANY(fluxes_obj, NPY_DOUBLE, 1, 2,
+			       NPY_ARRAY_IN_ARRAY));
+  if ( !fluxes.get() )
+    return NULL;
+
+  std::vector<double> ear;
+  std::vector<int> gaps_index;
+  if ( !create_grid(xlo, xhi, ear, gaps_index) )
+    return NULL;
+
+  if ( !gaps_index.empty() ) {
+    PyErr_SetString( PyExc_ValueError,
+		     "XSPEC convolution model requires a contiguous grid" );
+    return NULL;
+  }
+
+  npy_intp nelem = xlo.get_size();
+  int fdim = PyArray_NDIM(fluxes.array());
+  npy_intp nflux = PyArray_DIM(fluxes.array(), fdim - 1);
+  if ( nelem != nflux ) {
+    std::ostringstream err;
+    err << "flux array does not match the input grid: " << nelem
+	<< " and " << nflux;
+    PyErr_SetString( PyExc_ValueError, err.str().c_str() );
+    return NULL;
+  }
+
+  bool pbatch = PyArray_NDIM(pars.array()) == 2;
+  bool fbatch = fdim == 2;
+  bool seeds = fbatch && !pbatch;
+  npy_intp nsets = pbatch ? PyArray_DIM(pars.array(), 0) :
+    (seeds ? PyArray_DIM(fluxes.array(), 0) : 1);
+  if ( fbatch && (PyArray_DIM(fluxes.array(), 0) != nsets) ) {
+    std::ostringstream err;
+    err << "expected " << nsets << " rows in the flux array, got "
+	<< PyArray_DIM(fluxes.array(), 0);
+    PyErr_SetString( PyExc_ValueError, err.str().c_str() );
+    return NULL;
+  }
+
+  PyRef result(create_output(pbatch || fbatch, nsets, nelem));
+  if ( !result.get() )
+    return NULL;
+
+  // The model is single precision.
+  int ngrid = int( ear.size() );
+  int npts = ngrid - 1;
+  std::vector<float> fear(ear.begin(), ear.end());
+
+  const double* pptr = (const double*) PyArray_DATA(pars.array());
+  const double* fptr = (const double*) PyArray_DATA(fluxes.array());
+  double* rptr = (double*) PyArray_DATA(result.array());
+
+  ThcompCounts counts;
+  auto add_counts = [&]() {
+    thcompf_thread_hits += counts.hits;
+    thcompf_thread_misses += counts.misses;
+  };
+
+  if ( seeds ) {
+    std::vector<float> fpars(pptr, pptr + NumPars);
+    auto eval = [&](npy_intp n) {
+      npy_intp start = n * SeedBlockSize;
+      npy_intp nrows = std::min(SeedBlockSize, nsets - start);
+      std::vector<float> photar(fptr + start * nelem,
+				fptr + (start + nrows) * nelem);
+
+      thcomp_eval_many(&fear[0], npts, &fpars[0], int( nrows ),
+		       &photar[0], &counts);
+
+      double* setresult = rptr + start * nelem;
+      for (npy_intp i = 0; i < nrows * nelem; i++) {
+	setresult[i] = photar[i];
+      }
+    };
+
+    npy_intp nblocks = (nsets + SeedBlockSize - 1) / SeedBlockSize;
+    bool okay = run_sets("XSPEC convolution model evaluation failed",
+			 nblocks, nthreads, eval);
+    add_counts();
+    if ( !okay )
+      return NULL;
+
+    return result.release();
+  }
+
+  auto eval = [&](npy_intp n) {
+    const double* setpars = pptr + n * NumPars;
+    const double* setflux = fbatch ? fptr + n * nelem : fptr;
+    double* setresult = rptr + n * nelem;
+
+    std::vector<float> fpars(setpars, setpars + NumPars);
+    std::vector<float> photar(setflux, setflux + nelem);
+
+    thcomp_eval(&fear[0], npts, &fpars[0], &photar[0], &counts);
+
+    for (npy_intp i = 0; i < nelem; i++) {
+      setresult[i] = photar[i];
+    }
+  };
+
+  bool okay = run_sets("XSPEC convolution model evaluation failed",
+		       nsets, nthreads, eval);
+  add_counts();
+  if ( !okay )
+    return NULL;
+
+  return result.release();
+
+}
+
+
+// Report on, and control, the cache used by agnslim. The optional
+// state argument restricts the call to a single model instance.
+//
+static PyObject* agnslim_cache_info_fct(PyObject* self, PyObject* args) {
+  PyObject* state_obj = NULL;
+  if ( !PyArg_ParseTuple(args, "|O", &state_obj) )
+    return NULL;
+
+  AgnslimState* state;
+  if ( !get_agnslim_state(state_obj, &state) )
+    return NULL;
+
+  AgnslimCacheInfo info = agnslim_cache_info(state);
+  return Py_BuildValue("(nnnn)",
+		       (Py_ssize_t) info.hits, (Py_ssize_t) info.misses,
+		       (Py_ssize_t) info.maxsize, (Py_ssize_t) info.currsize);
+}
+
+static PyObject* agnslim_structure_cache_info_fct(PyObject* self,
+						  PyObject* args) {
+  PyObject* state_obj = NULL;
+  if ( !PyArg_ParseTuple(args, "|O", &state_obj) )
+    return NULL;
+
+  AgnslimState* state;
+  if ( !get_agnslim_state(state_obj, &state) )
+    return NULL;
+
+  AgnslimCacheInfo info = agnslim_structure_cache_info(state);
+  return Py_BuildValue("(nnnn)",
+		       (Py_ssize_t) info.hits, (Py_ssize_t) info.misses,
+		       (Py_ssize_t) info.maxsize, (Py_ssize_t) info.currsize);
+}
+
+static PyObject* agnslim_shape_cache_info_fct(PyObject* self,
+					      PyObject* args) {
+  PyObject* state_obj = NULL;
+  if ( !PyArg_ParseTuple(args, "|O", &state_obj) )
+    return NULL;
+
+  AgnslimState* state;
+  if ( !get_agnslim_state(state_obj, &state) )
+    return NULL;
+
+  AgnslimCacheInfo info = agnslim_shape_cache_info(state);
+  return Py_BuildValue("(nnnn)",
+		       (Py_ssize_t) info.hits, (Py_ssize_t) info.misses,
+		       (Py_ssize_t) info.maxsize, (Py_ssize_t) info.currsize);
+}
+
+static PyObject* agnslim_rebin_cache_info_fct(PyObject* self) {
+  AgnslimCacheInfo info = agnslim_rebin_cache_info();
+  return Py_BuildValue("(nnnn)",
+		       (Py_ssize_t) info.hits, (Py_ssize_t) info.misses,
+		       (Py_ssize_t) info.maxsize, (Py_ssize_t) info.currsize);
+}
+
+static PyObject* agnslim_cache_clear_fct(PyObject* self, PyObject* args) {
+  PyObject* state_obj = NULL;
+  if ( !PyArg_ParseTuple(args, "|O", &state_obj) )
+    return NULL;
+
+  AgnslimState* state;
+  if ( !get_agnslim_state(state_obj, &state) )
+    return NULL;
+
+  agnslim_cache_clear(state);
+  Py_RETURN_NONE;
+}
+
+static PyObject* agnslim_cache_resize_fct(PyObject* self, PyObject* args) {
+  Py_ssize_t maxsize;
+  if (!PyArg_ParseTuple(args, "n", &maxsize))
+    return NULL;
+
+  if (maxsize < 0) {
+    PyErr_SetString(PyExc_ValueError, "maxsize must be >= 0");
+    return NULL;
+  }
+
+  agnslim_cache_resize((size_t) maxsize);
+  Py_RETURN_NONE;
+}
+
+
+// Report on the zkerrbb memo for a state (None means the default
+// state).
+//
+static PyObject* zkerrbb_memo_info_fct(PyObject* self, PyObject* args) {
+  PyObject* state_obj = NULL;
+  if ( !PyArg_ParseTuple(args, "|O", &state_obj) )
+    return NULL;
+
+  ZkerrbbState* state;
+  if ( !get_zkerrbb_state(state_obj, &state) )
+    return NULL;
+
+  size_t hits, misses;
+  zkerrbb_memo_info(state, &hits, &misses);
+  return Py_BuildValue("(nn)", (Py_ssize_t) hits, (Py_ssize_t) misses);
+}
+
+
+// zkerrbb_nearest(x, arr, double_precision=False)
+//
+// The index of the closest element of arr (ascending) to each x, as
+// found by the zkerrbb table searches. This is only used by the tests.
+//
+static PyObject* zkerrbb_nearest_fct(PyObject* self, PyObject* args,
+				     PyObject* kwds) {
+
+  static char *kwlist[] = {(char*)"x", (char*)"arr",
+			   (char*)"double_precision", NULL};
+
+  DoubleArray x, arr;
+  int double_precision = 0;
+  if ( !PyArg_ParseTupleAndKeywords( args, kwds, (char*)"O&O&|p", kwlist,
+				     (converter)sherpa::convert_to_contig_array< DoubleArray >,
+				     &x,
+				     (converter)sherpa::convert_to_contig_array< DoubleArray >,
+				     &arr,
+				     &double_precision ) )
+    return NULL;
+
+  if ( arr.get_size() < 1 ) {
+    PyErr_SetString( PyExc_ValueError, "arr must not be empty" );
+    return NULL;
+  }
+
+  npy_intp nx = x.get_size();
+  PyRef result(PyArray_ZEROS(1, &nx, NPY_INT, 0));
+  if ( !result.get() )
+    return NULL;
+
+  if ( nx > 0 )
+    zkerrbb_nearest(&x[0], int( nx ), &arr[0], int( arr.get_size() ),
+		    (int*) PyArray_DATA(result.array()),
+		    double_precision != 0);
+  return result.release();
+}
+
+
+// Load the kerrbb table used by zkerrbb (all four FLUX columns).
+// Returns the number of columns that could be loaded.
+//
+static PyObject* zkerrbb_preload_fct(PyObject* self) {
+  int nloaded;
+  Py_BEGIN_ALLOW_THREADS
+  nloaded = kerrbb_preload();
+  Py_END_ALLOW_THREADS
+  return Py_BuildValue("i", nloaded);
+}
+
+
+// The number of times the kerrbb FITS file has been read.
+//
+static PyObject* zkerrbb_table_reads_fct(PyObject* self) {
+  return Py_BuildValue("i", kerrbb_fits_reads());
+}
+
+
+// Report on, and change, the resolution used by agnslim. The state
+// argument is optional for agnslim_resolution, where None means
+// the default state. The nseed and rtol arguments are optional for
+// agnslim_set_resolution (they default to 0), so that settings saved
+// before they were added can still be used.
+//
+static PyObject* agnslim_resolution_fct(PyObject* self, PyObject* args) {
+  PyObject* state_obj = NULL;
+  if ( !PyArg_ParseTuple(args, "|O", &state_obj) )
+    return NULL;
+
+  AgnslimState* state;
+  if ( !get_agnslim_state(state_obj, &state) )
+    return NULL;
+
+  AgnslimResolution res = agnslim_get_resolution(state);
+  return Py_BuildValue("(iiiiiid)", res.nn, res.imax, res.ipow, res.icor,
+		       res.iout, res.nseed, res.rtol);
+}
+
+static PyObject* agnslim_set_resolution_fct(PyObject* self, PyObject* args) {
+  PyObject* state_obj = NULL;
+  AgnslimResolution res;
+  res.nseed = 0;
+  res.rtol = 0.0;
+  if ( !PyArg_ParseTuple(args, "Oiiiii|id", &state_obj, &res.nn, &res.imax,
+			 &res.ipow, &res.icor, &res.iout, &res.nseed,
+			 &res.rtol) )
+    return NULL;
+
+  AgnslimState* state;
+  if ( !get_agnslim_state(state_obj, &state) )
+    return NULL;
+
+  if ( (res.nn < 1) || (res.imax < 1) || (res.ipow < 1) ||
+       (res.icor < 1) || (res.iout < 1) ) {
+    PyErr_SetString(PyExc_ValueError,
+		    "the number of bins and zones must be >= 1");
+    return NULL;
+  }
+
+  if (res.nseed < 0) {
+    PyErr_SetString(PyExc_ValueError, "nseed must be >= 0");
+    return NULL;
+  }
+
+  // This also catches NaN.
+  if ( !(res.rtol >= 0.0) ) {
+    PyErr_SetString(PyExc_ValueError, "rtol must be >= 0");
+    return NULL;
+  }
+
+  agnslim_set_resolution(state, res);
+  Py_RETURN_NONE;
+}
+
+
+// The number of zones used by the last agnslim evaluation of a state
+// (None means the default state).
+//
+static PyObject* agnslim_zones_fct(PyObject* self, PyObject* args) {
+  PyObject* state_obj = NULL;
+  if ( !PyArg_ParseTuple(args, "|O", &state_obj) )
+    return NULL;
+
+  AgnslimState* state;
+  if ( !get_agnslim_state(state_obj, &state) )
+    return NULL;
+
+  int nz[3];
+  agnslim_get_zones(state, nz);
+  return Py_BuildValue("(iii)", nz[0], nz[1], nz[2]);
+}
+
+
+// The number of threads used by agnslim when built with OpenMP.
+//
+static PyObject* agnslim_threads_fct(PyObject* self) {
+  return Py_BuildValue("(Oi)", agnslim_has_openmp() ? Py_True : Py_False,
+		       agnslim_get_threads());
+}
+
+static PyObject* agnslim_set_threads_fct(PyObject* self, PyObject* args) {
+  int nthreads;
+  if ( !PyArg_ParseTuple(args, "i", &nthreads) )
+    return NULL;
+
+  if (nthreads < 0) {
+    PyErr_SetString(PyExc_ValueError, "nthreads must be >= 0");
+    return NULL;
+  }
+
+  agnslim_set_threads(nthreads);
+  Py_RETURN_NONE;
+}
+
+
+static PyObject* fortran_reentrant_fct(PyObject* self) {
+  return PyBool_FromLong(fortran_reentrant);
+}
+
+
+// Report on, and control, the cache of thcompf operators.
+//
+static PyObject* thcompf_cache_info_fct(PyObject* self) {
+  ThcompCacheInfo info = thcomp_cache_info();
+  return Py_BuildValue("(nnnn)",
+		       (Py_ssize_t) info.hits, (Py_ssize_t) info.misses,
+		       (Py_ssize_t) info.maxsize, (Py_ssize_t) info.currsize);
+}
+
+// The (hits, misses) counts for the thcompf calls made by the
+// current thread.
+//
+static PyObject* thcompf_thread_counts_fct(PyObject* self) {
+  return Py_BuildValue("(nn)",
+		       (Py_ssize_t) thcompf_thread_hits,
+		       (Py_ssize_t) thcompf_thread_misses);
+}
+
+static PyObject* thcompf_cache_clear_fct(PyObject* self) {
+  thcomp_cache_clear();
+  Py_RETURN_NONE;
+}
+
+static PyObject* thcompf_cache_resize_fct(PyObject* self, PyObject* args) {
+  Py_ssize_t maxsize;
+  if (!PyArg_ParseTuple(args, "n", &maxsize))
+    return NULL;
+
+  if (maxsize < 0) {
+    PyErr_SetString(PyExc_ValueError, "maxsize must be >= 0");
+    return NULL;
+  }
+
+  thcomp_cache_resize((size_t) maxsize);
+  Py_RETURN_NONE;
+}
+
+
+// The size of the internal grid used by thcompf (0 means the requested
+// grid is used). The Kompaneets solver needs a reasonable number of
+// bins, so small values are rejected.
+//
+static PyObject* thcompf_grid_size_fct(PyObject* self) {
+  return Py_BuildValue("i", thcomp_get_grid_size());
+}
+
+static PyObject* thcompf_set_grid_size_fct(PyObject* self, PyObject* args) {
+  int nbins;
+  if (!PyArg_ParseTuple(args, "i", &nbins))
+    return NULL;
+
+  if ((nbins != 0) && (nbins < 10)) {
+    PyErr_SetString(PyExc_ValueError, "nbins must be 0 or >= 10");
+    return NULL;
+  }
+
+  thcomp_set_grid_size(nbins);
+  Py_RETURN_NONE;
+}
+
+
+// Initialize the XSPEC model library. This is done by Sherpa when
+// xspeclmodels is imported, so it is only needed when the models are
+// used without Sherpa (e.g. when replaying a trace). The settings
+// match those used by Sherpa: the library is told to be quiet
+// (the initialization messages are hidden) and the cosmology is set
+// to H0=70, q0=0, lambda0=0.73.
+//
+static PyObject* initialize_fct(PyObject* self) {
+  static bool initialized = false;
+
+  std::lock_guard<XspecLock> guard(xspec_lock());
+  if (!initialized) {
+    std::ostringstream hidden;
+    std::streambuf* orig = std::cout.rdbuf(hidden.rdbuf());
+    FNINIT();
+    std::cout.rdbuf(orig);
+
+    FunctionUtility::xwriteChatter(0);
+    FunctionUtility::setH0(70.0);
+    FunctionUtility::setq0(0.0);
+    FunctionUtility::setlambda0(0.73);
+    initialized = true;
+  }
+
+  Py_RETURN_NONE;
+}
+
+
+// The cosmology used by the models (at present only zkerrbb).
+//
+static PyObject* cosmology_fct(PyObject* self) {
+  return Py_BuildValue("(ddd)", (double) FunctionUtility::getH0(),
+		       (double) FunctionUtility::getq0(),
+		       (double) FunctionUtility::getlambda0());
+}
+
+static PyObject* set_cosmology_fct(PyObject* self, PyObject* args) {
+  double H0, q0, lambda0;
+  if ( !PyArg_ParseTuple(args, "ddd", &H0, &q0, &lambda0) )
+    return NULL;
+
+  // The GIL is held, so the models - which read the cosmology with
+  // xspec_lock held - will not see a partial change.
+  FunctionUtility::setH0(H0);
+  FunctionUtility::setq0(q0);
+  FunctionUtility::setlambda0(lambda0);
+  Py_RETURN_NONE;
+}
+
+
 static PyMethodDef Wrappers[] = {
-  // remember, the number of parameters here is 1 + <value from lmodel.dat>
-  // for _NORM parameters.
-  //
-  XSPECMODELFCT_C_NORM( C_zkerrbb, 10 ),
-  XSPECMODELFCT_NORM( agnslim, 15 ),
-  XSPECMODELFCT_CON_F77( thcompf, 3 ),
+  { "C_zkerrbb", (PyCFunction)((PyCFunctionWithKeywords) zkerrbb_fct),
+    METH_VARARGS | METH_KEYWORDS,
+    "C_zkerrbb(pars, xlo, xhi=None, state=None, spectrumNumber=1, nthreads=1, double_precision=False)" },
+  { "zkerrbb_nearest", (PyCFunction)((PyCFunctionWithKeywords) zkerrbb_nearest_fct),
+    METH_VARARGS | METH_KEYWORDS,
+    "zkerrbb_nearest(x, arr, double_precision=False)" },
+  { "zkerrbb_memo_info", zkerrbb_memo_info_fct, METH_VARARGS,
+    "Return (hits, misses) for the zkerrbb interpolated-spectrum memo." },
+  { "zkerrbb_state", zkerrbb_state_fct, METH_NOARGS,
+    "Create the state for a zkerrbb instance." },
+  { "zkerrbb_preload", (PyCFunction) zkerrbb_preload_fct, METH_NOARGS,
+    "Load the kerrbb table, returning the number of FLUX columns read." },
+  { "zkerrbb_table_reads", (PyCFunction) zkerrbb_table_reads_fct,
+    METH_NOARGS,
+    "Return the number of times the kerrbb FITS file has been read." },
+  { "thcompf", (PyCFunction)((PyCFunctionWithKeywords) thcompf_fct),
+    METH_VARARGS | METH_KEYWORDS,
+    "thcompf(pars, fluxes, xlo, xhi=None, spectrumNumber=1, nthreads=1)" },
+  { "thcompf_cache_info", (PyCFunction) thcompf_cache_info_fct, METH_NOARGS,
+    "Return (hits, misses, maxsize, currsize) for the thcompf cache." },
+  { "thcompf_thread_counts", (PyCFunction) thcompf_thread_counts_fct,
+    METH_NOARGS,
+    "Return (hits, misses) for the thcompf calls made by this thread." },
+  { "thcompf_cache_clear", (PyCFunction) thcompf_cache_clear_fct,
+    METH_NOARGS,
+    "Clear the thcompf cache (and reset the statistics)." },
+  { "thcompf_cache_resize", thcompf_cache_resize_fct, METH_VARARGS,
+    "Change the maximum number of operators stored by the thcompf cache." },
+  { "thcompf_grid_size", (PyCFunction) thcompf_grid_size_fct, METH_NOARGS,
+    "Return the number of bins in the thcompf internal grid (0 if not used)." },
+  { "thcompf_set_grid_size", thcompf_set_grid_size_fct, METH_VARARGS,
+    "Set the number of bins in the thcompf internal grid (0 to turn off)." },
+
+  { "agnslim", (PyCFunction)((PyCFunctionWithKeywords) agnslim_fct),
+    METH_VARARGS | METH_KEYWORDS,
+    "agnslim(pars, xlo, xhi=None, state=None, spectrumNumber=1, nthreads=1)" },
+  { "agnslim_state", agnslim_state_fct, METH_NOARGS,
+    "Create the state (that is, the cache) for an agnslim instance." },
+
+  { "agnslim_cache_info", agnslim_cache_info_fct, METH_VARARGS,
+    "Return (hits, misses, maxsize, currsize) for the agnslim cache." },
+  { "agnslim_structure_cache_info", agnslim_structure_cache_info_fct,
+    METH_VARARGS,
+    "Return (hits, misses, maxsize, currsize) for the agnslim disc-structure cache." },
+  { "agnslim_rebin_cache_info", (PyCFunction) agnslim_rebin_cache_info_fct,
+    METH_NOARGS,
+    "Return (hits, misses, maxsize, currsize) for the agnslim rebinning cache." },
+  { "agnslim_shape_cache_info", agnslim_shape_cache_info_fct,
+    METH_VARARGS,
+    "Return (hits, misses, maxsize, currsize) for the agnslim nthcomp-shape cache." },
+  { "agnslim_cache_clear", agnslim_cache_clear_fct, METH_VARARGS,
+    "Clear the agnslim cache (and reset the statistics)." },
+  { "agnslim_cache_resize", agnslim_cache_resize_fct, METH_VARARGS,
+    "Change the maximum number of spectra stored by the agnslim cache." },
+
+  { "fortran_reentrant", (PyCFunction) fortran_reentrant_fct, METH_NOARGS,
+    "Can the models be evaluated with nthreads other than 1?" },
+  { "agnslim_threads", (PyCFunction) agnslim_threads_fct, METH_NOARGS,
+    "Return (openmp, nthreads) for the agnslim disc calculation." },
+  { "agnslim_set_threads", agnslim_set_threads_fct, METH_VARARGS,
+    "Set the number of OpenMP threads used by agnslim." },
+
+  { "agnslim_resolution", agnslim_resolution_fct, METH_VARARGS,
+    "Return (nn, imax, ipow, icor, iout, nseed, rtol) for an agnslim state." },
+  { "agnslim_set_resolution", agnslim_set_resolution_fct, METH_VARARGS,
+    "agnslim_set_resolution(state, nn, imax, ipow, icor, iout, nseed=0, rtol=0)" },
+  { "agnslim_zones", agnslim_zones_fct, METH_VARARGS,
+    "Return the (hot, warm, outer) zones used by the last agnslim evaluation." },
+
+  { "initialize", (PyCFunction) initialize_fct, METH_NOARGS,
+    "Initialize the XSPEC model library (only needed without Sherpa)." },
+  { "cosmology", (PyCFunction) cosmology_fct, METH_NOARGS,
+    "Return (H0, q0, lambda0) for the XSPEC model library." },
+  { "set_cosmology", set_cosmology_fct, METH_VARARGS,
+    "set_cosmology(H0, q0, lambda0)" },
 
   { NULL, NULL, 0, NULL }
 };
@@ -91,10 +1144,9 @@ static struct PyModuleDef wrapper_module = {
 };
 
 // Note that we are going to assume that the XSPEC model has
-// already been initialized. The XSPECMODELFCT_C macro/template
-// does not guarantee this (it does when building the Sherpa
-// XSPEC module, but not for external code, since INIT_XSPEC
-// may not be defined).
+// already been initialized. The wrappers do not guarantee this (and
+// nor does the XSPECMODELFCT_C macro/template for external code,
+// since INIT_XSPEC may not be defined).
 //
 PyMODINIT_FUNC PyInit__models(void) {
   import_array();
@@ -0,0 +1,953 @@
+//
+// This code is placed into the PUBLIC DOMAIN.
+// It was written by Douglas Burke dburke.gw@gmail.com
+//
+// The driver for the agnslim model. This replaces the agnslim
+// subroutine from the original FORTRAN code, which only remembered
+// the last set of parameters (in a SAVE block), so that evaluating
+// several datasets, or several agnslim components, would cause the
+// disc to be re-calculated on every call. Here the spectrum
+// calculated on the internal grid is stored in a LRU cache, keyed on
+// the model parameters and the internal grid. Each model instance
+// can have its own cache (see AgnslimState), and within that, each
+// spectrum number has its own cache.
+//
+// The disc structure (the radius and temperature of each radial
+// zone) only depends on a subset of the parameters, so it is cached
+// separately (one cache per state), and re-used when only the
+// Comptonisation parameters (or the distance, inclination, or
+// redshift) change.
+//
+// The distance and redshift are not part of the key for the spectrum
+// cache: the spectrum is stored in the rest frame, along with the
+// distance used to calculate it, and these parameters are applied
+// when the spectrum is rebinned onto the requested grid. This means
+// that changing them does not require the disc to be re-calculated
+// (the internal grid only depends on the redshift when the requested
+// grid extends beyond 1e-5 to 1e3 keV in the rest frame).
+//
+// The mapping from the internal grid (in the observed frame) onto
+// the requested grid, as calculated by inibin, does not change during
+// a fit, so it is stored - as a sparse matrix - in a LRU cache that is
+// shared by all the states, keyed on the internal grid, redshift, and
+// requested grid. This means that a spectrum found in the cache only
+// needs a sparse matrix-vector product to be returned.
+//
+// If the FORTRAN code was compiled with OpenMP support then the
+// radial zones in amydiskspec can be calculated in parallel (see
+// agnslim_set_threads).
+//
+// The caches are protected by a lock, and the calls to the XSPEC
+// library are serialized (see locking.hh), so the model can be
+// evaluated from several threads.
+//
+// The logic - and the use of single-precision values - follows the
+// original FORTRAN code:
+//
+//   - create a grid of nn bins, logarithmically spaced from
+//     newemin to newemax (which depend on the requested grid and
+//     the redshift);
+//   - call amydiskstruct to calculate the disc structure, and then
+//     amydiskspec to calculate the spectrum;
+//   - correct for the redshift;
+//   - rebin onto the requested grid (the sum over each output bin is
+//     done in double precision, so the result can differ from erebin
+//     by a relative amount of about 1e-7);
+//   - scale by the distance (if the cached spectrum was calculated
+//     for a different distance).
+//
+// The number of bins in the internal grid, and the number of radial
+// zones used by amydiskstruct, were fixed in the original code; they
+// can now be changed for each state (see AgnslimResolution).
+//
+// When the rtol resolution setting is not 0 the number of radial
+// zones is chosen adaptively: the contribution of each region (hot,
+// warm, and outer) is calculated separately, starting with the ipow,
+// icor, and iout zones, and the number of zones in a region is
+// doubled until the change in its contribution, relative to the total
+// spectrum, is less than rtol (or MAX_REFINE doublings have been
+// made). The zones in each region are independent of the number of
+// zones in the other regions, so only the regions that need it are
+// refined. The number of zones that were used is recorded for each
+// spectrum (see agnslim_get_zones).
+//
+// Each hot and warm zone requires a call to nthcomp over the internal
+// grid, and these calls dominate the run time (and are serialized).
+// Only the seed temperature changes between the zones of a region, so
+// when the nseed resolution setting is not 0 the Comptonised spectra
+// are calculated at seed temperatures of 10^(k/nseed) keV, for the k
+// values that cover the zones, and amydiskspec interpolates between
+// them. These shapes are normalized (amydiskspec re-normalizes each
+// zone anyway) and cached per state, keyed on the photon index,
+// electron temperature, internal grid, and k, so that they can be
+// re-used when only the disc parameters change. A region is not
+// tabulated if it would need as many nodes as it has zones.
+//
+
+#include <algorithm>
+#include <atomic>
+#include <cmath>
+#include <map>
+#include <mutex>
+#include <set>
+#include <tuple>
+#include <vector>
+
+#include "agnslim.hh"
+#include "locking.hh"
+#include "lrucache.hh"
+
+extern "C" {
+
+  void amydiskstruct_(float* param, int* nzone, double* rz, double* drz,
+		      double* tz, int* nz, double* rlim);
+
+  void amydiskspec_(float* ear, int* ne, float* param, int* ifl,
+		    float* photar, double* rz, double* drz, double* tz,
+		    int* nz, double* rlim, int* nthr, int* nseed,
+		    float* htab, int* nhtab, int* hk0,
+		    float* ltab, int* nltab, int* lk0);
+
+  void lkdonthcomp_(float* ear, int* ne, float* param, int* ifl,
+		    float* photar, float* photer);
+
+  int amydiskomp_();
+
+  void inibin_(int* nin, float* ein, int* nout, float* eout,
+	       int* istart, int* iend, float* fstart, float* fend,
+	       float* fuzzy);
+
+}
+
+// The number of parameters (excluding the normalization).
+//
+static const int NPAR = 14;
+
+// The distance and redshift parameters.
+//
+static const int DIST_PAR = 1;
+static const int KTE_HOT_PAR = 5;
+static const int KTE_WARM_PAR = 6;
+static const int GAMMA_HOT_PAR = 7;
+static const int GAMMA_WARM_PAR = 8;
+static const int REDSHIFT_PAR = 13;
+
+// The parameters that the disc structure depends on: mass, logmdot,
+// astar, R_hot, R_warm, logrout, and rin.
+//
+static const int STRUCTURE_PARS[] = {0, 2, 3, 9, 10, 11, 12};
+static const int NSTRUCTURE = 7;
+
+// The default resolution, taken from the original FORTRAN code.
+//
+static const AgnslimResolution DEFAULT_RESOLUTION = {5000, 2000, 100, 10, 1000, 0, 0.0};
+
+// The default number of spectra to cache; each entry requires
+// about 40 kB (for the default resolution).
+//
+static const size_t DEFAULT_CACHE_SIZE = 16;
+
+// The number of tabulated nthcomp shapes to cache per state; each
+// entry requires about 20 kB (for the default resolution).
+//
+static const size_t SHAPE_CACHE_SIZE = 256;
+
+// The number of rebinning maps to cache (for all states).
+//
+static const size_t REBIN_CACHE_SIZE = 8;
+
+// The maximum number of times the zones of a region are doubled in
+// the adaptive calculation.
+//
+static const int MAX_REFINE = 5;
+
+// When checking whether the adaptive calculation has converged, bins
+// fainter than this fraction of the peak are compared to this level.
+//
+static const double ADAPTIVE_FLOOR = 1.0e-3;
+
+// The spectrum on the internal grid, in the rest frame, the
+// distance it was calculated for, and the number of zones used in
+// the hot, warm, and outer regions.
+//
+struct AgnslimSpectrum {
+  std::vector<float> e;
+  std::vector<float> ph;
+  float dist;
+  int nz[3];
+};
+
+// The key is the parameter values (excluding the distance and
+// redshift) followed by the limits of the internal grid and the
+// resolution settings (which is enough to define the grid).
+//
+typedef std::vector<float> AgnslimKey;
+typedef LRUCache<AgnslimKey, AgnslimSpectrum> AgnslimCache;
+
+// The disc structure, as calculated by amydiskstruct: the radius,
+// width, and temperature of each radial zone, the number of zones
+// in each region, and the inner radius and outer radius of the warm
+// region. The key is the STRUCTURE_PARS parameter values followed by
+// the number of radial zones.
+//
+struct AgnslimStructure {
+  std::vector<double> r;
+  std::vector<double> dr;
+  std::vector<double> t;
+  int nz[3];
+  double rlim[2];
+};
+
+typedef LRUCache<AgnslimKey, AgnslimStructure> AgnslimStructureCache;
+
+// The nthcomp spectrum for a single seed temperature, normalized to
+// unit energy flux. The key is the photon index, electron temperature,
+// the limits and size of the internal grid, nseed, and k.
+//
+typedef LRUCache<AgnslimKey, std::vector<float> > AgnslimShapeCache;
+
+// The rebinning of the internal grid onto the requested grid, in
+// compressed-row form: output bin i is the sum of weight[k] times
+// the internal bin col[k], for k from row[i] to row[i + 1] - 1. The
+// key is the size and limits of the internal grid and the redshift
+// (which define the internal grid in the observed frame) followed by
+// the requested grid.
+//
+struct AgnslimRebin {
+  std::vector<int> row;
+  std::vector<int> col;
+  std::vector<float> weight;
+};
+
+typedef LRUCache<AgnslimKey, AgnslimRebin> AgnslimRebinCache;
+
+// NaN values can not be used in a key (the caches are ordered), so
+// the caches are not used when any element is NaN.
+//
+static bool valid_key(const AgnslimKey& key) {
+  for (size_t i = 0; i < key.size(); i++) {
+    if (key[i] != key[i])
+      return false;
+  }
+  return true;
+}
+
+// The number of threads used by amydiskspec. It is not part of the
+// cache key since it does not (significantly) change the result.
+//
+static std::atomic<int> agnslim_nthreads(1);
+
+// The maximum size of each cache.
+//
+static size_t agnslim_cache_maxsize = DEFAULT_CACHE_SIZE;
+
+// This protects the maximum size, the list of states, and the
+// caches and resolution settings they contain.
+//
+static std::mutex agnslim_mutex;
+
+// Each state has a cache per spectrum number, so that a model that
+// is used for several datasets does not have to share a cache, and
+// a single cache of disc structures. The number of zones used by
+// the last evaluation is also recorded.
+//
+class AgnslimState {
+public:
+
+  AgnslimState();
+  ~AgnslimState();
+
+  AgnslimCache& cache(int spectrumNumber) {
+    std::map<int, AgnslimCache>::iterator it = caches.find(spectrumNumber);
+    if (it == caches.end()) {
+      it = caches.emplace(std::piecewise_construct,
+			  std::forward_as_tuple(spectrumNumber),
+			  std::forward_as_tuple(agnslim_cache_maxsize)).first;
+    }
+    return it->second;
+  }
+
+  std::map<int, AgnslimCache> caches;
+  AgnslimStructureCache structures;
+  AgnslimShapeCache shapes;
+  AgnslimResolution resolution;
+  int zones[3];
+
+};
+
+// Track all the states so that the cache size can be changed, and
+// the statistics reported, for all of them.
+//
+static std::set<AgnslimState*> agnslim_states;
+
+// The rebinning maps are not specific to a state, since the requested
+// grid is normally the same for all the model instances.
+//
+static AgnslimRebinCache agnslim_rebin_cache(REBIN_CACHE_SIZE);
+
+AgnslimState::AgnslimState()
+  : structures(DEFAULT_CACHE_SIZE), shapes(SHAPE_CACHE_SIZE),
+    resolution(DEFAULT_RESOLUTION) {
+  zones[0] = zones[1] = zones[2] = 0;
+  std::lock_guard<std::mutex> guard(agnslim_mutex);
+  structures.resize(agnslim_cache_maxsize);
+  agnslim_states.insert(this);
+}
+
+AgnslimState::~AgnslimState() {
+  std::lock_guard<std::mutex> guard(agnslim_mutex);
+  agnslim_states.erase(this);
+}
+
+static AgnslimState default_state;
+
+
+static AgnslimStructureCache::ValuePtr
+calc_structure(float* param, const AgnslimResolution& res) {
+
+  AgnslimStructure* st = new AgnslimStructure();
+  AgnslimStructureCache::ValuePtr out(st);
+
+  size_t nr = res.ipow + res.icor + res.iout;
+  st->r.resize(nr);
+  st->dr.resize(nr);
+  st->t.resize(nr);
+
+  int nzone[4] = {res.imax, res.ipow, res.icor, res.iout};
+  amydiskstruct_(param, nzone, &st->r[0], &st->dr[0], &st->t[0],
+		 st->nz, st->rlim);
+  return out;
+}
+
+
+// Return the disc structure for the number of zones given by res,
+// using the cache of the state.
+//
+static AgnslimStructureCache::ValuePtr
+find_structure(AgnslimState* state, float* param,
+	       const AgnslimResolution& res) {
+
+  AgnslimKey skey;
+  for (int i = 0; i < NSTRUCTURE; i++) {
+    skey.push_back(param[STRUCTURE_PARS[i]]);
+  }
+  skey.push_back(res.imax);
+  skey.push_back(res.ipow);
+  skey.push_back(res.icor);
+  skey.push_back(res.iout);
+
+  bool use_cache = valid_key(skey);
+  AgnslimStructureCache::ValuePtr structure;
+  if (use_cache) {
+    std::lock_guard<std::mutex> guard(agnslim_mutex);
+    structure = state->structures.get(skey);
+  }
+
+  if (!structure) {
+    structure = calc_structure(param, res);
+    if (use_cache) {
+      std::lock_guard<std::mutex> guard(agnslim_mutex);
+      state->structures.put(skey, structure);
+    }
+  }
+
+  return structure;
+}
+
+
+// The nthcomp spectra for the zones from first to first+nzone-1,
+// tabulated at the seed temperatures 10^(k/nseed) keV, for
+// k = k0, ..., k0 + ntab - 1, and stored in tab (ntab * nn values).
+// ntab is set to 0 if the region is empty, or tabulating it would
+// need as many calls to nthcomp as calculating each zone.
+//
+static void
+calc_seed_table(AgnslimState* state, std::vector<float>& e,
+		float gamma, float kte, int nseed,
+		const AgnslimStructure& st, int first, int nzone,
+		std::vector<float>& tab, int& ntab, int& k0) {
+
+  ntab = 0;
+  k0 = 0;
+  tab.clear();
+  if ((nseed <= 0) || (nzone <= 0))
+    return;
+
+  double tmin = st.t[first];
+  double tmax = st.t[first];
+  for (int i = first + 1; i < first + nzone; i++) {
+    tmin = std::min(tmin, st.t[i]);
+    tmax = std::max(tmax, st.t[i]);
+  }
+
+  if (!(tmin > 0.0))
+    return;
+
+  int kmin = static_cast<int>(std::floor(nseed * std::log10(tmin)));
+  int kmax = static_cast<int>(std::ceil(nseed * std::log10(tmax)));
+  int nk = kmax - kmin + 1;
+  if (nk >= nzone)
+    return;
+
+  int nn = static_cast<int>(e.size()) - 1;
+  tab.resize(size_t(nn) * nk);
+
+  AgnslimKey key;
+  key.push_back(gamma);
+  key.push_back(kte);
+  key.push_back(e[0]);
+  key.push_back(e[nn]);
+  key.push_back(nn);
+  key.push_back(nseed);
+  key.push_back(0);
+
+  bool use_cache = valid_key(key);
+  std::vector<float> photer(nn);
+  for (int j = 0; j < nk; j++) {
+    int k = kmin + j;
+    key.back() = k;
+
+    AgnslimShapeCache::ValuePtr shape;
+    if (use_cache) {
+      std::lock_guard<std::mutex> guard(agnslim_mutex);
+      shape = state->shapes.get(key);
+    }
+
+    if (!shape) {
+      std::vector<float>* ph = new std::vector<float>(nn);
+      shape.reset(ph);
+
+      float tseed = static_cast<float>(std::pow(10.0, double(k) / nseed));
+      float par[5] = {gamma, kte, tseed, 0.0f, 0.0f};
+      int ifl = 1;
+      lkdonthcomp_(&e[0], &nn, par, &ifl, &(*ph)[0], &photer[0]);
+
+      // Use the same normalization as amydiskspec (apart from the
+      // constants), which over-writes it.
+      double norm = 0.0;
+      for (int n = 0; n < nn; n++) {
+	norm += (*ph)[n] * e[n + 1];
+      }
+      if (norm != 0.0) {
+	for (int n = 0; n < nn; n++) {
+	  (*ph)[n] = static_cast<float>((*ph)[n] / norm);
+	}
+      }
+
+      if (use_cache) {
+	std::lock_guard<std::mutex> guard(agnslim_mutex);
+	state->shapes.put(key, shape);
+      }
+    }
+
+    std::copy(shape->begin(), shape->end(), tab.begin() + size_t(nn) * j);
+  }
+
+  ntab = nk;
+  k0 = kmin;
+}
+
+
+// Calculate the spectrum, on the grid e, from the zones of a single
+// region of the disc (0 for hot, 1 for warm, and 2 for the outer
+// disc), or from all the zones when region is -1.
+//
+static void
+calc_zones(AgnslimState* state, float* param, std::vector<float>& e,
+	   int nseed, AgnslimStructureCache::ValuePtr structure,
+	   int region, std::vector<float>& ph) {
+
+  // The structure is not changed by amydiskspec (so it can be shared
+  // by several threads), but the FORTRAN interface does not say so.
+  AgnslimStructure& st = const_cast<AgnslimStructure&>(*structure);
+
+  // amydiskspec is sent the zones of the selected region, with the
+  // other regions marked as empty.
+  int nz[3];
+  int first = 0;
+  for (int j = 0; j < 3; j++) {
+    if ((region < 0) || (region == j)) {
+      nz[j] = st.nz[j];
+    } else {
+      nz[j] = 0;
+      if (j < region)
+	first += st.nz[j];
+    }
+  }
+
+  // The FORTRAN code requires valid arrays even when there is no
+  // table.
+  std::vector<float> htab, ltab;
+  int nhtab, hk0, nltab, lk0;
+  calc_seed_table(state, e, std::abs(param[GAMMA_HOT_PAR]),
+		  std::abs(param[KTE_HOT_PAR]), nseed, st, first, nz[0],
+		  htab, nhtab, hk0);
+  calc_seed_table(state, e, std::abs(param[GAMMA_WARM_PAR]),
+		  std::abs(param[KTE_WARM_PAR]), nseed, st, first + nz[0],
+		  nz[1], ltab, nltab, lk0);
+  if (htab.empty())
+    htab.resize(1);
+  if (ltab.empty())
+    ltab.resize(1);
+
+  int nn = static_cast<int>(e.size()) - 1;
+  ph.resize(nn);
+
+  int ifl = 1;
+  int nthr = agnslim_nthreads;
+  amydiskspec_(&e[0], &nn, param, &ifl, &ph[0], &st.r[0] + first,
+	       &st.dr[0] + first, &st.t[0] + first, nz, st.rlim, &nthr,
+	       &nseed, &htab[0], &nhtab, &hk0, &ltab[0], &nltab, &lk0);
+}
+
+
+// The adaptive calculation: each region starts with the number of
+// zones given by res, and is refined until the change in its
+// contribution is within res.rtol of the total spectrum.
+//
+static void
+calc_adaptive(AgnslimState* state, float* param, std::vector<float>& e,
+	      const AgnslimResolution& res, std::vector<float>& ph,
+	      int* nz) {
+
+  int nn = static_cast<int>(e.size()) - 1;
+  std::vector<float> regions[3];
+  bool done[3];
+
+  AgnslimResolution lres = res;
+  AgnslimStructureCache::ValuePtr structure =
+    find_structure(state, param, lres);
+  for (int j = 0; j < 3; j++) {
+    calc_zones(state, param, e, res.nseed, structure, j, regions[j]);
+    nz[j] = structure->nz[j];
+    done[j] = nz[j] == 0;
+  }
+
+  std::vector<double> total(nn);
+  for (int n = 0; n < nn; n++) {
+    total[n] = double(regions[0][n]) + regions[1][n] + regions[2][n];
+  }
+
+  std::vector<float> next;
+  for (int level = 1; level <= MAX_REFINE; level++) {
+    if (done[0] && done[1] && done[2])
+      break;
+
+    lres.ipow *= 2;
+    lres.icor *= 2;
+    lres.iout *= 2;
+    structure = find_structure(state, param, lres);
+
+    for (int j = 0; j < 3; j++) {
+      if (done[j])
+	continue;
+
+      calc_zones(state, param, e, res.nseed, structure, j, next);
+
+      double peak = 0.0;
+      for (int n = 0; n < nn; n++) {
+	total[n] += double(next[n]) - regions[j][n];
+	peak = std::max(peak, total[n]);
+      }
+
+      double err = 0.0;
+      for (int n = 0; n < nn; n++) {
+	double scale = std::max(total[n], ADAPTIVE_FLOOR * peak);
+	if (scale > 0.0) {
+	  double diff = std::abs(double(next[n]) - regions[j][n]);
+	  err = std::max(err, diff / scale);
+	}
+      }
+
+      regions[j].swap(next);
+      nz[j] = structure->nz[j];
+      done[j] = err <= res.rtol;
+    }
+  }
+
+  ph.resize(nn);
+  for (int n = 0; n < nn; n++) {
+    ph[n] = static_cast<float>(total[n]);
+  }
+}
+
+
+static AgnslimCache::ValuePtr
+calc_spectrum(AgnslimState* state, float* param,
+	      float newemin, float newemax,
+	      const AgnslimResolution& res) {
+
+  AgnslimSpectrum* spec = new AgnslimSpectrum();
+  AgnslimCache::ValuePtr out(spec);
+
+  std::vector<float>& e = spec->e;
+  int nn = res.nn;
+  e.resize(nn + 1);
+
+  float dloge = std::log10(newemax / newemin) / float(nn);
+  e[0] = newemin;
+  for (int n = 1; n <= nn; n++) {
+    e[n] = std::pow(10.0f, std::log10(e[0]) + dloge * float(n));
+  }
+
+  if (res.rtol > 0.0) {
+    calc_adaptive(state, param, e, res, spec->ph, spec->nz);
+  } else {
+    AgnslimStructureCache::ValuePtr structure =
+      find_structure(state, param, res);
+    calc_zones(state, param, e, res.nseed, structure, -1, spec->ph);
+    std::copy(structure->nz, structure->nz + 3, spec->nz);
+  }
+
+  spec->dist = param[DIST_PAR];
+  return out;
+}
+
+
+// Convert the inibin output into a sparse matrix, using the same
+// scheme as erebin: the first and last bins are weighted by fstart
+// and fend, the bins between them are included in full, and only
+// fstart is used when the output bin falls within a single bin.
+//
+static AgnslimRebinCache::ValuePtr
+calc_rebin(const std::vector<float>& spec_e, float zfac,
+	   std::vector<float>& ear) {
+
+  AgnslimRebin* map = new AgnslimRebin();
+  AgnslimRebinCache::ValuePtr out(map);
+
+  int nn = static_cast<int>(spec_e.size()) - 1;
+  int ne = static_cast<int>(ear.size()) - 1;
+
+  std::vector<float> e(spec_e);
+  for (int n = 0; n <= nn; n++) {
+    e[n] /= zfac;
+  }
+
+  std::vector<int> istart(ne), iend(ne);
+  std::vector<float> fstart(ne), fend(ne);
+  float fuzzy = 0.0f;
+  {
+    std::lock_guard<XspecLock> guard(xspec_lock());
+    inibin_(&nn, &e[0], &ne, &ear[0], &istart[0], &iend[0],
+	    &fstart[0], &fend[0], &fuzzy);
+  }
+
+  map->row.resize(ne + 1);
+  map->row[0] = 0;
+  for (int i = 0; i < ne; i++) {
+    // istart and iend count from 1, with 0 meaning no overlap.
+    if (istart[i] > 0) {
+      map->col.push_back(istart[i] - 1);
+      map->weight.push_back(fstart[i]);
+      if (iend[i] > istart[i]) {
+	for (int j = istart[i]; j < iend[i] - 1; j++) {
+	  map->col.push_back(j);
+	  map->weight.push_back(1.0f);
+	}
+	map->col.push_back(iend[i] - 1);
+	map->weight.push_back(fend[i]);
+      }
+    }
+    map->row[i + 1] = static_cast<int>(map->col.size());
+  }
+
+  return out;
+}
+
+
+void agnslim_eval(AgnslimState* state, const double* energy, int nFlux,
+		  const double* params, int spectrumNumber, double* flux) {
+
+  if (state == NULL)
+    state = &default_state;
+
+  int ne = nFlux;
+  std::vector<float> ear(energy, energy + ne + 1);
+
+  float param[NPAR];
+  for (int i = 0; i < NPAR; i++) {
+    param[i] = static_cast<float>(params[i]);
+  }
+
+  float zfac = 1.0f + param[REDSHIFT_PAR];
+
+  // the limits of the internal energy grid
+  float newemin, newemax;
+  if ((ear[0] == 0.0f) && (ne > 1)) {
+    newemin = ear[1] - (ear[2] - ear[1]) / 10.0f;
+  } else {
+    newemin = std::min(1.0e-5f, ear[0] * zfac);
+  }
+  newemax = std::max(1.0e3f, ear[ne] * zfac);
+
+  AgnslimKey key;
+  for (int i = 0; i < NPAR; i++) {
+    if ((i != DIST_PAR) && (i != REDSHIFT_PAR))
+      key.push_back(param[i]);
+  }
+  key.push_back(newemin);
+  key.push_back(newemax);
+
+  // The lock is not held while the spectrum is calculated, so two
+  // threads may end up calculating the same spectrum.
+  AgnslimCache::ValuePtr spec;
+  AgnslimResolution res;
+  bool use_cache;
+  {
+    std::lock_guard<std::mutex> guard(agnslim_mutex);
+    res = state->resolution;
+    key.push_back(res.nn);
+    key.push_back(res.imax);
+    key.push_back(res.ipow);
+    key.push_back(res.icor);
+    key.push_back(res.iout);
+    key.push_back(res.nseed);
+    key.push_back(res.rtol);
+    use_cache = valid_key(key);
+    if (use_cache)
+      spec = state->cache(spectrumNumber).get(key);
+    if (spec)
+      std::copy(spec->nz, spec->nz + 3, state->zones);
+  }
+
+  if (!spec) {
+    spec = calc_spectrum(state, param, newemin, newemax, res);
+    std::lock_guard<std::mutex> guard(agnslim_mutex);
+    if (use_cache)
+      state->cache(spectrumNumber).put(key, spec);
+    std::copy(spec->nz, spec->nz + 3, state->zones);
+  }
+
+  // rebin the calculated fluxes back onto original energy grid,
+  // correcting for the redshift
+  AgnslimKey rkey;
+  rkey.push_back(res.nn);
+  rkey.push_back(newemin);
+  rkey.push_back(newemax);
+  rkey.push_back(zfac);
+  rkey.insert(rkey.end(), ear.begin(), ear.end());
+
+  use_cache = valid_key(rkey);
+  AgnslimRebinCache::ValuePtr map;
+  if (use_cache) {
+    std::lock_guard<std::mutex> guard(agnslim_mutex);
+    map = agnslim_rebin_cache.get(rkey);
+  }
+
+  if (!map) {
+    map = calc_rebin(spec->e, zfac, ear);
+    if (use_cache) {
+      std::lock_guard<std::mutex> guard(agnslim_mutex);
+      agnslim_rebin_cache.put(rkey, map);
+    }
+  }
+
+  std::vector<float> photar(ne);
+  const std::vector<float>& ph = spec->ph;
+  for (int i = 0; i < ne; i++) {
+    double sum = 0.0;
+    for (int k = map->row[i]; k < map->row[i + 1]; k++) {
+      sum += double(map->weight[k]) * ph[map->col[k]];
+    }
+    photar[i] = static_cast<float>(sum / zfac);
+  }
+
+  // The flux scales as the inverse square of the distance (the
+  // scaling is skipped when the distance matches, so that the result
+  // is the same as the original code).
+  float dist = param[DIST_PAR];
+  if (spec->dist == dist) {
+    for (int i = 0; i < ne; i++) {
+      flux[i] = photar[i];
+    }
+  } else {
+    double scale = double(spec->dist) / double(dist);
+    scale *= scale;
+    for (int i = 0; i < ne; i++) {
+      flux[i] = photar[i] * scale;
+    }
+  }
+
+}
+
+
+extern "C"
+void C_agnslim(const double* energy, int nFlux, const double* params,
+	       int spectrumNumber, double* flux, double* fluxError,
+	       const char* initStr) {
+
+  agnslim_eval(NULL, energy, nFlux, params, spectrumNumber, flux);
+  for (int i = 0; i < nFlux; i++) {
+    fluxError[i] = 0.0;
+  }
+
+}
+
+
+AgnslimState* agnslim_state_new() {
+  return new AgnslimState();
+}
+
+void agnslim_state_free(AgnslimState* state) {
+  delete state;
+}
+
+
+AgnslimResolution agnslim_default_resolution() {
+  return DEFAULT_RESOLUTION;
+}
+
+AgnslimResolution agnslim_get_resolution(const AgnslimState* state) {
+  if (state == NULL)
+    state = &default_state;
+
+  std::lock_guard<std::mutex> guard(agnslim_mutex);
+  return state->resolution;
+}
+
+void agnslim_set_resolution(AgnslimState* state, const AgnslimResolution& res) {
+  if (state == NULL)
+    state = &default_state;
+
+  std::lock_guard<std::mutex> guard(agnslim_mutex);
+  state->resolution = res;
+}
+
+
+void agnslim_get_zones(const AgnslimState* state, int* nz) {
+  if (state == NULL)
+    state = &default_state;
+
+  std::lock_guard<std::mutex> guard(agnslim_mutex);
+  std::copy(state->zones, state->zones + 3, nz);
+}
+
+
+bool agnslim_has_openmp() {
+  return amydiskomp_() != 0;
+}
+
+int agnslim_get_threads() {
+  return agnslim_nthreads;
+}
+
+void agnslim_set_threads(int nthreads) {
+  agnslim_nthreads = nthreads;
+}
+
+
+AgnslimCacheInfo agnslim_cache_info(const AgnslimState* state) {
+  std::lock_guard<std::mutex> guard(agnslim_mutex);
+
+  AgnslimCacheInfo info;
+  info.hits = 0;
+  info.misses = 0;
+  info.maxsize = agnslim_cache_maxsize;
+  info.currsize = 0;
+
+  std::set<AgnslimState*>::const_iterator st;
+  for (st = agnslim_states.begin(); st != agnslim_states.end(); ++st) {
+    if ((state != NULL) && (state != *st))
+      continue;
+
+    std::map<int, AgnslimCache>::const_iterator it;
+    for (it = (*st)->caches.begin(); it != (*st)->caches.end(); ++it) {
+      info.hits += it->second.hits();
+      info.misses += it->second.misses();
+      info.currsize += it->second.size();
+    }
+  }
+
+  return info;
+}
+
+AgnslimCacheInfo agnslim_structure_cache_info(const AgnslimState* state) {
+  std::lock_guard<std::mutex> guard(agnslim_mutex);
+
+  AgnslimCacheInfo info;
+  info.hits = 0;
+  info.misses = 0;
+  info.maxsize = agnslim_cache_maxsize;
+  info.currsize = 0;
+
+  std::set<AgnslimState*>::const_iterator st;
+  for (st = agnslim_states.begin(); st != agnslim_states.end(); ++st) {
+    if ((state != NULL) && (state != *st))
+      continue;
+
+    info.hits += (*st)->structures.hits();
+    info.misses += (*st)->structures.misses();
+    info.currsize += (*st)->structures.size();
+  }
+
+  return info;
+}
+
+AgnslimCacheInfo agnslim_rebin_cache_info() {
+  std::lock_guard<std::mutex> guard(agnslim_mutex);
+
+  AgnslimCacheInfo info;
+  info.hits = agnslim_rebin_cache.hits();
+  info.misses = agnslim_rebin_cache.misses();
+  info.maxsize = REBIN_CACHE_SIZE;
+  info.currsize = agnslim_rebin_cache.size();
+  return info;
+}
+
+AgnslimCacheInfo agnslim_shape_cache_info(const AgnslimState* state) {
+  std::lock_guard<std::mutex> guard(agnslim_mutex);
+
+  AgnslimCacheInfo info;
+  info.hits = 0;
+  info.misses = 0;
+  info.maxsize = SHAPE_CACHE_SIZE;
+  info.currsize = 0;
+
+  std::set<AgnslimState*>::const_iterator st;
+  for (st = agnslim_states.begin(); st != agnslim_states.end(); ++st) {
+    if ((state != NULL) && (state != *st))
+      continue;
+
+    info.hits += (*st)->shapes.hits();
+    info.misses += (*st)->shapes.misses();
+    info.currsize += (*st)->shapes.size();
+  }
+
+  return info;
+}
+
+void agnslim_cache_clear(AgnslimState* state) {
+  std::lock_guard<std::mutex> guard(agnslim_mutex);
+
+  if (state == NULL)
+    agnslim_rebin_cache.clear();
+
+  std::set<AgnslimState*>::iterator st;
+  for (st = agnslim_states.begin(); st != agnslim_states.end(); ++st) {
+    if ((state != NULL) && (state != *st))
+      continue;
+
+    std::map<int, AgnslimCache>::iterator it;
+    for (it = (*st)->caches.begin(); it != (*st)->caches.end(); ++it) {
+      it->second.clear();
+    }
+    (*st)->structures.clear();
+    (*st)->shapes.clear();
+  }
+}
+
+void agnslim_cache_resize(size_t maxsize) {
+  std::lock_guard<std::mutex> guard(agnslim_mutex);
+
+  agnslim_cache_maxsize = maxsize;
+
+  std::set<AgnslimState*>::iterator st;
+  for (st = agnslim_states.begin(); st != agnslim_states.end(); ++st) {
+    std::map<int, AgnslimCache>::iterator it;
+    for (it = (*st)->caches.begin(); it != (*st)->caches.end(); ++it) {
+      it->second.resize(maxsize);
+    }
+    (*st)->structures.resize(maxsize);
+  }
+}
@@ -0,0 +1,116 @@
+//
+// This code is placed into the PUBLIC DOMAIN.
+// It was written by Douglas Burke dburke.gw@gmail.com
+//
+// The C++ driver for the agnslim model (the disc calculation itself
+// is in src/xspec/agnslim.f).
+//
+
+#ifndef XSPECLMODELS_AGNSLIM_HH
+#define XSPECLMODELS_AGNSLIM_HH
+
+#include <cstddef>
+
+extern "C" {
+
+  // The XSPEC C-style interface to the model.
+  void C_agnslim(const double* energy, int nFlux, const double* params,
+		 int spectrumNumber, double* flux, double* fluxError,
+		 const char* initStr);
+
+}
+
+// The calculated spectra are cached by each state (which represents
+// a model instance), with a separate cache for each spectrum number,
+// and a cache of the disc structure (which does not depend on the
+// energy grid or all the parameters).
+// A default state is used by C_agnslim, and when agnslim_eval is
+// sent a NULL state. The routines can be called from several
+// threads.
+//
+class AgnslimState;
+
+AgnslimState* agnslim_state_new();
+void agnslim_state_free(AgnslimState* state);
+
+// Evaluate the model. The params array contains 14 values (that is,
+// it does not include the normalization), and flux must have space
+// for nFlux values.
+//
+void agnslim_eval(AgnslimState* state, const double* energy, int nFlux,
+		  const double* params, int spectrumNumber, double* flux);
+
+// The resolution of the calculation: the number of bins in the
+// internal energy grid (nn) and the number of radial zones used by
+// amydiskslim (imax, ipow, icor, iout). The nthcomp spectra of the
+// hot and warm zones are interpolated from a table with nseed points
+// per decade of seed temperature, or calculated for each zone when
+// nseed is 0. When rtol is greater than 0 the ipow, icor, and iout
+// values give the starting number of zones for each region, which are
+// refined until the spectrum has converged to a relative tolerance of
+// about rtol. The defaults match the original FORTRAN code. Changing
+// the resolution of a state does not invalidate its cache, since the
+// settings are part of the cache key.
+//
+struct AgnslimResolution {
+  int nn;
+  int imax;
+  int ipow;
+  int icor;
+  int iout;
+  int nseed;
+  double rtol;
+};
+
+AgnslimResolution agnslim_default_resolution();
+AgnslimResolution agnslim_get_resolution(const AgnslimState* state);
+void agnslim_set_resolution(AgnslimState* state, const AgnslimResolution& res);
+
+// The number of zones in the hot, warm, and outer regions used to
+// calculate the last spectrum returned by agnslim_eval for the state
+// (nz must have space for 3 values). This is mainly of interest when
+// the zones are chosen adaptively.
+//
+void agnslim_get_zones(const AgnslimState* state, int* nz);
+
+// The number of threads used to calculate the spectrum from the disc
+// zones, for all states. This is only used if the FORTRAN code was
+// compiled with OpenMP support (agnslim_has_openmp); a value of 0
+// means use the OpenMP default (normally one per core). The default
+// is 1.
+//
+bool agnslim_has_openmp();
+int agnslim_get_threads();
+void agnslim_set_threads(int nthreads);
+
+// Access to the caches of calculated spectra and disc structures.
+// The counts mirror those reported by functools.lru_cache. When state
+// is NULL the values are summed over all states. The maximum size
+// applies to each cache, and clearing a state clears both types of
+// cache.
+//
+struct AgnslimCacheInfo {
+  size_t hits;
+  size_t misses;
+  size_t maxsize;
+  size_t currsize;
+};
+
+AgnslimCacheInfo agnslim_cache_info(const AgnslimState* state);
+AgnslimCacheInfo agnslim_structure_cache_info(const AgnslimState* state);
+
+// The rebinning maps, from the internal grid to the requested grid,
+// are shared by all states, and are only removed when the caches of
+// all states are cleared (state is NULL). The size of this cache is
+// fixed.
+//
+AgnslimCacheInfo agnslim_rebin_cache_info();
+
+// The tabulated nthcomp spectra (used when nseed is not 0) are also
+// cached by each state, but the maximum size of this cache is fixed.
+//
+AgnslimCacheInfo agnslim_shape_cache_info(const AgnslimState* state);
+void agnslim_cache_clear(AgnslimState* state);
+void agnslim_cache_resize(size_t maxsize);
+
+#endif
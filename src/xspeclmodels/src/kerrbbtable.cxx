@@ -0,0 +1,426 @@
+//
+// This code is placed into the PUBLIC DOMAIN.
+// It was written by Douglas Burke dburke.gw@gmail.com
+//
+// Access to the kerrbb.fits table used by zkerrbb. Reading the FLUX
+// columns from the FITS file is slow, and each process used to keep
+// its own copy of a column (about 12 MB), so the first time the file
+// is read each column is also written out as a binary file, which is
+// then memory-mapped (read only) by any process that needs it. This
+// means that processes running on the same machine share a single
+// copy of the table (via the page cache), and do not need to read
+// the FITS file.
+//
+// The cache files are written to the model data directory - next
+// to kerrbb.fits - or, if that can not be written to, to
+// $XDG_CACHE_HOME/xspeclmodels/ (falling back to
+// $HOME/.cache/xspeclmodels/). Each file has a header which records
+// a version number, the byte order, the grid sizes, and the size and
+// modification time of kerrbb.fits, so that a file which does not
+// match is ignored (and replaced). If the cache can not be used then
+// the table is read from the FITS file, as before.
+//
+// All four columns are read from the FITS file at once, and each
+// column is kept once it has been loaded, so that models using
+// different rflag and lflag settings do not cause the data to be
+// re-read.
+//
+
+#include <algorithm>
+#include <atomic>
+#include <cerrno>
+#include <cstdint>
+#include <cstdio>
+#include <cstdlib>
+#include <cstring>
+#include <mutex>
+#include <sstream>
+#include <string>
+#include <vector>
+
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <sys/types.h>
+#include <unistd.h>
+
+#include <XSFunctions/Utilities/FunctionUtility.h>
+
+#include "kerrbbtable.hh"
+#include "locking.hh"
+
+extern "C" void kbbread_(float* gi, float* ai, float* thetai, float* e,
+			 float* flux0, int& status);
+
+namespace {
+
+  // The number of values in the grid and FLUX arrays.
+  //
+  const size_t NGRID = KERRBB_NG + KERRBB_NS + KERRBB_NTH + KERRBB_NENER;
+  const size_t NFLUX = size_t(KERRBB_NS) * KERRBB_NTH * KERRBB_NG *
+    KERRBB_NENER;
+
+  // The number of FLUX columns.
+  //
+  const int NCOLS = 4;
+
+  // The cache file is the header followed by the gi, ai, thetai, e,
+  // and flux0 arrays, stored as native floats. The version should be
+  // increased if the format changes.
+  //
+  const char CACHE_MAGIC[8] = {'X', 'S', 'L', 'M', 'K', 'B', 'B', '\0'};
+  const uint32_t CACHE_VERSION = 1;
+  const uint32_t CACHE_BYTEORDER = 0x01020304;
+
+  struct CacheHeader {
+    char magic[8];
+    uint32_t version;
+    uint32_t byteorder;
+    uint32_t ng;
+    uint32_t ns;
+    uint32_t nth;
+    uint32_t nener;
+    uint32_t icol;
+    uint32_t pad;
+    int64_t source_size;
+    int64_t source_mtime;
+  };
+
+  const size_t CACHE_SIZE = sizeof(CacheHeader) +
+    (NGRID + NFLUX) * sizeof(float);
+
+  // Set up the pointers to the arrays. The grid values are stored in
+  // the same order as the cache file.
+  //
+  void set_arrays(KerrbbTable* table, const float* grid,
+		  const float* flux0) {
+    table->gi = grid;
+    table->ai = table->gi + KERRBB_NG;
+    table->thetai = table->ai + KERRBB_NS;
+    table->e = table->thetai + KERRBB_NTH;
+    table->flux0 = flux0;
+  }
+
+  // The FLUX column to use (see KBBREAD), numbered from 1.
+  //
+  int select_column(int rflag, int lflag) {
+    if (rflag <= 0)
+      return lflag <= 0 ? 1 : 2;
+
+    return lflag <= 0 ? 3 : 4;
+  }
+
+  CacheHeader make_header(int icol, const struct stat& source) {
+    CacheHeader hdr;
+    std::memset(&hdr, 0, sizeof(hdr));
+    std::memcpy(hdr.magic, CACHE_MAGIC, sizeof(hdr.magic));
+    hdr.version = CACHE_VERSION;
+    hdr.byteorder = CACHE_BYTEORDER;
+    hdr.ng = KERRBB_NG;
+    hdr.ns = KERRBB_NS;
+    hdr.nth = KERRBB_NTH;
+    hdr.nener = KERRBB_NENER;
+    hdr.icol = icol;
+    hdr.source_size = source.st_size;
+    hdr.source_mtime = source.st_mtime;
+    return hdr;
+  }
+
+  std::string cache_name(int icol) {
+    std::ostringstream name;
+    name << "kerrbb_flux" << icol << ".cache";
+    return name.str();
+  }
+
+  std::string join_path(const std::string& dname, const std::string& fname) {
+    if (dname.empty() || dname[dname.size() - 1] == '/')
+      return dname + fname;
+
+    return dname + "/" + fname;
+  }
+
+  // The user cache directory (which may not exist), or an empty
+  // string if it can not be determined.
+  //
+  std::string user_cache_dir() {
+    const char* xdg = std::getenv("XDG_CACHE_HOME");
+    if (xdg && *xdg)
+      return join_path(xdg, "xspeclmodels");
+
+    const char* home = std::getenv("HOME");
+    if (home && *home)
+      return join_path(join_path(home, ".cache"), "xspeclmodels");
+
+    return "";
+  }
+
+  bool make_dirs(const std::string& dname) {
+    struct stat st;
+    if (stat(dname.c_str(), &st) == 0)
+      return S_ISDIR(st.st_mode);
+
+    size_t idx = dname.find_last_of('/');
+    if ((idx != std::string::npos) && (idx > 0) &&
+	!make_dirs(dname.substr(0, idx)))
+      return false;
+
+    return (mkdir(dname.c_str(), 0755) == 0) || (errno == EEXIST);
+  }
+
+  // A read-only memory map of a file.
+  //
+  class MappedFile {
+  public:
+    MappedFile(void* addr, size_t length) : addr_(addr), length_(length) { }
+    ~MappedFile() { munmap(addr_, length_); }
+
+    const char* data() const { return static_cast<const char*>(addr_); }
+
+  private:
+    MappedFile(const MappedFile&);
+    MappedFile& operator=(const MappedFile&);
+
+    void* addr_;
+    size_t length_;
+  };
+
+  // Map the cache file if it exists and matches the expected header.
+  //
+  std::shared_ptr<const KerrbbTable>
+  map_cache(const std::string& fname, const CacheHeader& expected) {
+    std::shared_ptr<const KerrbbTable> out;
+
+    int fd = open(fname.c_str(), O_RDONLY);
+    if (fd < 0)
+      return out;
+
+    struct stat st;
+    CacheHeader hdr;
+    if ((fstat(fd, &st) != 0) ||
+	(st.st_size != off_t(CACHE_SIZE)) ||
+	(pread(fd, &hdr, sizeof(hdr), 0) != ssize_t(sizeof(hdr))) ||
+	(std::memcmp(&hdr, &expected, sizeof(hdr)) != 0)) {
+      close(fd);
+      return out;
+    }
+
+    void* addr = mmap(NULL, CACHE_SIZE, PROT_READ, MAP_SHARED, fd, 0);
+    close(fd);
+    if (addr == MAP_FAILED)
+      return out;
+
+    std::shared_ptr<MappedFile> mapped(new MappedFile(addr, CACHE_SIZE));
+
+    KerrbbTable* table = new KerrbbTable();
+    out.reset(table);
+    const float* grid =
+      reinterpret_cast<const float*>(mapped->data() + sizeof(hdr));
+    set_arrays(table, grid, grid + NGRID);
+    table->storage = mapped;
+    return out;
+  }
+
+  // Write the cache file, using a temporary file so that other
+  // processes never see a partially-written file.
+  //
+  bool write_cache(const std::string& dname, const std::string& fname,
+		   const CacheHeader& hdr, const float* grid,
+		   const float* flux0) {
+    if (!make_dirs(dname))
+      return false;
+
+    std::ostringstream tmpname;
+    tmpname << fname << "." << getpid() << ".tmp";
+
+    FILE* fh = std::fopen(tmpname.str().c_str(), "wb");
+    if (!fh)
+      return false;
+
+    bool okay = (std::fwrite(&hdr, sizeof(hdr), 1, fh) == 1) &&
+      (std::fwrite(grid, sizeof(float), NGRID, fh) == NGRID) &&
+      (std::fwrite(flux0, sizeof(float), NFLUX, fh) == NFLUX);
+    okay = (std::fclose(fh) == 0) && okay;
+    if (okay)
+      okay = std::rename(tmpname.str().c_str(), fname.c_str()) == 0;
+
+    if (!okay)
+      std::remove(tmpname.str().c_str());
+
+    return okay;
+  }
+
+  // The number of times the FITS file has been read.
+  //
+  std::atomic<int> kerrbb_nreads(0);
+
+  // Read the grid values and the four FLUX columns from the FITS
+  // file. They are stored as the grid values followed by each column.
+  // This must be called with the XSPEC lock held.
+  //
+  bool read_fits(std::vector<float>& data) {
+    kerrbb_nreads++;
+    data.resize(NGRID + NCOLS * NFLUX);
+
+    float* gi = &data[0];
+    float* ai = gi + KERRBB_NG;
+    float* thetai = ai + KERRBB_NS;
+    float* e = thetai + KERRBB_NTH;
+    float* flux0 = e + KERRBB_NENER;
+
+    int status = 0;
+    kbbread_(gi, ai, thetai, e, flux0, status);
+    return status == 0;
+  }
+
+  // Return the cached table for the column, if there is a valid
+  // version in one of the directories.
+  //
+  std::shared_ptr<const KerrbbTable>
+  find_cache(const std::vector<std::string>& dirs, int icol,
+	     const struct stat& source) {
+    CacheHeader hdr = make_header(icol, source);
+    for (size_t i = 0; i < dirs.size(); i++) {
+      std::shared_ptr<const KerrbbTable> table =
+	map_cache(join_path(dirs[i], cache_name(icol)), hdr);
+      if (table)
+	return table;
+    }
+
+    return std::shared_ptr<const KerrbbTable>();
+  }
+
+  // Write out the cache for the column, to the first directory that
+  // can be written to, and return the mapped version. An empty
+  // pointer is returned if the cache could not be written.
+  //
+  std::shared_ptr<const KerrbbTable>
+  create_cache(const std::vector<std::string>& dirs, int icol,
+	       const struct stat& source, const float* grid,
+	       const float* flux0) {
+    CacheHeader hdr = make_header(icol, source);
+    for (size_t i = 0; i < dirs.size(); i++) {
+      std::string fname = join_path(dirs[i], cache_name(icol));
+      if (write_cache(dirs[i], fname, hdr, grid, flux0))
+	return map_cache(fname, hdr);
+    }
+
+    return std::shared_ptr<const KerrbbTable>();
+  }
+
+  // The tables for each column. Once a column has been loaded it is
+  // kept, so changing the rflag or lflag settings does not require
+  // any I/O.
+  //
+  std::mutex kerrbb_table_mutex;
+  std::shared_ptr<const KerrbbTable> kerrbb_tables[NCOLS];
+
+  // Load the table for the column. If the FITS file has to be read
+  // then all the columns that have not already been loaded are
+  // stored. This must be called with kerrbb_table_mutex held.
+  //
+  void load_table(int icol) {
+
+    // The model data path is only changed by XSPEC calls, so access
+    // it with the lock held.
+    std::string datadir;
+    {
+      std::lock_guard<XspecLock> guard(xspec_lock());
+      datadir = FunctionUtility::modelDataPath();
+    }
+
+    std::string fitsname = join_path(datadir, "kerrbb.fits");
+
+    std::vector<std::string> dirs;
+    dirs.push_back(datadir);
+    std::string userdir = user_cache_dir();
+    if (!userdir.empty())
+      dirs.push_back(userdir);
+
+    // If the FITS file can not be found then there's no way to check
+    // the cache, so fall through to reading the FITS file (which
+    // will report the error).
+    //
+    struct stat source;
+    bool use_cache = stat(fitsname.c_str(), &source) == 0;
+    if (use_cache) {
+      kerrbb_tables[icol - 1] = find_cache(dirs, icol, source);
+      if (kerrbb_tables[icol - 1])
+	return;
+    }
+
+    std::shared_ptr< std::vector<float> > data(new std::vector<float>());
+    {
+      std::lock_guard<XspecLock> guard(xspec_lock());
+      if (!read_fits(*data))
+	return;
+    }
+
+    const float* grid = &(*data)[0];
+    for (int col = 1; col <= NCOLS; col++) {
+      if (kerrbb_tables[col - 1])
+	continue;
+
+      const float* flux0 = grid + NGRID + (col - 1) * NFLUX;
+
+      std::shared_ptr<const KerrbbTable> table;
+      if (use_cache) {
+	table = find_cache(dirs, col, source);
+	if (!table)
+	  table = create_cache(dirs, col, source, grid, flux0);
+      }
+
+      if (!table) {
+	KerrbbTable* mem = new KerrbbTable();
+	table.reset(mem);
+	set_arrays(mem, grid, flux0);
+	mem->storage = data;
+      }
+
+      kerrbb_tables[col - 1] = table;
+    }
+  }
+
+}
+
+
+std::shared_ptr<const KerrbbTable> get_kerrbb_table(int rflag, int lflag) {
+  std::lock_guard<std::mutex> guard(kerrbb_table_mutex);
+
+  int icol = select_column(rflag, lflag);
+  if (!kerrbb_tables[icol - 1])
+    load_table(icol);
+
+  return kerrbb_tables[icol - 1];
+}
+
+int kerrbb_fits_reads() {
+  return kerrbb_nreads;
+}
+
+int kerrbb_preload() {
+  std::lock_guard<std::mutex> guard(kerrbb_table_mutex);
+
+  int nloaded = 0;
+  for (int icol = 1; icol <= NCOLS; icol++) {
+    if (!kerrbb_tables[icol - 1])
+      load_table(icol);
+
+    std::shared_ptr<const KerrbbTable> table = kerrbb_tables[icol - 1];
+    if (!table)
+      continue;
+
+    // Read one value from each page, so that the data is resident
+    // (for a memory-mapped cache file this reads it into the page
+    // cache, which is shared by all processes).
+    const size_t step = std::max<size_t>(1, sysconf(_SC_PAGESIZE) /
+					 sizeof(float));
+    volatile float total = 0.0f;
+    for (size_t i = 0; i < NFLUX; i += step) {
+      total += table->flux0[i];
+    }
+
+    nloaded++;
+  }
+
+  return nloaded;
+}
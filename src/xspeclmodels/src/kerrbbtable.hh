@@ -0,0 +1,56 @@
+//
+// This code is placed into the PUBLIC DOMAIN.
+// It was written by Douglas Burke dburke.gw@gmail.com
+//
+// The kerrbb.fits table used by the zkerrbb model (the calculation
+// is done in src/xspec/zkerrbb.cxx).
+//
+
+#ifndef XSPECLMODELS_KERRBBTABLE_HH
+#define XSPECLMODELS_KERRBBTABLE_HH
+
+#include <memory>
+
+// The grid sizes, which must match the values in KBBREAD (zrunkbb.f).
+//
+const int KERRBB_NG = 6;
+const int KERRBB_NS = 46;
+const int KERRBB_NTH = 18;
+const int KERRBB_NENER = 601;
+
+// The grid values (eta, spin, inclination, and energy) and one of
+// the FLUX columns. The arrays are either stored in memory or are
+// memory-mapped from the binary cache (see kerrbbtable.cxx).
+//
+struct KerrbbTable {
+  const float* gi;
+  const float* ai;
+  const float* thetai;
+  const float* e;
+  const float* flux0;
+
+  // The owner of the memory the arrays point to.
+  std::shared_ptr<const void> storage;
+};
+
+// Return the table for the given rflag and lflag values, which
+// select the FLUX column. An empty pointer is returned if the data
+// could not be read (the error will have been reported). This can
+// be called from several threads.
+//
+std::shared_ptr<const KerrbbTable> get_kerrbb_table(int rflag, int lflag);
+
+// The number of times the FITS file has been read (each read loads
+// all the columns that are not already loaded, so this should be at
+// most 1). This can be called from several threads.
+//
+int kerrbb_fits_reads();
+
+// Load all four FLUX columns, and make sure the data is resident, so
+// that processes forked after this call share the table and do not
+// need to read it. The return value is the number of columns that
+// could be loaded.
+//
+int kerrbb_preload();
+
+#endif
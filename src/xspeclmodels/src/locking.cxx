@@ -0,0 +1,40 @@
+//
+// This code is placed into the PUBLIC DOMAIN.
+// It was written by Douglas Burke dburke.gw@gmail.com
+//
+// The lock used to serialize calls to the XSPEC model library.
+//
+
+#include <Python.h>
+
+#include <vector>
+
+#include "locking.hh"
+
+// The GIL state for each (possibly nested) call to lock, so that
+// unlock can restore it.
+//
+static thread_local std::vector<PyGILState_STATE> gil_states;
+
+void XspecLock::lock() {
+  gil_states.push_back(PyGILState_Ensure());
+}
+
+void XspecLock::unlock() {
+  PyGILState_STATE state = gil_states.back();
+  gil_states.pop_back();
+  PyGILState_Release(state);
+}
+
+XspecLock& xspec_lock() {
+  static XspecLock lock;
+  return lock;
+}
+
+void xslmlock_() {
+  xspec_lock().lock();
+}
+
+void xslmunlock_() {
+  xspec_lock().unlock();
+}
@@ -0,0 +1,42 @@
+//
+// This code is placed into the PUBLIC DOMAIN.
+// It was written by Douglas Burke dburke.gw@gmail.com
+//
+// The XSPEC model library is not thread safe, so the calls the
+// models make into it - such as donthcomp, inibin, xwrite, and the
+// FITS routines used to read kerrbb.fits - are made while holding a
+// single lock. The FORTRAN code uses the wrappers in
+// src/xspec/locked.f, which call xslmlock and xslmunlock.
+//
+// The models from Sherpa (e.g. XSnthcomp, which also calls
+// donthcomp) are only protected by the GIL, so the lock is the GIL:
+// taking it means that no other XSPEC model can be running, whether
+// it was called by this module or by Sherpa. It can be taken from
+// any thread, whether or not the thread has released the GIL, and
+// can be nested. To avoid deadlocks it must not be taken while
+// holding a lock that is also acquired by code that holds the GIL.
+//
+
+#ifndef XSPECLMODELS_LOCKING_HH
+#define XSPECLMODELS_LOCKING_HH
+
+#include <mutex>
+
+// This can be used with std::lock_guard.
+//
+class XspecLock {
+ public:
+  void lock();
+  void unlock();
+};
+
+XspecLock& xspec_lock();
+
+extern "C" {
+
+  void xslmlock_();
+  void xslmunlock_();
+
+}
+
+#endif
@@ -0,0 +1,108 @@
+//
+// This code is placed into the PUBLIC DOMAIN.
+// It was written by Douglas Burke dburke.gw@gmail.com
+//
+// A small, bounded, least-recently-used cache. It is used to store
+// the results of expensive model calculations, keyed on the model
+// parameters and whatever else the calculation depends on (e.g. the
+// internal energy grid). The hit and miss counts are tracked so that
+// they can be reported back to Python, in the same way that
+// functools.lru_cache reports them.
+//
+// Values are stored as shared pointers so that a caller can keep
+// using an entry even if it is evicted by a later call.
+//
+
+#ifndef XSPECLMODELS_LRUCACHE_HH
+#define XSPECLMODELS_LRUCACHE_HH
+
+#include <cstddef>
+#include <list>
+#include <map>
+#include <memory>
+#include <utility>
+
+template <typename Key, typename Value>
+class LRUCache {
+public:
+
+  typedef std::shared_ptr<const Value> ValuePtr;
+
+  explicit LRUCache(size_t maxsize)
+    : maxsize_(maxsize), hits_(0), misses_(0) { }
+
+  // Returns an empty pointer if the key is not in the cache.
+  ValuePtr get(const Key& key) {
+    typename Index::iterator it = index_.find(key);
+    if (it == index_.end()) {
+      misses_++;
+      return ValuePtr();
+    }
+
+    // Move the entry to the front of the list (most-recently used).
+    entries_.splice(entries_.begin(), entries_, it->second);
+    hits_++;
+    return it->second->second;
+  }
+
+  void put(const Key& key, ValuePtr value) {
+    if (maxsize_ == 0)
+      return;
+
+    typename Index::iterator it = index_.find(key);
+    if (it != index_.end()) {
+      it->second->second = value;
+      entries_.splice(entries_.begin(), entries_, it->second);
+      return;
+    }
+
+    entries_.push_front(std::make_pair(key, value));
+    index_[key] = entries_.begin();
+    trim();
+  }
+
+  void resize(size_t maxsize) {
+    maxsize_ = maxsize;
+    trim();
+  }
+
+  // As with functools.lru_cache, clearing the cache also resets the
+  // statistics.
+  void clear() {
+    entries_.clear();
+    index_.clear();
+    hits_ = 0;
+    misses_ = 0;
+  }
+
+  size_t hits() const { return hits_; }
+  size_t misses() const { return misses_; }
+  size_t maxsize() const { return maxsize_; }
+  size_t size() const { return index_.size(); }
+
+private:
+
+  // The index refers to elements of the list, so copies are not
+  // allowed.
+  LRUCache(const LRUCache&);
+  LRUCache& operator=(const LRUCache&);
+
+  typedef std::list< std::pair<Key, ValuePtr> > Entries;
+  typedef std::map<Key, typename Entries::iterator> Index;
+
+  void trim() {
+    while (index_.size() > maxsize_) {
+      index_.erase(entries_.back().first);
+      entries_.pop_back();
+    }
+  }
+
+  size_t maxsize_;
+  size_t hits_;
+  size_t misses_;
+  Entries entries_;
+  Index index_;
+
+};
+
+#endif
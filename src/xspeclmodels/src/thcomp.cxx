@@ -0,0 +1,384 @@
+//
+// This code is placed into the PUBLIC DOMAIN.
+// It was written by Douglas Burke dburke.gw@gmail.com
+//
+// The driver for the thcompf model. The original FORTRAN code
+// re-created the photon energy grid and the Kompaneets operator (the
+// escape probabilities and the tridiagonal matrix, which is then
+// factorized) on every call, even though they only depend on
+// gamma_tau, kT_e, and the energy grid. When fitting, it is often
+// only the seed spectrum that changes, so the operator - calculated
+// by thcompfop - is stored in a LRU cache, and the convolution then
+// only requires thcompfsolve to be called.
+//
+// The FORTRAN code solves the Kompaneets equation on a grid with as
+// many points as the requested grid, so the time and the memory (much
+// of which is on the stack) grow with the size of the grid. When the
+// grid size is set (see thcomp_set_grid_size), and the requested grid
+// has more bins than this, the seed spectrum is rebinned onto a grid
+// with this number of logarithmically-spaced bins, covering the same
+// range, and the result is interpolated back onto the requested grid
+// (and normalized to the number of photons in the seed spectrum, as
+// thcompfsolve does).
+//
+// Several seed spectra can be convolved with the same parameters (see
+// thcomp_eval_many), in which case the operator is only looked up once
+// and thcompfsolvem solves the tridiagonal systems for a block of the
+// spectra in one pass. Each spectrum gives the same result as a call
+// to thcomp_eval.
+//
+// The FORTRAN routines do not use any shared state, and the cache is
+// protected by a lock, so the model can be evaluated from several
+// threads.
+//
+
+#include <algorithm>
+#include <atomic>
+#include <cmath>
+#include <mutex>
+#include <vector>
+
+#include "lrucache.hh"
+#include "thcomp.hh"
+
+extern "C" {
+
+  void thcompfop_(float* ear, int* ne, float* param, float* x, float* bet,
+		  float* a, float* c, float* alp, float* gam, float* aa,
+		  float* escape, int* interp);
+
+  void thcompfsolve_(float* ear, int* ne, float* param, int* ifl,
+		     float* photar, float* photer, float* x, float* bet,
+		     float* a, float* c, float* alp, float* gam, float* aa,
+		     float* escape, int* interp);
+
+  void thcompfsolvem_(float* ear, int* ne, int* nspec, float* param,
+		      float* photar, float* x, float* bet, float* a,
+		      float* c, float* alp, float* gam, float* aa,
+		      float* escape, int* interp);
+
+}
+
+// The default number of operators to cache; each entry requires
+// about 30 bytes per bin.
+//
+static const size_t DEFAULT_CACHE_SIZE = 8;
+
+// The maximum number of seed spectra sent to thcompfsolvem in one
+// call, which limits the memory it allocates (about 50 bytes per bin
+// per spectrum).
+//
+static const int SOLVE_BLOCK_SIZE = 64;
+
+// The arrays calculated by thcompfop (see th.f90 for details).
+//
+struct ThcompOperator {
+  std::vector<float> x;
+  std::vector<float> bet;
+  std::vector<float> a;
+  std::vector<float> c;
+  std::vector<float> alp;
+  std::vector<float> gam;
+  float aa;
+  float escape;
+  int interp;
+};
+
+// The key is gamma_tau and kT_e followed by the energy grid.
+//
+typedef std::vector<float> ThcompKey;
+typedef LRUCache<ThcompKey, ThcompOperator> ThcompCache;
+
+// This protects the cache.
+//
+static std::mutex thcomp_mutex;
+
+static ThcompCache thcomp_cache(DEFAULT_CACHE_SIZE);
+
+// The number of bins in the internal grid (0 means use the requested
+// grid).
+//
+static std::atomic<int> thcomp_grid_size(0);
+
+
+static ThcompCache::ValuePtr
+calc_operator(const float* ear, int ne, const float* param) {
+
+  ThcompOperator* op = new ThcompOperator();
+  ThcompCache::ValuePtr out(op);
+
+  op->x.resize(ne + 1);
+  op->bet.resize(ne);
+  op->a.resize(ne);
+  op->c.resize(ne);
+  op->alp.resize(ne);
+  op->gam.resize(ne);
+
+  std::vector<float> e(ear, ear + ne + 1);
+  float pars[3] = { param[0], param[1], param[2] };
+  int nn = ne;
+  thcompfop_(&e[0], &nn, pars, &op->x[0], &op->bet[0], &op->a[0],
+	     &op->c[0], &op->alp[0], &op->gam[0], &op->aa, &op->escape,
+	     &op->interp);
+
+  return out;
+}
+
+
+// Return the operator for the ear grid, using the cache if possible.
+//
+static ThcompCache::ValuePtr
+get_operator(const float* ear, int ne, const float* param,
+	     ThcompCounts* counts) {
+
+  ThcompKey key(param, param + 2);
+  key.insert(key.end(), ear, ear + ne + 1);
+
+  // NaN values can not be used in the key.
+  bool use_cache = true;
+  for (size_t i = 0; i < key.size(); i++) {
+    if (key[i] != key[i]) {
+      use_cache = false;
+      break;
+    }
+  }
+
+  // The lock is not held while the operator is calculated, so two
+  // threads may end up calculating the same operator.
+  ThcompCache::ValuePtr op;
+  if (use_cache) {
+    std::lock_guard<std::mutex> guard(thcomp_mutex);
+    op = thcomp_cache.get(key);
+    if (counts) {
+      if (op) {
+	counts->hits++;
+      } else {
+	counts->misses++;
+      }
+    }
+  }
+
+  if (!op) {
+    op = calc_operator(ear, ne, param);
+    if (use_cache) {
+      std::lock_guard<std::mutex> guard(thcomp_mutex);
+      thcomp_cache.put(key, op);
+    }
+  }
+
+  return op;
+}
+
+
+// Convolve the nspec seed spectra, each of ne values, in photar on
+// the ear grid.
+//
+static void
+thcomp_solve(const float* ear, int ne, const float* param, int nspec,
+	     float* photar, ThcompCounts* counts) {
+
+  ThcompCache::ValuePtr op = get_operator(ear, ne, param, counts);
+
+  // The FORTRAN code does not change the operator.
+  std::vector<float> e(ear, ear + ne + 1);
+  float pars[3] = { param[0], param[1], param[2] };
+  int nn = ne;
+
+  if (nspec == 1) {
+    std::vector<float> photer(ne);
+    int ifl = 1;
+    thcompfsolve_(&e[0], &nn, pars, &ifl, photar, &photer[0],
+		  const_cast<float*>(&op->x[0]),
+		  const_cast<float*>(&op->bet[0]),
+		  const_cast<float*>(&op->a[0]),
+		  const_cast<float*>(&op->c[0]),
+		  const_cast<float*>(&op->alp[0]),
+		  const_cast<float*>(&op->gam[0]),
+		  const_cast<float*>(&op->aa),
+		  const_cast<float*>(&op->escape),
+		  const_cast<int*>(&op->interp));
+    return;
+  }
+
+  for (int start = 0; start < nspec; start += SOLVE_BLOCK_SIZE) {
+    int nblock = std::min(SOLVE_BLOCK_SIZE, nspec - start);
+    thcompfsolvem_(&e[0], &nn, &nblock, pars,
+		   photar + static_cast<size_t>(start) * ne,
+		   const_cast<float*>(&op->x[0]),
+		   const_cast<float*>(&op->bet[0]),
+		   const_cast<float*>(&op->a[0]),
+		   const_cast<float*>(&op->c[0]),
+		   const_cast<float*>(&op->alp[0]),
+		   const_cast<float*>(&op->gam[0]),
+		   const_cast<float*>(&op->aa),
+		   const_cast<float*>(&op->escape),
+		   const_cast<int*>(&op->interp));
+  }
+}
+
+
+// Rebin the photons per bin in yin, on the ein grid, onto the eout
+// grid, assuming the photons are evenly spread within each bin. The
+// grids must cover the same range.
+//
+static void
+rebin_photons(const std::vector<float>& ein, const float* yin,
+	      const std::vector<float>& eout, std::vector<float>& yout) {
+
+  size_t nin = ein.size() - 1;
+  size_t nout = eout.size() - 1;
+  yout.assign(nout, 0.0f);
+
+  size_t i = 0;
+  for (size_t j = 0; j < nout; j++) {
+    while ((i < nin) && (ein[i + 1] <= eout[j]))
+      i++;
+
+    double sum = 0.0;
+    for (size_t k = i; (k < nin) && (ein[k] < eout[j + 1]); k++) {
+      double lo = std::max(ein[k], eout[j]);
+      double hi = std::min(ein[k + 1], eout[j + 1]);
+      double width = double(ein[k + 1]) - ein[k];
+      if ((hi > lo) && (width > 0.0))
+	sum += yin[k] * (hi - lo) / width;
+    }
+    yout[j] = static_cast<float>(sum);
+  }
+}
+
+
+// The internal grid for the ear grid, if it is to be used.
+//
+static bool
+internal_grid(const float* ear, int ne, std::vector<float>& e) {
+
+  int nint = thcomp_grid_size;
+  if ((nint <= 0) || (nint >= ne) || !(ear[0] > 0.0f) ||
+      !(ear[ne] > ear[0])) {
+    return false;
+  }
+
+  // The internal grid has the same end points as the requested grid.
+  e.resize(nint + 1);
+  double lmin = std::log10(double(ear[0]));
+  double dloge = (std::log10(double(ear[ne])) - lmin) / nint;
+  e[0] = ear[0];
+  for (int k = 1; k < nint; k++) {
+    e[k] = static_cast<float>(std::pow(10.0, lmin + dloge * k));
+  }
+  e[nint] = ear[ne];
+  return true;
+}
+
+
+// Replace the seed spectrum in photar (on the ear grid) by the
+// convolved spectrum in ph (on the internal grid e).
+//
+static void
+interpolate_photons(const std::vector<float>& e, const float* ph,
+		    const float* ear, int ne, float* photar) {
+
+  // Interpolate the photon density (linearly in log energy) from the
+  // centres of the internal bins to the centres of the requested bins.
+  int nint = e.size() - 1;
+  std::vector<double> lc(nint), dens(nint);
+  for (int k = 0; k < nint; k++) {
+    lc[k] = 0.5 * (std::log10(double(e[k])) + std::log10(double(e[k + 1])));
+    dens[k] = ph[k] / (double(e[k + 1]) - e[k]);
+  }
+
+  double psum = 0.0;
+  for (int i = 0; i < ne; i++) {
+    psum += photar[i];
+  }
+
+  std::vector<double> out(ne);
+  double tsum = 0.0;
+  int k = 0;
+  for (int i = 0; i < ne; i++) {
+    double l = 0.5 * (std::log10(double(ear[i])) +
+		      std::log10(double(ear[i + 1])));
+    while ((k < nint - 2) && (lc[k + 1] < l))
+      k++;
+
+    double w = (l - lc[k]) / (lc[k + 1] - lc[k]);
+    w = std::min(std::max(w, 0.0), 1.0);
+    double d = (1.0 - w) * dens[k] + w * dens[k + 1];
+    out[i] = d * (double(ear[i + 1]) - ear[i]);
+    tsum += out[i];
+  }
+
+  double scale = (tsum != 0.0) ? psum / tsum : 0.0;
+  for (int i = 0; i < ne; i++) {
+    photar[i] = static_cast<float>(out[i] * scale);
+  }
+}
+
+
+void thcomp_eval(const float* ear, int ne, const float* param,
+		 float* photar, ThcompCounts* counts) {
+  thcomp_eval_many(ear, ne, param, 1, photar, counts);
+}
+
+
+void thcomp_eval_many(const float* ear, int ne, const float* param,
+		      int nspec, float* photar, ThcompCounts* counts) {
+
+  if (nspec < 1) {
+    return;
+  }
+
+  std::vector<float> e;
+  if (!internal_grid(ear, ne, e)) {
+    thcomp_solve(ear, ne, param, nspec, photar, counts);
+    return;
+  }
+
+  int nint = e.size() - 1;
+  std::vector<float> eout(ear, ear + ne + 1);
+  std::vector<float> ph(static_cast<size_t>(nspec) * nint);
+  std::vector<float> tmp;
+  for (int j = 0; j < nspec; j++) {
+    rebin_photons(eout, photar + static_cast<size_t>(j) * ne, e, tmp);
+    std::copy(tmp.begin(), tmp.end(),
+	      ph.begin() + static_cast<size_t>(j) * nint);
+  }
+
+  thcomp_solve(&e[0], nint, param, nspec, &ph[0], counts);
+
+  for (int j = 0; j < nspec; j++) {
+    interpolate_photons(e, &ph[static_cast<size_t>(j) * nint], ear, ne,
+			photar + static_cast<size_t>(j) * ne);
+  }
+}
+
+
+int thcomp_get_grid_size() {
+  return thcomp_grid_size;
+}
+
+void thcomp_set_grid_size(int nbins) {
+  thcomp_grid_size = nbins;
+}
+
+
+ThcompCacheInfo thcomp_cache_info() {
+  std::lock_guard<std::mutex> guard(thcomp_mutex);
+
+  ThcompCacheInfo info;
+  info.hits = thcomp_cache.hits();
+  info.misses = thcomp_cache.misses();
+  info.maxsize = thcomp_cache.maxsize();
+  info.currsize = thcomp_cache.size();
+  return info;
+}
+
+void thcomp_cache_clear() {
+  std::lock_guard<std::mutex> guard(thcomp_mutex);
+  thcomp_cache.clear();
+}
+
+void thcomp_cache_resize(size_t maxsize) {
+  std::lock_guard<std::mutex> guard(thcomp_mutex);
+  thcomp_cache.resize(maxsize);
+}
@@ -0,0 +1,67 @@
+//
+// This code is placed into the PUBLIC DOMAIN.
+// It was written by Douglas Burke dburke.gw@gmail.com
+//
+// The driver for the thcompf convolution model (the calculation
+// itself is in src/xspec/th.f90).
+//
+
+#ifndef XSPECLMODELS_THCOMP_HH
+#define XSPECLMODELS_THCOMP_HH
+
+#include <atomic>
+#include <cstddef>
+
+// The cache hits and misses of the calls that were sent this
+// structure (see thcomp_eval), which can be shared between threads.
+//
+struct ThcompCounts {
+  std::atomic<size_t> hits;
+  std::atomic<size_t> misses;
+
+  ThcompCounts() : hits(0), misses(0) { }
+};
+
+// Convolve the seed spectrum in photar (ne values, on the ear grid,
+// which has ne + 1 values), replacing it with the model output. The
+// param array contains gamma_tau, kT_e, and z. This can be called
+// from several threads. If counts is not NULL then the operator cache
+// hit or miss is added to it, as well as to the cache totals.
+//
+void thcomp_eval(const float* ear, int ne, const float* param,
+		 float* photar, ThcompCounts* counts = NULL);
+
+// Convolve the nspec seed spectra in photar (stored one after the
+// other, so photar has nspec * ne values) with the same parameters.
+// The operator is shared, and the tridiagonal systems are solved
+// together, but each spectrum is the same as that from thcomp_eval.
+//
+void thcomp_eval_many(const float* ear, int ne, const float* param,
+		      int nspec, float* photar, ThcompCounts* counts = NULL);
+
+// The number of bins in the internal grid used to solve the
+// Kompaneets equation, for all calls. When it is greater than 0, and
+// smaller than the number of bins in the requested grid, the seed
+// spectrum is rebinned onto a grid of this many logarithmically-spaced
+// bins, and the result interpolated back onto the requested grid. The
+// default is 0, which means the requested grid is used.
+//
+int thcomp_get_grid_size();
+void thcomp_set_grid_size(int nbins);
+
+// The operator for each set of gamma_tau, kT_e, and energy grid
+// is stored in a cache. The counts mirror those reported by
+// functools.lru_cache.
+//
+struct ThcompCacheInfo {
+  size_t hits;
+  size_t misses;
+  size_t maxsize;
+  size_t currsize;
+};
+
+ThcompCacheInfo thcomp_cache_info();
+void thcomp_cache_clear();
+void thcomp_cache_resize(size_t maxsize);
+
+#endif
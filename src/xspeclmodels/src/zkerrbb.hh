@@ -0,0 +1,48 @@
+//
+// This code is placed into the PUBLIC DOMAIN.
+// It was written by Douglas Burke dburke.gw@gmail.com
+//
+// The evaluation of the zkerrbb model (src/xspec/zkerrbb.cxx) without
+// going through the XSPEC C++ interface.
+//
+
+#ifndef XSPECLMODELS_ZKERRBB_HH
+#define XSPECLMODELS_ZKERRBB_HH
+
+#include <cstddef>
+
+// Each state (which represents a model instance) remembers the last
+// distance and interpolated table spectrum it calculated, so that
+// they are not re-calculated when only the other parameters change.
+// A default state is used by the XSPEC interface, and when
+// zkerrbb_eval is sent a NULL state.
+//
+class ZkerrbbState;
+
+ZkerrbbState* zkerrbb_state_new();
+void zkerrbb_state_free(ZkerrbbState* state);
+
+// The number of evaluations that re-used (hits), or had to calculate
+// (misses), the interpolated table spectrum.
+//
+void zkerrbb_memo_info(ZkerrbbState* state, size_t* hits, size_t* misses);
+
+// Evaluate the model. The params array contains 9 values (that is,
+// it does not include the normalization), and the nFlux values are
+// written directly to flux. The calculation is done in single
+// precision, matching the original Fortran code, unless
+// double_precision is set. This can be called from several threads.
+//
+void zkerrbb_eval(ZkerrbbState* state, const double* energy, int nFlux,
+		  const double* params, double* flux, bool double_precision);
+
+// The index of the element of arr (n values in ascending order)
+// closest to each of the nx values in x, picking the first when
+// several are equally close, as used for the table searches (this
+// is for testing). The comparison is done in single precision unless
+// double_precision is set.
+//
+void zkerrbb_nearest(const double* x, int nx, const double* arr, int n,
+		     int* idx, bool double_precision);
+
+#endif
@@ -0,0 +1,445 @@
+#
+# This code is placed into the PUBLIC DOMAIN.
+# It was written by Douglas Burke dburke.gw@gmail.com
+#
+"""
+Record, and replay, the evaluations of the xspeclmodels models.
+
+A trace is started with xspeclmodels.start_trace and stopped with
+xspeclmodels.stop_trace. While it is running every evaluation of an
+XSagnslim, XSzkerrbb, or XSthcompc instance - the parameter values,
+the grid, the spectrum number, and the time taken - is written to
+the file, so that the sequence of calls made by a fit can be
+re-run, and timed, with replay. This lets a fit be profiled, or
+optimizations be compared using real call patterns, without needing
+the data or the Sherpa session that created it.
+
+The replay does not need Sherpa, and can be run from the command
+line with the xspeclmodels-replay script:
+
+    % xspeclmodels-replay fit.trace
+
+File format
+-----------
+
+The file is a binary file, with all values stored little-endian. It
+starts with the 8 bytes b'XSLMTRC1', and is followed by a sequence of
+records, each starting with a single byte that identifies the record:
+
+  I   a model instance, sent when the instance is first evaluated or
+      its settings change: the instance number (uint32), the model
+      (uint8, an index into MODELS), the name (uint16 length and then
+      UTF-8 text), and the settings (uint8 count and float64 values;
+      the resolution for agnslim, the double_precision flag for
+      zkerrbb, and the internal grid size for thcompc)
+
+  C   the cosmology used by zkerrbb, sent when it changes: H0, q0,
+      and lambda0 (float64)
+
+  G   a grid, sent the first time it is used: the grid number
+      (uint32), an 8-byte fingerprint (a BLAKE2 hash of the data),
+      and the xlo and xhi arrays
+
+  E   an evaluation: the instance number and grid number (uint32),
+      the spectrum number and nthreads (int32), the time taken in
+      seconds (float64), and the pars and fluxes arrays (fluxes is
+      only set for thcompc)
+
+Each array is written as the number of dimensions (uint8; 0 means
+no array), the size of each dimension (uint32), and then the data
+(float64). Since each grid is only written once the files are
+dominated by the parameter values.
+
+"""
+
+from collections import namedtuple
+import hashlib
+import struct
+import threading
+import time
+import weakref
+
+import numpy as np
+
+
+__all__ = ('TraceEvaluation', 'ReplayResult', 'read_trace', 'replay',
+           'summarize')
+
+
+MAGIC = b'XSLMTRC1'
+
+MODELS = ('agnslim', 'zkerrbb', 'thcompc')
+
+TraceEvaluation = namedtuple('TraceEvaluation',
+                             ['model', 'instance', 'name', 'settings',
+                              'cosmology', 'pars', 'fluxes', 'xlo', 'xhi',
+                              'fingerprint', 'spectrumNumber', 'nthreads',
+                              'duration'])
+
+ReplayResult = namedtuple('ReplayResult',
+                          ['model', 'name', 'spectrumNumber', 'nbins',
+                           'nsets', 'recorded', 'replayed'])
+
+
+_INSTANCE = struct.Struct('<IB')
+_SETTINGS = struct.Struct('<B')
+_NAME = struct.Struct('<H')
+_COSMOLOGY = struct.Struct('<3d')
+_GRID = struct.Struct('<I8s')
+_EVAL = struct.Struct('<IIiid')
+_NDIM = struct.Struct('<B')
+
+
+def _pack_array(arr):
+    """The bytes representing an array (which can be None)."""
+
+    if arr is None:
+        return _NDIM.pack(0)
+
+    arr = np.ascontiguousarray(arr, dtype='<f8')
+    shape = struct.pack('<{}I'.format(arr.ndim), *arr.shape)
+    return _NDIM.pack(arr.ndim) + shape + arr.tobytes()
+
+
+def _fingerprint(xlo, xhi):
+    """The fingerprint of a grid."""
+
+    h = hashlib.blake2b(digest_size=8)
+    h.update(xlo.tobytes())
+    if xhi is not None:
+        h.update(xhi.tobytes())
+
+    return h.digest()
+
+
+class TraceRecorder:
+    """Write the model evaluations to a file.
+
+    This is used by xspeclmodels.start_trace and should not be
+    created directly.
+
+    Parameters
+    ----------
+    filename : str
+        The file name, which is overwritten if it exists.
+    """
+
+    def __init__(self, filename):
+
+        from . import _models
+
+        self._models = _models
+        self._lock = threading.Lock()
+        self._instances = {}
+        self._ninstances = 0
+        self._grids = {}
+        self._cosmology = None
+        self.filename = filename
+        self.nevals = 0
+
+        self._fh = open(filename, 'wb')
+        self._fh.write(MAGIC)
+
+    def close(self):
+        """Close the file."""
+
+        with self._lock:
+            self._fh.close()
+
+    def _instance(self, model, instance, settings):
+        """Return the instance number, writing a record if needed."""
+
+        key = id(instance)
+        try:
+            ref, num, old = self._instances[key]
+        except KeyError:
+            ref = None
+
+        # The id can be re-used once an instance has been deleted, so
+        # the number of entries can not be used as the next number.
+        #
+        if ref is None or ref() is not instance:
+            ref = weakref.ref(instance)
+            num = self._ninstances
+            self._ninstances += 1
+            old = None
+
+        if settings != old:
+            name = instance.name.encode('utf-8')
+            self._fh.write(b'I' + _INSTANCE.pack(num, MODELS.index(model)) +
+                           _NAME.pack(len(name)) + name +
+                           _SETTINGS.pack(len(settings)) +
+                           struct.pack('<{}d'.format(len(settings)),
+                                       *settings))
+
+        self._instances[key] = (ref, num, settings)
+        return num
+
+    def _grid(self, xlo, xhi):
+        """Return the grid number, writing a record if needed."""
+
+        xlo = np.ascontiguousarray(xlo, dtype='<f8')
+        if xhi is not None:
+            xhi = np.ascontiguousarray(xhi, dtype='<f8')
+
+        fingerprint = _fingerprint(xlo, xhi)
+        try:
+            return self._grids[fingerprint]
+        except KeyError:
+            pass
+
+        num = len(self._grids)
+        self._fh.write(b'G' + _GRID.pack(num, fingerprint) +
+                       _pack_array(xlo) + _pack_array(xhi))
+        self._grids[fingerprint] = num
+        return num
+
+    def record(self, model, instance, settings, pars, fluxes, xlo, xhi,
+               spectrumNumber, nthreads, duration):
+        """Write out an evaluation."""
+
+        with self._lock:
+            if self._fh.closed:
+                return
+
+            if model == 'zkerrbb':
+                cosmology = self._models.cosmology()
+                if cosmology != self._cosmology:
+                    self._fh.write(b'C' + _COSMOLOGY.pack(*cosmology))
+                    self._cosmology = cosmology
+
+            inum = self._instance(model, instance, tuple(settings))
+            gnum = self._grid(xlo, xhi)
+            self._fh.write(b'E' + _EVAL.pack(inum, gnum, spectrumNumber,
+                                             nthreads, duration) +
+                           _pack_array(pars) + _pack_array(fluxes))
+            self.nevals += 1
+
+
+class _Reader:
+    """Read the values from a trace file."""
+
+    def __init__(self, fh):
+        self.fh = fh
+
+    def read(self, nbytes):
+        data = self.fh.read(nbytes)
+        if len(data) != nbytes:
+            raise IOError("trace file is truncated: {}".format(self.fh.name))
+
+        return data
+
+    def unpack(self, st):
+        return st.unpack(self.read(st.size))
+
+    def array(self):
+        ndim, = self.unpack(_NDIM)
+        if ndim == 0:
+            return None
+
+        shape = struct.unpack('<{}I'.format(ndim), self.read(4 * ndim))
+        size = int(np.prod(shape))
+        data = np.frombuffer(self.read(8 * size), dtype='<f8')
+        return data.astype(np.float64).reshape(shape)
+
+
+def read_trace(filename):
+    """Return the evaluations stored in a trace file.
+
+    Parameters
+    ----------
+    filename : str
+        The file created by xspeclmodels.start_trace.
+
+    Yields
+    ------
+    evaluation : TraceEvaluation
+        The model (one of MODELS), the instance number and name, the
+        instance settings, the cosmology (only set for zkerrbb), the
+        arguments sent to the model, the grid fingerprint, and the
+        time taken (in seconds).
+
+    """
+
+    with open(filename, 'rb') as fh:
+        if fh.read(len(MAGIC)) != MAGIC:
+            raise IOError("not a trace file: {}".format(filename))
+
+        rdr = _Reader(fh)
+        instances = {}
+        grids = {}
+        cosmology = None
+        while True:
+            tag = fh.read(1)
+            if tag == b'':
+                return
+
+            if tag == b'I':
+                num, model = rdr.unpack(_INSTANCE)
+                nlen, = rdr.unpack(_NAME)
+                name = rdr.read(nlen).decode('utf-8')
+                nset, = rdr.unpack(_SETTINGS)
+                settings = struct.unpack('<{}d'.format(nset),
+                                         rdr.read(8 * nset))
+                instances[num] = (MODELS[model], name, settings)
+
+            elif tag == b'C':
+                cosmology = rdr.unpack(_COSMOLOGY)
+
+            elif tag == b'G':
+                num, fingerprint = rdr.unpack(_GRID)
+                xlo = rdr.array()
+                xhi = rdr.array()
+                grids[num] = (xlo, xhi, fingerprint)
+
+            elif tag == b'E':
+                inum, gnum, specnum, nthreads, duration = rdr.unpack(_EVAL)
+                pars = rdr.array()
+                fluxes = rdr.array()
+                model, name, settings = instances[inum]
+                xlo, xhi, fingerprint = grids[gnum]
+                cosmo = cosmology if model == 'zkerrbb' else None
+                yield TraceEvaluation(model, inum, name, settings, cosmo,
+                                      pars, fluxes, xlo, xhi, fingerprint,
+                                      specnum, nthreads, duration)
+
+            else:
+                emsg = "invalid record in trace file: {}"
+                raise IOError(emsg.format(filename))
+
+
+def replay(filename, models=None):
+    """Re-run the evaluations stored in a trace file.
+
+    Each instance in the trace is given its own state (that is, cache)
+    and the evaluations are made in the order they were recorded, so
+    the caches behave as they did when the trace was created (other
+    than the thcompc cache, which is shared by all instances and
+    is not cleared before the replay).
+
+    Parameters
+    ----------
+    filename : str
+        The file created by xspeclmodels.start_trace.
+    models : module or None, optional
+        The compiled models. If not set then xspeclmodels._models is
+        used, which requires Sherpa; the xspeclmodels-replay script
+        loads the module directly so that Sherpa is not needed (in
+        which case the XSPEC model library must have been initialized
+        with its initialize routine).
+
+    Returns
+    -------
+    results : list of ReplayResult
+        The recorded and replayed times (in seconds) for each
+        evaluation.
+
+    See Also
+    --------
+    read_trace, summarize
+
+    """
+
+    if models is None:
+        from . import _initialize_xspec
+        from . import _models as models
+
+        _initialize_xspec()
+
+    funcs = {'agnslim': models.agnslim,
+             'zkerrbb': models.C_zkerrbb,
+             'thcompc': models.thcompf}
+
+    states = {}
+    cosmology = None
+    out = []
+    for ev in read_trace(filename):
+
+        try:
+            state, settings = states[ev.instance]
+        except KeyError:
+            state, settings = None, None
+            if ev.model == 'agnslim':
+                state = models.agnslim_state()
+            elif ev.model == 'zkerrbb':
+                state = models.zkerrbb_state()
+
+        kwargs = {'spectrumNumber': ev.spectrumNumber,
+                  'nthreads': ev.nthreads}
+        if ev.model == 'agnslim':
+            if ev.settings != settings:
+                # The zone counts and nseed are integers, rtol is not.
+                res = [int(v) for v in ev.settings[:6]]
+                res.extend(ev.settings[6:])
+                models.agnslim_set_resolution(state, *res)
+
+            kwargs['state'] = state
+
+        elif ev.model == 'thcompc':
+            # Traces written before the grid size was recorded use
+            # the requested grid.
+            nbins = int(ev.settings[0]) if ev.settings else 0
+            models.thcompf_set_grid_size(nbins)
+
+        elif ev.model == 'zkerrbb':
+            kwargs['state'] = state
+            kwargs['double_precision'] = bool(ev.settings[0])
+            if ev.cosmology != cosmology:
+                models.set_cosmology(*ev.cosmology)
+                cosmology = ev.cosmology
+
+        states[ev.instance] = (state, ev.settings)
+
+        args = [ev.pars]
+        if ev.fluxes is not None:
+            args.append(ev.fluxes)
+
+        args.append(ev.xlo)
+        if ev.xhi is not None:
+            args.append(ev.xhi)
+
+        start = time.perf_counter()
+        funcs[ev.model](*args, **kwargs)
+        elapsed = time.perf_counter() - start
+
+        nsets = ev.pars.shape[0] if ev.pars.ndim == 2 else 1
+        out.append(ReplayResult(ev.model, ev.name, ev.spectrumNumber,
+                                ev.xlo.size, nsets, ev.duration, elapsed))
+
+    return out
+
+
+def summarize(results):
+    """Summarize the replay results for each model instance.
+
+    Parameters
+    ----------
+    results : list of ReplayResult
+        The output of replay.
+
+    Returns
+    -------
+    summary : str
+        A table listing, for each instance, the number of calls and
+        the total recorded and replayed times.
+
+    """
+
+    totals = {}
+    for res in results:
+        key = (res.model, res.name)
+        ncalls, trec, trep = totals.get(key, (0, 0.0, 0.0))
+        totals[key] = (ncalls + 1, trec + res.recorded, trep + res.replayed)
+
+    lines = ['{:8s} {:16s} {:>8s} {:>12s} {:>12s}'.format('model', 'name',
+                                                          'calls',
+                                                          'recorded',
+                                                          'replayed')]
+    for (model, name), (ncalls, trec, trep) in sorted(totals.items()):
+        lines.append('{:8s} {:16s} {:8d} {:12.4f} {:12.4f}'.format(model,
+                                                                   name,
+                                                                   ncalls,
+                                                                   trec,
+                                                                   trep))
+
+    return '\n'.join(lines)
@@ -24,13 +24,18 @@ logger = logging.getLogger('sherpa')
 # For now process all models (including convolution style) the
 # same way.
 #
-xsmodels = set([n for n in dir(xspec) if n.startswith('XS')])
-
 for name in xspeclmodels.__all__:
-    if not name.startswith('XS') or name in xsmodels:
+    if not name.startswith('XS') or hasattr(xspec, name):
+        continue
+
+    # XSthcompc is listed when sherpa_contrib can be found, but that
+    # does not mean it can be imported.
+    cls = getattr(xspeclmodels, name, None)
+    if cls is None:
+        logger.warning("Unable to add XSPEC local model: {}".format(
+            name.lower()))
         continue
 
-    cls = getattr(xspeclmodels, name)
     ui.add_model(cls)
 
     logger.info("Adding XSPEC local model: {}".format(name.lower()))